@@ -0,0 +1,204 @@
+"""
+Pluggable providers for the symmetric primitives used by our transports.
+
+obfs2, obfs3 and ScrambleSuit need AES (in counter mode, and in CBC mode for
+ScrambleSuit's session tickets) and HMAC-SHA256. This module picks the fastest
+available implementation of each at import time:
+
+AES: OpenSSL (through the 'cryptography' package), falling back to PyCrypto.
+
+HMAC-SHA256: the stdlib's hmac/hashlib modules (which are backed by
+OpenSSL and have the lowest per-call overhead for our message sizes),
+then OpenSSL through 'cryptography', and PyCrypto as a last resort.
+"""
+
+import binascii
+import hashlib
+import hmac
+import warnings
+
+try:
+    with warnings.catch_warnings():
+        # Recent versions of 'cryptography' complain about Python 2.
+        warnings.simplefilter("ignore")
+        from cryptography.hazmat.backends import default_backend
+        from cryptography.hazmat.primitives import hashes as openssl_hashes
+        from cryptography.hazmat.primitives import hmac as openssl_hmac
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    openssl_backend = default_backend()
+except ImportError:
+    openssl_backend = None
+
+try:
+    from Crypto.Cipher import AES as PyCryptoAES
+    from Crypto.Util import Counter as PyCryptoCounter
+    import Crypto.Hash.HMAC
+    import Crypto.Hash.SHA256
+    have_pycrypto = True
+except ImportError:
+    have_pycrypto = False
+
+class OpenSSLCipher(object):
+    """AES provided by OpenSSL through the 'cryptography' package."""
+
+    name = "openssl"
+
+    def aes_ctr(self, key, counter_block, wraparound):
+        # OpenSSL always wraps the 128-bit counter block around.
+        return Cipher(algorithms.AES(key), modes.CTR(counter_block),
+                      openssl_backend).encryptor().update
+
+    def aes_cbc_encrypt(self, key, iv, data):
+        encryptor = Cipher(algorithms.AES(key), modes.CBC(iv),
+                           openssl_backend).encryptor()
+        return encryptor.update(data) + encryptor.finalize()
+
+    def aes_cbc_decrypt(self, key, iv, data):
+        decryptor = Cipher(algorithms.AES(key), modes.CBC(iv),
+                           openssl_backend).decryptor()
+        return decryptor.update(data) + decryptor.finalize()
+
+class PyCryptoCipher(object):
+    """AES provided by PyCrypto."""
+
+    name = "pycrypto"
+
+    def aes_ctr(self, key, counter_block, wraparound):
+        ctr = PyCryptoCounter.new(128,
+                                  initial_value=long(binascii.hexlify(counter_block), 16),
+                                  allow_wraparound=wraparound)
+        return PyCryptoAES.new(key, PyCryptoAES.MODE_CTR, counter=ctr).encrypt
+
+    def aes_cbc_encrypt(self, key, iv, data):
+        return PyCryptoAES.new(key, PyCryptoAES.MODE_CBC, iv).encrypt(data)
+
+    def aes_cbc_decrypt(self, key, iv, data):
+        return PyCryptoAES.new(key, PyCryptoAES.MODE_CBC, iv).decrypt(data)
+
+class HashlibHMAC(object):
+    """HMAC-SHA256 provided by the stdlib."""
+
+    name = "hashlib"
+
+    def hmac_sha256(self, key):
+        return hmac.new(key, digestmod=hashlib.sha256)
+
+class OpenSSLHMACContext(object):
+    """
+    Wrap a 'cryptography' HMAC object so that it looks like the stdlib's
+    hmac objects: update(), copy() and a non-destructive digest().
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+    def update(self, msg):
+        self.ctx.update(bytes(msg))
+
+    def copy(self):
+        return OpenSSLHMACContext(self.ctx.copy())
+
+    def digest(self):
+        return self.ctx.copy().finalize()
+
+class OpenSSLHMAC(object):
+    """HMAC-SHA256 provided by OpenSSL through the 'cryptography' package."""
+
+    name = "openssl"
+
+    def hmac_sha256(self, key):
+        return OpenSSLHMACContext(openssl_hmac.HMAC(key, openssl_hashes.SHA256(),
+                                                    openssl_backend))
+
+class PyCryptoHMAC(object):
+    """HMAC-SHA256 provided by PyCrypto."""
+
+    name = "pycrypto"
+
+    def hmac_sha256(self, key):
+        return Crypto.Hash.HMAC.new(key, digestmod=Crypto.Hash.SHA256)
+
+# All the providers we can use, ordered by preference.
+CIPHER_BACKENDS = []
+if openssl_backend:
+    CIPHER_BACKENDS.append(OpenSSLCipher())
+if have_pycrypto:
+    CIPHER_BACKENDS.append(PyCryptoCipher())
+
+HMAC_BACKENDS = [HashlibHMAC()]
+if openssl_backend:
+    HMAC_BACKENDS.append(OpenSSLHMAC())
+if have_pycrypto:
+    HMAC_BACKENDS.append(PyCryptoHMAC())
+
+if not CIPHER_BACKENDS:
+    raise ImportError("No AES implementation found. Please install "
+                      "'cryptography' or PyCrypto.")
+
+cipher_backend = CIPHER_BACKENDS[0]
+hmac_backend = HMAC_BACKENDS[0]
+
+def get_backend_names():
+    """Return the names of the (AES, HMAC-SHA256) providers in use."""
+
+    return (cipher_backend.name, hmac_backend.name)
+
+def set_backends(cipher_name=None, hmac_name=None):
+    """
+    Use the providers called 'cipher_name' and 'hmac_name' from now on.
+    None keeps the current provider.
+
+    Throws ValueError if a provider is not available.
+    """
+
+    global cipher_backend, hmac_backend
+
+    if cipher_name:
+        cipher_backend = _find_backend(CIPHER_BACKENDS, cipher_name)
+    if hmac_name:
+        hmac_backend = _find_backend(HMAC_BACKENDS, hmac_name)
+
+def _find_backend(backends, name):
+    for backend in backends:
+        if backend.name == name:
+            return backend
+
+    raise ValueError("Crypto backend '%s' is not available." % name)
+
+def aes_ctr(key, counter_block, wraparound=False):
+    """
+    Return a function that encrypts (and decrypts) a stream of data
+    using AES in counter mode with 'key'. The 128-bit counter starts
+    at the 16-byte 'counter_block' and is incremented as a big-endian
+    integer.
+
+    If 'wraparound' is False, PyCrypto refuses to wrap the counter
+    around. With any sensible key lifetime, this never happens.
+    """
+
+    return cipher_backend.aes_ctr(key, counter_block, wraparound)
+
+def aes_cbc_encrypt(key, iv, data):
+    """Encrypt 'data' (a multiple of 16 bytes) using AES-CBC."""
+
+    return cipher_backend.aes_cbc_encrypt(key, iv, data)
+
+def aes_cbc_decrypt(key, iv, data):
+    """Decrypt 'data' (a multiple of 16 bytes) using AES-CBC."""
+
+    return cipher_backend.aes_cbc_decrypt(key, iv, data)
+
+def hmac_sha256(key):
+    """
+    Return a new HMAC-SHA256 object keyed with 'key'. It supports
+    update(), digest() and copy() like the stdlib's hmac objects.
+    """
+
+    return hmac_backend.hmac_sha256(key)
+
+def hmac_sha256_digest(key, msg):
+    """Return the HMAC-SHA256 of 'msg' using 'key'."""
+
+    h = hmac_backend.hmac_sha256(key)
+    h.update(msg)
+    return h.digest()
@@ -0,0 +1,154 @@
+"""
+Crypto worker: runs the expensive public-key operations of our
+handshakes in a pool of worker processes.
+
+Pure-Python (and gmpy) bignum arithmetic holds the GIL, so running it
+in Twisted's thread pool does not let other handshakes make progress.
+A process pool does. Results are handed back to the reactor thread
+and delivered through Deferreds.
+
+If no process pool can be created (or if it was disabled by setting
+the number of workers to 0), the work is done in the reactor's thread
+pool instead.
+"""
+
+import multiprocessing
+import signal
+
+from twisted.internet import defer, reactor, threads
+
+import obfsproxy.common.log as logging
+import obfsproxy.transports.obfs3_dh as obfs3_dh
+
+log = logging.get_obfslogger()
+
+def _init_worker():
+    """
+    Initializer of the worker processes.
+
+    The workers are forked off the reactor process and inherit its
+    signal handlers, which would try to stop a reactor that is not
+    running in the worker. Restore the default handlers instead, and
+    leave Ctrl-C to the parent: it will tear down the pool.
+    """
+    signal.set_wakeup_fd(-1)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def _call(func, args):
+    """
+    Call 'func' with 'args' in a worker process. Python 2's
+    multiprocessing has no error callbacks, so exceptions are returned
+    instead of raised.
+    """
+    try:
+        return (True, func(*args))
+    except Exception, e:
+        return (False, e)
+
+class CryptoWorker(object):
+    """
+    A lazily started process pool for crypto operations.
+
+    Attributes:
+    workers, the number of worker processes. 0 means that the reactor's
+    thread pool is used instead.
+    pool, the multiprocessing.Pool (or None if it's not running).
+    """
+
+    def __init__(self, workers=None):
+        self.workers = 0
+        self.set_workers(workers)
+        self.pool = None
+        self.failed = False # True if we could not create a pool.
+
+    def set_workers(self, workers):
+        """
+        Use 'workers' worker processes. None means one per CPU core.
+        Takes effect the next time the pool is started.
+
+        Throws ValueError if 'workers' is negative.
+        """
+        if workers is None:
+            try:
+                workers = multiprocessing.cpu_count()
+            except NotImplementedError:
+                workers = 1
+
+        if workers < 0:
+            raise ValueError("Invalid number of crypto workers (%d)." % workers)
+
+        self.workers = workers
+
+    def start(self):
+        """
+        Start the worker processes, if they are not running already.
+
+        Transports should call this from their setup(): the workers are
+        forked, and we don't want them to inherit the sockets of live
+        connections (closing a connection would not close the socket in
+        the workers).
+        """
+        if self.pool or self.failed or (self.workers == 0):
+            return
+
+        try:
+            self.pool = multiprocessing.Pool(self.workers, _init_worker)
+        except (OSError, ImportError), e:
+            log.warning("Could not start crypto worker processes (%s). "
+                        "Using threads instead." % e)
+            self.failed = True
+            return
+
+        log.debug("Started %d crypto worker process(es)." % self.workers)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        """
+        Terminate the worker processes.
+        """
+        if not self.pool:
+            return
+
+        self.pool.terminate()
+        self.pool.join()
+        self.pool = None
+
+    def run(self, func, *args):
+        """
+        Run 'func(*args)' in a worker process and return a Deferred that
+        fires with its result. 'func' and 'args' must be picklable.
+        """
+        self.start()
+
+        if not self.pool:
+            return threads.deferToThread(func, *args)
+
+        d = defer.Deferred()
+
+        def done(result):
+            # Called in the pool's result handler thread.
+            success, value = result
+            if success:
+                reactor.callFromThread(d.callback, value)
+            else:
+                reactor.callFromThread(d.errback, value)
+
+        self.pool.apply_async(_call, (func, args), callback=done)
+
+        return d
+
+    def compute_shared_secret(self, priv, their_pub_str):
+        """
+        Compute the UniformDH shared secret of our private key 'priv' (an
+        integer) and the other party's public key 'their_pub_str' (a
+        string of bytes).
+
+        Return a Deferred that fires with the shared secret as a string
+        of bytes, or fails with ValueError if the public key was bogus.
+        """
+        return self.run(obfs3_dh.compute_shared_secret, long(priv), their_pub_str)
+
+# The process-wide crypto worker.
+crypto_worker = CryptoWorker()
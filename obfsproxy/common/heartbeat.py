@@ -4,6 +4,7 @@ import datetime
 import socket # for socket.inet_pton()
 
 import obfsproxy.common.log as logging
+import obfsproxy.common.metrics as metrics
 
 log = logging.get_obfslogger()
 
@@ -99,11 +100,54 @@ class Heartbeat(object):
             log.debug("Resetting heartbeat.")
             self.reset_stats()
 
+    def say_metrics(self):
+        """Log the circuit metrics of each transport."""
+
+        for name, values in sorted(metrics.registry.snapshot().items()):
+            handshakes = values['handshake_seconds']
+            if handshakes['count']:
+                handshake_str = "%.3f" % (handshakes['sum'] / handshakes['count'])
+            else:
+                handshake_str = "-"
+
+            log.info("Heartbeat: %s: %d open circuit(s), %d opened and %d closed;"
+                     " %d/%d byte(s) in/out downstream, %d/%d upstream;"
+                     " %s second(s) per handshake on average.",
+                     name, values['open_circuits'],
+                     values['circuits_opened'], values['circuits_closed'],
+                     values['downstream_bytes_in'], values['downstream_bytes_out'],
+                     values['upstream_bytes_in'], values['upstream_bytes_out'],
+                     handshake_str)
+
+    def get_report(self):
+        """
+        Return our connection stats in a form that can be serialized,
+        and reset them. Used by worker processes to report to their
+        supervisor.
+        """
+
+        report = {'n_connections': self.n_connections,
+                  'unique_ips': [ip.encode('hex') for ip in self.unique_ips]}
+
+        self.n_connections = 0
+        self.unique_ips = set()
+
+        return report
+
+    def merge_report(self, report):
+        """
+        Add the stats of a worker process (see get_report()) to ours.
+        """
+
+        self.n_connections += report['n_connections']
+        self.unique_ips.update(ip.decode('hex') for ip in report['unique_ips'])
+
     def talk(self):
         """Do a heartbeat."""
 
         self.say_uptime()
         self.say_stats()
+        self.say_metrics()
 
 # A heartbeat singleton.
 heartbeat = Heartbeat()
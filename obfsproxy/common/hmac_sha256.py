@@ -1,5 +1,4 @@
-import hashlib
-import hmac
+import obfsproxy.common.crypto_backend as crypto_backend
 
 def hmac_sha256_digest(key, msg):
     """
@@ -7,4 +6,4 @@ def hmac_sha256_digest(key, msg):
     'msg' with key 'key'.
     """
 
-    return hmac.new(key, msg, hashlib.sha256).digest()
+    return crypto_backend.hmac_sha256_digest(key, msg)
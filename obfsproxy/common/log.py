@@ -1,9 +1,31 @@
 """obfsproxy logging code"""
 import logging
+import logging.handlers
+import os
 import sys
+import threading
+import time
+import collections
 
 from twisted.python import log
 
+# Logging levels, for ObfsLogger.is_enabled_for().
+DEBUG = logging.DEBUG
+INFO = logging.INFO
+WARNING = logging.WARNING
+ERROR = logging.ERROR
+
+# Number of log records that may wait to be written to the log file.
+LOG_QUEUE_SIZE = 10000
+
+# Time (in seconds) the log writer waits for more records after the first
+# record of a batch arrived.
+LOG_WRITE_DELAY = 0.01
+
+# What to do with log records while the log queue is full: 'drop' them, or
+# 'block' until the log file caught up.
+LOG_QUEUE_POLICIES = ('drop', 'block')
+
 def get_obfslogger():
     """ Return the current ObfsLogger instance """
     return OBFSLOGGER
@@ -39,15 +61,38 @@ class ObfsLogger(object):
         formatter = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
         handler.setFormatter(formatter)
 
-    def set_log_file(self, filename):
-        """Set up our logger so that it starts logging to file in 'filename' instead."""
+    def set_log_file(self, filename, queue_size=LOG_QUEUE_SIZE, policy='drop',
+                     max_bytes=0, backup_count=1):
+        """
+        Set up our logger so that it starts logging to file in 'filename' instead.
 
-        # remove the default handler, and add the FileHandler:
-        self.obfslogger.removeHandler(self.default_handler)
+        Log records are queued and written by a background thread (see
+        QueuedFileHandler), unless 'queue_size' is 0. Then every record
+        is written right away. If 'max_bytes' is set, the log file is
+        rotated once it would grow beyond 'max_bytes', keeping
+        'backup_count' old log files.
+
+        Raises ValueError if an argument is invalid.
+        """
 
-        log_handler = logging.FileHandler(filename)
+        if queue_size < 0:
+            raise ValueError("The log queue size can't be negative (%d)." % queue_size)
+        if max_bytes < 0 or backup_count < 0:
+            raise ValueError("Invalid log rotation settings (%d bytes, %d backups)." %
+                             (max_bytes, backup_count))
+
+        if queue_size:
+            log_handler = QueuedFileHandler(filename, queue_size, policy,
+                                            max_bytes, backup_count)
+        elif max_bytes:
+            log_handler = logging.handlers.RotatingFileHandler(filename, maxBytes=max_bytes,
+                                                               backupCount=backup_count)
+        else:
+            log_handler = logging.FileHandler(filename)
         self.set_formatter(log_handler)
 
+        # remove the default handler, and add the new one:
+        self.obfslogger.removeHandler(self.default_handler)
         self.obfslogger.addHandler(log_handler)
 
 
@@ -71,17 +116,28 @@ class ObfsLogger(object):
         self.safe_logging = False
 
 
+    def is_enabled_for(self, level):
+        """
+        Return True if messages of 'level' (e.g. DEBUG) are logged.
+
+        Hot paths use this to skip building expensive log arguments.
+        Plain messages should rather pass their arguments to the logging
+        methods, which only format them if the message is logged.
+        """
+
+        return self.obfslogger.isEnabledFor(level)
+
     def safe_addr_str(self, address):
         """
         Unless safe_logging is False, we return '[scrubbed]' instead
         of the address parameter. If safe_logging is false, then we
         return the address itself.
+
+        The address is only scrubbed or converted to a string when it's
+        formatted, so pass the result as an argument of a logging method.
         """
 
-        if self.safe_logging:
-            return '[scrubbed]'
-        else:
-            return address
+        return SafeAddress(self, address)
 
     def debug(self, msg, *args, **kwargs):
         """ Class wrapper around debug logging method """
@@ -113,5 +169,171 @@ class ObfsLogger(object):
 
         self.obfslogger.exception(msg, *args, **kwargs)
 
+class SafeAddress(object):
+    """
+    An address which turns into '[scrubbed]' when formatted, unless safe
+    logging is disabled.
+    """
+
+    __slots__ = ('logger', 'address')
+
+    def __init__(self, logger, address):
+        self.logger = logger
+        self.address = address
+
+    def __str__(self):
+        if self.logger.safe_logging:
+            return '[scrubbed]'
+        else:
+            return str(self.address)
+
+class QueuedFileHandler(logging.Handler):
+    """
+    Log handler which writes to a file without blocking the event loop.
+
+    Records are formatted in the thread which logs them and put into a
+    bounded queue. A background thread writes them to the file in batches and
+    rotates the file by size. While the queue is full, records are
+    dropped or the logging thread blocks, depending on 'policy'.
+
+    Attributes:
+    dropped: Number of records dropped because the queue was full or
+             the log file could not be written.
+    """
+
+    def __init__(self, filename, queue_size=LOG_QUEUE_SIZE, policy='drop',
+                 max_bytes=0, backup_count=1):
+        logging.Handler.__init__(self)
+
+        if policy not in LOG_QUEUE_POLICIES:
+            raise ValueError("Unknown log queue policy '%s'." % policy)
+
+        self.filename = os.path.abspath(filename)
+        self.queue_size = queue_size
+        self.policy = policy
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+
+        self.dropped = 0
+        self.reported_dropped = 0
+        self.dropped_lock = threading.Lock()
+
+        self.stream = open(self.filename, 'a')
+        self.stream.seek(0, os.SEEK_END)
+        self.size = self.stream.tell()
+
+        # Appending to a deque is thread-safe and much cheaper than
+        # Queue.Queue. The writer is only woken up for the first record of
+        # a batch.
+        self.queue = collections.deque()
+        self.queued = threading.Event() # Set when the queue became non-empty.
+        self.drained = threading.Event() # Set when the writer took a batch.
+        self.stopping = False
+
+        self.writer = threading.Thread(target=self._run, name="log writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def emit(self, record):
+        try:
+            line = self.format(record) + '\n'
+        except Exception:
+            self.handleError(record)
+            return
+
+        while len(self.queue) >= self.queue_size:
+            if self.policy == 'drop' or not self.writer.is_alive():
+                with self.dropped_lock:
+                    self.dropped += 1
+                return
+            self.drained.clear()
+            if len(self.queue) >= self.queue_size:
+                self.drained.wait(0.1)
+
+        self.queue.append(line)
+        if len(self.queue) == 1:
+            self.queued.set()
+
+    def close(self):
+        """Write the queued records and close the log file."""
+        if self.writer.is_alive():
+            self.stopping = True
+            self.queued.set()
+            self.writer.join()
+
+        logging.Handler.close(self)
+
+    def _run(self):
+        while True:
+            self.queued.wait()
+            if not self.stopping:
+                # Let a batch build up.
+                time.sleep(LOG_WRITE_DELAY)
+            self.queued.clear()
+
+            lines = []
+            try:
+                while True:
+                    lines.append(self.queue.popleft())
+            except IndexError:
+                pass
+            self.drained.set()
+
+            dropped = self.dropped
+            if dropped != self.reported_dropped:
+                lines.insert(0, self._dropped_line(dropped - self.reported_dropped))
+                self.reported_dropped = dropped
+
+            if lines:
+                try:
+                    self._write(lines)
+                except (EnvironmentError, ValueError): # ValueError: the file is closed.
+                    with self.dropped_lock:
+                        self.dropped += len(lines)
+
+            if self.stopping and not self.queue:
+                break
+
+        self.stream.close()
+
+    def _dropped_line(self, n):
+        record = logging.makeLogRecord({
+            'name': 'obfslogger', 'levelno': logging.WARNING, 'levelname': 'WARNING',
+            'msg': "Dropped %d log message(s).",
+            'args': (n,)})
+        return self.format(record) + '\n'
+
+    def _write(self, lines):
+        """Write 'lines' to the log file, rotating it as needed."""
+        chunk = []
+        for line in lines:
+            if self.max_bytes and self.size and (self.size + len(line) > self.max_bytes):
+                self.stream.write(''.join(chunk))
+                chunk = []
+                self._rotate()
+            chunk.append(line)
+            self.size += len(line)
+
+        self.stream.write(''.join(chunk))
+        self.stream.flush()
+
+    def _rotate(self):
+        """Move the log file to 'filename.1' and start a new one."""
+        self.stream.close()
+
+        try:
+            for i in xrange(self.backup_count, 0, -1):
+                src = "%s.%d" % (self.filename, i - 1) if i > 1 else self.filename
+                dst = "%s.%d" % (self.filename, i)
+                if os.path.exists(src):
+                    if os.path.exists(dst):
+                        os.remove(dst)
+                    os.rename(src, dst)
+        finally:
+            # Without backups, the log file is truncated instead.
+            self.stream = open(self.filename, 'a' if self.backup_count else 'w')
+            self.stream.seek(0, os.SEEK_END)
+            self.size = self.stream.tell()
+
 """ Global variable that will track our Obfslogger instance """
 OBFSLOGGER = ObfsLogger()
@@ -0,0 +1,256 @@
+"""
+Runtime metrics of obfsproxy's circuits.
+
+The metrics are aggregated per transport name: how many circuits were
+opened and closed (and why), how many bytes went in and out of each side
+of the circuits, and how long handshakes took. Updating them only
+increments integers, so they stay enabled in production.
+
+Exporters, like the heartbeat, read them using 'registry.snapshot()'.
+"""
+
+import bisect
+import sys
+import weakref
+
+# Upper bounds (in seconds) of the buckets of duration histograms.
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Counters kept for every transport.
+COUNTERS = ('circuits_opened', 'circuits_closed',
+            'upstream_bytes_in', 'upstream_bytes_out',
+            'downstream_bytes_in', 'downstream_bytes_out')
+
+# Duration histograms kept for every transport:
+#   handshake_seconds: From the completion of a circuit until its
+#                      transport finished the handshake. Transports
+#                      without a handshake don't report it.
+#   first_byte_seconds: From the creation of a circuit until its first
+#                       byte arrives from downstream.
+HISTOGRAMS = ('handshake_seconds', 'first_byte_seconds')
+
+class Histogram(object):
+    """
+    Counts observed values in buckets with fixed upper bounds, like a
+    Prometheus histogram. The last bucket has no upper bound.
+    """
+
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds=DURATION_BUCKETS):
+        self.bounds = bounds
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        return {'bounds': list(self.bounds),
+                'counts': list(self.counts),
+                'sum': self.sum,
+                'count': self.count}
+
+    def merge(self, snapshot):
+        """Add the values of a histogram 'snapshot' to ours."""
+        if list(snapshot['bounds']) != list(self.bounds):
+            raise ValueError("Can't merge histograms with different buckets.")
+
+        for i, count in enumerate(snapshot['counts']):
+            self.counts[i] += count
+        self.sum += snapshot['sum']
+        self.count += snapshot['count']
+
+class TransportMetrics(object):
+    """
+    The metrics of the circuits of one transport. See COUNTERS and
+    HISTOGRAMS for the attributes.
+
+    Attributes:
+    name: The transport's name, e.g. 'obfs3'.
+    open_circuits: Number of circuits which are currently open.
+    close_reasons: Maps why circuits were closed (see
+                   network.Circuit.close()) to how often.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.open_circuits = 0
+        self.reset()
+
+    def reset(self):
+        """Reset the counters and histograms, but not the gauges."""
+        for counter in COUNTERS:
+            setattr(self, counter, 0)
+        self.close_reasons = {}
+        for histogram in HISTOGRAMS:
+            setattr(self, histogram, Histogram())
+
+    def circuit_opened(self):
+        self.circuits_opened += 1
+        self.open_circuits += 1
+
+    def circuit_closed(self, reason):
+        self.circuits_closed += 1
+        self.open_circuits -= 1
+        self.close_reasons[reason] = self.close_reasons.get(reason, 0) + 1
+
+    def snapshot(self):
+        snapshot = dict((counter, getattr(self, counter)) for counter in COUNTERS)
+        snapshot['close_reasons'] = dict(self.close_reasons)
+        for histogram in HISTOGRAMS:
+            snapshot[histogram] = getattr(self, histogram).snapshot()
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add the counters and histograms of a 'snapshot' to ours."""
+        for counter in COUNTERS:
+            setattr(self, counter, getattr(self, counter) + snapshot[counter])
+        for reason, count in snapshot['close_reasons'].items():
+            self.close_reasons[reason] = self.close_reasons.get(reason, 0) + count
+        for histogram in HISTOGRAMS:
+            getattr(self, histogram).merge(snapshot[histogram])
+
+def get_transport_name(transport_class):
+    """
+    Return the name under which 'transport_class' is registered, or the
+    class name if it isn't registered.
+    """
+    # Not imported, since the transports import us. obfsproxy loads the
+    # transports at startup anyway.
+    transports = sys.modules.get('obfsproxy.transports.transports')
+
+    if transports is not None:
+        for name, classes in transports.transports.items():
+            if transport_class in classes.values():
+                return name
+    return transport_class.__name__
+
+class MetricsRegistry(object):
+    """
+    Holds the metrics of all transports.
+
+    Attributes:
+    connections: The open network.GenericProtocol connections, for the
+                 'buffered_bytes' gauge.
+    process_gauges: Maps the names of gauges which are not specific to
+                    a transport (see add_gauge()) to tuples of their
+                    description and the function computing them.
+    exporting: True if our metrics are exported, e.g. by the Prometheus
+               endpoint. Process gauges can be costly to compute, so
+               reports only include them then.
+    """
+
+    def __init__(self):
+        self.transports = {}
+        self.by_class = {}
+        self.connections = weakref.WeakSet()
+        self.process_gauges = {}
+        self.exporting = False
+
+        # Gauges reported by worker processes, by worker.
+        self.remote_gauges = {}
+        self.remote_process_gauges = {}
+
+    def get(self, name):
+        """Return the TransportMetrics of the transport called 'name'."""
+        metrics = self.transports.get(name)
+        if metrics is None:
+            metrics = self.transports[name] = TransportMetrics(name)
+        return metrics
+
+    def for_transport(self, transport):
+        """Return the TransportMetrics of the transport object 'transport'."""
+        transport_class = type(transport)
+        metrics = self.by_class.get(transport_class)
+        if metrics is None:
+            metrics = self.by_class[transport_class] = self.get(get_transport_name(transport_class))
+        return metrics
+
+    def register_connection(self, conn):
+        self.connections.add(conn)
+
+    def add_gauge(self, name, description, callback):
+        """
+        Add the process gauge 'name'. Snapshots call 'callback' to get
+        its value.
+        """
+        self.process_gauges[name] = (description, callback)
+
+    def get_process_gauges(self):
+        """Return the values of our process gauges, by name."""
+        return dict((name, callback())
+                    for name, (_, callback) in self.process_gauges.items())
+
+    def gauges(self):
+        """Return the gauges of this process, by transport name."""
+        gauges = dict((name, {'open_circuits': metrics.open_circuits, 'buffered_bytes': 0})
+                      for name, metrics in self.transports.items())
+
+        for conn in list(self.connections):
+            metrics = getattr(conn.circuit, 'metrics', None)
+            if metrics is not None:
+                gauges[metrics.name]['buffered_bytes'] += len(conn.buffer) + conn.pending_bytes
+
+        return gauges
+
+    def snapshot(self):
+        """
+        Return the metrics of all transports, including those reported
+        by worker processes, as a dict mapping transport names to dicts
+        of metrics. Besides the TransportMetrics counters and histograms,
+        these have the gauges 'open_circuits' and 'buffered_bytes'.
+        """
+        snapshot = dict((name, metrics.snapshot()) for name, metrics in self.transports.items())
+
+        for gauges in [self.gauges()] + self.remote_gauges.values():
+            for name, values in gauges.items():
+                if name not in snapshot:
+                    snapshot[name] = self.get(name).snapshot()
+                for gauge, value in values.items():
+                    snapshot[name][gauge] = snapshot[name].get(gauge, 0) + value
+
+        return snapshot
+
+    def get_report(self):
+        """
+        Return our metrics in a form that can be serialized, and reset
+        the counters and histograms. Used by worker processes to report
+        to their supervisor. Process gauges are only included while
+        'exporting' is set.
+        """
+        report = {'transports': dict((name, metrics.snapshot())
+                                     for name, metrics in self.transports.items()),
+                  'gauges': self.gauges()}
+        if self.exporting:
+            report['process_gauges'] = self.get_process_gauges()
+
+        for metrics in self.transports.values():
+            metrics.reset()
+
+        return report
+
+    def merge_report(self, report, source):
+        """
+        Add the metrics of worker process 'source' (see get_report()) to
+        ours.
+        """
+        for name, snapshot in report['transports'].items():
+            self.get(name).merge(snapshot)
+        self.remote_gauges[source] = report['gauges']
+        if 'process_gauges' in report:
+            self.remote_process_gauges[source] = report['process_gauges']
+
+    def forget(self, source):
+        """Drop the gauges of worker process 'source', which ended."""
+        self.remote_gauges.pop(source, None)
+        self.remote_process_gauges.pop(source, None)
+
+# A metrics registry singleton.
+registry = MetricsRegistry()
@@ -8,6 +8,11 @@ except ImportError:
             return x
         pass
 
+# Window size (in bits) of the fixed-base tables.  A table holds
+# 2^FIXED_BASE_WINDOW numbers for each FIXED_BASE_WINDOW-bit digit of
+# the exponent, i.e. roughly 2MB for a 1536-bit group.
+FIXED_BASE_WINDOW = 5
+
 def powMod( x, y, mod ):
     """
     (Efficiently) Calculate and return `x' to the power of `y' mod `mod'.
@@ -21,3 +26,73 @@ def powMod( x, y, mod ):
     y = mpz(y)
     mod = mpz(mod)
     return pow(x, y, mod)
+
+class FixedBaseTable( object ):
+    """
+    Precomputed powers of a fixed base `base' modulo `mod', for exponents
+    of up to `bits' bits.
+
+    Row i of the table holds base^(d * 2^(window * i)) for all window-bit
+    digits d.  Exponentiation then boils down to one modular
+    multiplication per digit of the exponent, instead of one squaring
+    per bit plus the multiplications done by pow().
+    """
+
+    def __init__( self, base, mod, bits, window=FIXED_BASE_WINDOW ):
+        self.mod = mpz(mod)
+        self.bits = bits
+        self.window = window
+        self.mask = (1 << window) - 1
+
+        self.rows = []
+        rowBase = mpz(base)
+        for _ in xrange((bits + window - 1) / window):
+            row = [mpz(1)]
+            for _ in xrange(self.mask):
+                row.append(row[-1] * rowBase % self.mod)
+            self.rows.append(row)
+            rowBase = row[-1] * rowBase % self.mod
+
+    def pow( self, exp ):
+        """
+        Return base to the power of `exp' mod `mod'.
+
+        Every digit costs a multiplication, even zero digits, so that the
+        number of operations does not depend on the exponent.
+        """
+
+        if (exp < 0) or (exp >> self.bits):
+            raise ValueError("Exponent out of range for this table.")
+
+        exp = int(exp)
+        mask = self.mask
+        window = self.window
+        mod = self.mod
+
+        result = mpz(1)
+        for row in self.rows:
+            result = result * row[exp & mask] % mod
+            exp >>= window
+
+        return result
+
+# Tables built so far, indexed by (base, mod).
+_fixedBaseTables = {}
+
+def powModFixedBase( base, exp, mod ):
+    """
+    Calculate and return `base' to the power of `exp' mod `mod', for a
+    `base' and `mod' that are used over and over again (like the
+    generator and modulus of a DH group).
+
+    The first call for a (base, mod) pair builds a FixedBaseTable, which
+    is then kept around for the lifetime of the process.  Exponents must
+    be non-negative and smaller than `mod'.
+    """
+
+    table = _fixedBaseTables.get((base, mod))
+    if table is None:
+        table = FixedBaseTable(base, mod, long(mod).bit_length())
+        _fixedBaseTables[(base, mod)] = table
+
+    return table.pow(exp)
@@ -0,0 +1,171 @@
+"""
+Serves obfsproxy's metrics over HTTP, in the Prometheus text exposition
+format.
+
+With '--metrics-listen ADDR:PORT', GET requests for '/metrics' return
+the heartbeat stats, the circuit metrics of 'metrics.registry' and its
+process gauges. The endpoint runs on the reactor of the obfsproxy
+process started by the user. With worker processes, that's the
+supervisor: it serves the metrics the workers report every
+workers.STATS_INTERVAL seconds.
+"""
+
+import datetime
+
+from twisted.internet import reactor
+from twisted.web import resource, server
+
+import obfsproxy.common.log as logging
+import obfsproxy.common.heartbeat as heartbeat
+import obfsproxy.common.metrics as metrics
+
+log = logging.get_obfslogger()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Prefix of the names of our metrics.
+PREFIX = "obfsproxy_"
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels):
+    """Format the (name, value) tuples of 'labels'."""
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape_label_value(value))
+                             for name, value in labels)
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Exposition(object):
+    """
+    Builds a document in the text exposition format, one metric family
+    at a time.
+    """
+
+    def __init__(self):
+        self.lines = []
+
+    def family(self, name, metric_type, description):
+        self.lines.append("# HELP %s%s %s" % (PREFIX, name, description))
+        self.lines.append("# TYPE %s%s %s" % (PREFIX, name, metric_type))
+
+    def sample(self, name, labels, value):
+        self.lines.append("%s%s%s %s" % (PREFIX, name, format_labels(labels),
+                                         format_value(value)))
+
+    def histogram(self, name, labels, snapshot):
+        """Add the samples of a metrics.Histogram 'snapshot'."""
+        cumulative = 0
+        bounds = list(snapshot['bounds']) + [float('inf')]
+        for bound, count in zip(bounds, snapshot['counts']):
+            cumulative += count
+            self.sample(name + "_bucket", labels + [('le', format_value(bound))], cumulative)
+        self.sample(name + "_sum", labels, snapshot['sum'])
+        self.sample(name + "_count", labels, snapshot['count'])
+
+    def render(self):
+        return "\n".join(self.lines) + "\n"
+
+def render_metrics():
+    """Return our current metrics in the text exposition format."""
+    out = Exposition()
+
+    hb = heartbeat.heartbeat
+    uptime = datetime.datetime.now() - hb.started
+    out.family("uptime_seconds", "gauge", "Seconds since obfsproxy started.")
+    out.sample("uptime_seconds", [], uptime.days * 86400 + uptime.seconds)
+    out.family("heartbeat_connections", "gauge",
+               "Connections since the heartbeat stats were last reset.")
+    out.sample("heartbeat_connections", [], hb.n_connections)
+    out.family("heartbeat_unique_addresses", "gauge",
+               "Unique client addresses since the heartbeat stats were last reset.")
+    out.sample("heartbeat_unique_addresses", [], len(hb.unique_ips))
+
+    snapshot = sorted(metrics.registry.snapshot().items())
+
+    out.family("circuits_open", "gauge", "Circuits which are currently open.")
+    for name, values in snapshot:
+        out.sample("circuits_open", [('transport', name)], values['open_circuits'])
+
+    out.family("circuits_opened_total", "counter", "Circuits which were opened.")
+    for name, values in snapshot:
+        out.sample("circuits_opened_total", [('transport', name)], values['circuits_opened'])
+
+    out.family("circuits_closed_total", "counter",
+               "Circuits which were closed, by reason. 'transport_error' means "
+               "that the transport rejected the data it got, e.g. a handshake.")
+    for name, values in snapshot:
+        for reason, count in sorted(values['close_reasons'].items()):
+            out.sample("circuits_closed_total", [('transport', name), ('reason', reason)], count)
+
+    out.family("bytes_total", "counter", "Bytes which went through circuits.")
+    for name, values in snapshot:
+        for side in ('downstream', 'upstream'):
+            for direction in ('in', 'out'):
+                out.sample("bytes_total",
+                           [('transport', name), ('side', side), ('direction', direction)],
+                           values['%s_bytes_%s' % (side, direction)])
+
+    out.family("buffered_bytes", "gauge",
+               "Bytes which wait in the buffers of open connections.")
+    for name, values in snapshot:
+        out.sample("buffered_bytes", [('transport', name)], values['buffered_bytes'])
+
+    for histogram, description in (
+            ('handshake_seconds', "Seconds from the completion of a circuit until "
+                                  "its transport finished the handshake."),
+            ('first_byte_seconds', "Seconds from the creation of a circuit until "
+                                   "its first byte arrives from downstream.")):
+        out.family(histogram, "histogram", description)
+        for name, values in snapshot:
+            out.histogram(histogram, [('transport', name)], values[histogram])
+
+    # Process gauges are per process, so the ones of worker processes
+    # carry a label.
+    registry = metrics.registry
+    local = registry.get_process_gauges()
+    for gauge, (description, _) in sorted(registry.process_gauges.items()):
+        out.family(gauge, "gauge", description)
+        out.sample(gauge, [], local[gauge])
+        for worker, gauges in sorted(registry.remote_process_gauges.items()):
+            if gauge in gauges:
+                out.sample(gauge, [('worker', worker)], gauges[gauge])
+
+    return out.render()
+
+class MetricsResource(resource.Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", CONTENT_TYPE)
+        return render_metrics()
+
+class MetricsSite(server.Site):
+    noisy = False
+
+    def log(self, request):
+        pass # Access logs would reveal the addresses of our scrapers.
+
+def listen(addrport):
+    """
+    Serve our metrics at 'addrport', a (host, port) tuple. Return the
+    listening port.
+
+    Throws twisted.internet.error.CannotListenError if we can't bind.
+    """
+    root = resource.Resource()
+    root.putChild("metrics", MetricsResource())
+
+    host, port = addrport
+    listening_port = reactor.listenTCP(port, MetricsSite(root), interface=host)
+    metrics.registry.exporting = True
+
+    log.info("Serving metrics at 'http://%s:%s/metrics'.",
+             log.safe_addr_str(host), listening_port.getHost().port)
+
+    return listening_port
@@ -75,7 +75,7 @@ def do_managed_client():
             continue
 
         should_start_event_loop = True
-        log.debug("Successfully launched '%s' at '%s'" % (transport, log.safe_addr_str(str(addrport))))
+        log.debug("Successfully launched '%s' at '%s'", transport, log.safe_addr_str(str(addrport)))
         ptclient.reportMethodSuccess(transport, "socks5", addrport, None, None)
 
     ptclient.reportMethodsEnd()
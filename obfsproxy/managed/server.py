@@ -90,7 +90,7 @@ def do_managed_server():
         extra_log = "" # Include server transport options in the log message if we got 'em
         if transport_options:
             extra_log = " (server transport options: '%s')" % str(transport_options)
-        log.debug("Successfully launched '%s' at '%s'%s" % (transport, log.safe_addr_str(str(addrport)), extra_log))
+        log.debug("Successfully launched '%s' at '%s'%s", transport, log.safe_addr_str(str(addrport)), extra_log)
 
         # Invoke the transport-specific get_public_server_options()
         # method to potentially filter the server transport options
@@ -105,7 +105,7 @@ def do_managed_server():
                 optlist.append("%s=%s" % (k,v))
             public_options_str = ",".join(optlist)
 
-            log.debug("do_managed_server: sending only public_options to tor: %s" % public_options_str)
+            log.debug("do_managed_server: sending only public_options to tor: %s", public_options_str)
 
         # Report success for this transport.
         # If public_options_str is None then all of the
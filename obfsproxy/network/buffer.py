@@ -1,14 +1,25 @@
+import collections
+
 class Buffer(object):
     """
     A Buffer is a simple FIFO buffer. You write() stuff to it, and you
     read() them back. You can also peek() or drain() data.
+
+    Internally, the buffer is a deque of the chunks that were written
+    to it. Writing appends a chunk, and reading or draining advances
+    an offset into the first chunk. This way, no data is copied
+    around unless it's actually handed out to the caller.
     """
 
     def __init__(self, data=''):
         """
         Initialize a buffer with 'data'.
         """
-        self.buffer = bytes(data)
+        self.chunks = collections.deque()
+        self.offset = 0 # read offset into the first chunk
+        self.length = 0 # total number of buffered bytes
+
+        self.write(data)
 
     def read(self, n=-1):
         """
@@ -18,21 +29,44 @@ class Buffer(object):
         If 'n' is larger than the size of the buffer, read and return
         the whole buffer.
         """
+        if (n < 0) or (n >= self.length):
+            return self._read_all()
 
-        if (n < 0) or (n > len(self.buffer)):
-            the_whole_buffer = self.buffer
-            self.buffer = bytes('')
-            return the_whole_buffer
+        head = self.chunks[0]
+        start = self.offset
+        if len(head) - start > n:
+            # Fast path: the first chunk has more than we need.
+            self.offset = start + n
+            self.length -= n
+            return head[start:start + n]
 
-        data = self.buffer[:n]
-        self.buffer = self.buffer[n:]
-        return data
+        # Collect whole chunks until we have enough, and join them once.
+        self.length -= n
+        pieces = []
+        while n > 0:
+            head = self.chunks[0]
+            left_in_head = len(head) - self.offset
+            if n < left_in_head:
+                pieces.append(head[self.offset:self.offset + n])
+                self.offset += n
+                break
+
+            pieces.append(head[self.offset:] if self.offset else head)
+            self.chunks.popleft()
+            self.offset = 0
+            n -= left_in_head
+
+        return ''.join(pieces)
 
     def write(self, data):
         """
         Append 'data' to the buffer.
         """
-        self.buffer = self.buffer + data
+        if not data:
+            return
+
+        self.chunks.append(data)
+        self.length += len(data)
 
     def peek(self, n=-1):
         """
@@ -42,11 +76,37 @@ class Buffer(object):
         If 'n' is larger than the size of the buffer, return the whole
         buffer.
         """
+        if (n < 0) or (n > self.length):
+            n = self.length
+
+        if n == 0:
+            return ''
+
+        self._coalesce(n)
+
+        head = self.chunks[0]
+        if (self.offset == 0) and (n == len(head)):
+            return head # no need to copy anything
+
+        return head[self.offset:self.offset + n]
+
+    def peek_view(self, n=-1):
+        """
+        Like peek(), but return a read-only buffer object pointing
+        into our own storage instead of a copy of the data.
+
+        The returned view is only valid until the next call that
+        modifies the buffer.
+        """
+        if (n < 0) or (n > self.length):
+            n = self.length
 
-        if (n < 0) or (n > len(self.buffer)):
-            return self.buffer
+        if n == 0:
+            return buffer('')
 
-        return self.buffer[:n]
+        self._coalesce(n)
+
+        return buffer(self.chunks[0], self.offset, n)
 
     def drain(self, n=-1):
         """
@@ -56,20 +116,70 @@ class Buffer(object):
         If 'n' is larger than the size of the buffer, drain the whole
         buffer.
         """
-        if (n < 0) or (n > len(self.buffer)):
-            self.buffer = bytes('')
+        if (n < 0) or (n >= self.length):
+            self.chunks.clear()
+            self.offset = 0
+            self.length = 0
             return
 
-        self.buffer = self.buffer[n:]
+        self.length -= n
+
+        while n > 0:
+            left_in_head = len(self.chunks[0]) - self.offset
+            if n < left_in_head:
+                self.offset += n
+                return
+
+            # The whole first chunk was drained; get rid of it.
+            n -= left_in_head
+            self.chunks.popleft()
+            self.offset = 0
+
         return
 
+    def _read_all(self):
+        """
+        Read and return the whole buffer.
+        """
+        if not self.chunks:
+            return ''
+
+        if self.offset:
+            self.chunks[0] = self.chunks[0][self.offset:]
+
+        data = self.chunks[0] if len(self.chunks) == 1 else ''.join(self.chunks)
+
+        self.chunks.clear()
+        self.offset = 0
+        self.length = 0
+        return data
+
+    def _coalesce(self, n):
+        """
+        Make sure that the first 'n' bytes of the buffer live in the
+        first chunk, so that they can be handed out with a single
+        slice. Requires 0 < 'n' <= len(self).
+        """
+        if len(self.chunks[0]) - self.offset >= n:
+            return # already contiguous
+
+        pieces = [self.chunks.popleft()[self.offset:]]
+        have = len(pieces[0])
+        while have < n:
+            chunk = self.chunks.popleft()
+            pieces.append(chunk)
+            have += len(chunk)
+
+        self.chunks.appendleft(''.join(pieces))
+        self.offset = 0
+
     def __len__(self):
         """Returns length of buffer. Used in len()."""
-        return len(self.buffer)
+        return self.length
 
     def __nonzero__(self):
         """
         Returns True if the buffer is non-empty.
         Used in truth-value testing.
         """
-        return True if len(self.buffer) else False
+        return self.length > 0
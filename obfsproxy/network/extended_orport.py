@@ -125,6 +125,7 @@ class ExtORPortProtocol(network.GenericProtocol):
             log.debug("%s: ExtORPort dataReceived called while closed. Ignoring.", self.name)
             return
 
+        self.circuit.bytes_received(self, len(data_rcvd))
         self.buffer.write(data_rcvd)
 
         if self.state == STATE_WAIT_FOR_AUTH_TYPES:
@@ -218,7 +219,7 @@ class ExtORPortProtocol(network.GenericProtocol):
 
         data = self.buffer.peek()
         if '\x00' not in data: # haven't received EndAuthTypes yet
-            log.debug("%s: Got some auth types data but no EndAuthTypes yet." % self.name)
+            log.debug("%s: Got some auth types data but no EndAuthTypes yet.", self.name)
             raise NeedMoreData('Not EndAuthTypes.')
 
         # Drain all data up to (and including) the EndAuthTypes.
@@ -281,7 +282,7 @@ class ExtORPortProtocol(network.GenericProtocol):
         if result != '\x01':
             raise AuthFailed("%s: Authentication failed (%s)!" % (self.name, repr(result)))
 
-        log.debug("%s: Authentication successful!" % self.name)
+        log.debug("%s: Authentication successful!", self.name)
 
     def _handle_okay(self):
         """
@@ -367,10 +368,10 @@ class ExtORPortServerFactory(network.StaticDestinationClientFactory):
         self.name = "fact_ext_s_%s" % hex(id(self))
 
     def startFactory(self):
-        log.debug("%s: Starting up Extended ORPort server factory." % self.name)
+        log.debug("%s: Starting up Extended ORPort server factory.", self.name)
 
     def buildProtocol(self, addr):
-        log.debug("%s: New connection from %s:%d." % (self.name, log.safe_addr_str(addr.host), addr.port))
+        log.debug("%s: New connection from %s:%d.", self.name, log.safe_addr_str(addr.host), addr.port)
 
         circuit = network.Circuit(self.transport_class())
 
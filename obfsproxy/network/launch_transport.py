@@ -2,6 +2,7 @@ import obfsproxy.network.network as network
 import obfsproxy.transports.transports as transports
 import obfsproxy.network.socks as socks
 import obfsproxy.network.extended_orport as extended_orport
+import obfsproxy.network.workers as workers
 
 from twisted.internet import reactor
 
@@ -30,19 +31,39 @@ def launch_transport_listener(transport, bindaddr, role, remote_addrport, pt_con
     could not be set up.
     """
 
-    transport_class = transports.get_transport_class(transport, role)
     listen_host = bindaddr[0] if bindaddr else 'localhost'
     listen_port = int(bindaddr[1]) if bindaddr else 0
 
+    # With worker processes, we only bind the listening socket here. The
+    # workers accept the connections.
+    if workers.supervisor.enabled and role != 'socks':
+        transports.get_transport_class(transport, role) # check that it exists
+        return workers.supervisor.add_listener(listen_host, listen_port, transport, role,
+                                               remote_addrport, pt_config, ext_or_cookie_file)
+
+    factory = build_listener_factory(transport, role, remote_addrport, pt_config, ext_or_cookie_file)
+
+    addrport = reactor.listenTCP(listen_port, factory, interface=listen_host)
+
+    return (addrport.getHost().host, addrport.getHost().port)
+
+def build_listener_factory(transport, role, remote_addrport, pt_config, ext_or_cookie_file=None):
+    """
+    Return the factory that handles the connections of a 'transport'
+    listener in role 'role'. See launch_transport_listener() for the
+    arguments.
+
+    Throws obfsproxy.transports.transports.TransportNotFound if the
+    transport could not be found.
+    """
+
+    transport_class = transports.get_transport_class(transport, role)
+
     if role == 'socks':
-        factory = socks.OBFSSOCKSv5Factory(transport_class, pt_config)
+        return socks.OBFSSOCKSv5Factory(transport_class, pt_config)
     elif role == 'ext_server':
         assert(remote_addrport and ext_or_cookie_file)
-        factory = extended_orport.ExtORPortServerFactory(remote_addrport, ext_or_cookie_file, transport, transport_class, pt_config)
+        return extended_orport.ExtORPortServerFactory(remote_addrport, ext_or_cookie_file, transport, transport_class, pt_config)
     else:
         assert(remote_addrport)
-        factory = network.StaticDestinationServerFactory(remote_addrport, role, transport_class, pt_config)
-
-    addrport = reactor.listenTCP(listen_port, factory, interface=listen_host)
-
-    return (addrport.getHost().host, addrport.getHost().port)
+        return network.StaticDestinationServerFactory(remote_addrport, role, transport_class, pt_config)
@@ -1,14 +1,55 @@
-from twisted.internet import reactor
+import time
+
+from twisted.internet import interfaces, reactor
 from twisted.internet.protocol import Protocol, Factory
+from zope.interface import implementer
 
 import obfsproxy.common.log as logging
 import obfsproxy.common.heartbeat as heartbeat
+import obfsproxy.common.metrics as metrics
 
 import obfsproxy.network.buffer as obfs_buf
 import obfsproxy.transports.base as base
 
 log = logging.get_obfslogger()
 
+# Writes to a connection are gathered for this many seconds and then handed
+# to the socket at once. 0 gathers the writes of one reactor turn and None
+# disables write coalescing. See set_write_coalescing().
+write_coalescing_delay = 0
+
+# Coalesced writes are flushed right away once they reach this many bytes.
+WRITE_COALESCING_MAX_BYTES = 65536
+
+# We stop reading from one side of a circuit while the transport of the
+# other side buffers more than FLOW_CONTROL_HIGH_WATER bytes, and read
+# again once it buffers fewer than FLOW_CONTROL_LOW_WATER bytes. See
+# CircuitProducer.
+FLOW_CONTROL_HIGH_WATER = 65536
+FLOW_CONTROL_LOW_WATER = 16384
+
+# While reading is paused, the other side's buffer is checked this often
+# (in seconds) for having drained below FLOW_CONTROL_LOW_WATER.
+FLOW_CONTROL_CHECK_INTERVAL = 0.01
+
+def set_write_coalescing(microseconds):
+    """
+    Gather the writes to a connection for 'microseconds' before sending
+    them. 0 gathers the writes of one reactor turn and None sends every
+    write right away.
+
+    Raises ValueError if 'microseconds' is negative.
+    """
+    global write_coalescing_delay
+
+    if microseconds is None:
+        write_coalescing_delay = None
+        return
+    if microseconds < 0:
+        raise ValueError("The write coalescing delay can't be negative (%d)." % microseconds)
+
+    write_coalescing_delay = microseconds / 1000000.0
+
 """
 Networking subsystem:
 
@@ -73,6 +114,7 @@ class Circuit(Protocol):
 
     downstream: the downstream connection
     upstream: the upstream connection
+    metrics: the metrics.TransportMetrics of our transport
     """
 
     def __init__(self, transport):
@@ -84,12 +126,21 @@ class Circuit(Protocol):
 
         self.name = "circ_%s" % hex(id(self))
 
+        self.metrics = metrics.registry.for_transport(transport)
+        self.metrics.circuit_opened()
+
+        # For the handshake and time-to-first-byte metrics.
+        self.created = time.time()
+        self.completed = None
+        self.got_first_byte = False
+        self.handshake_done = False
+
     def setDownstreamConnection(self, conn):
         """
         Set the downstream connection of a circuit.
         """
 
-        log.debug("%s: Setting downstream connection (%s)." % (self.name, conn.name))
+        log.debug("%s: Setting downstream connection (%s).", self.name, conn.name)
         assert(not self.downstream)
         self.downstream = conn
 
@@ -101,7 +152,7 @@ class Circuit(Protocol):
         Set the upstream connection of a circuit.
         """
 
-        log.debug("%s: Setting upstream connection (%s)." % (self.name, conn.name))
+        log.debug("%s: Setting upstream connection (%s).", self.name, conn.name)
         assert(not self.upstream)
         self.upstream = conn
 
@@ -124,11 +175,16 @@ class Circuit(Protocol):
             log.debug("%s: Completed circuit while closed. Ignoring.", self.name)
             return
 
-        log.debug("%s: Circuit completed." % self.name)
+        log.debug("%s: Circuit completed.", self.name)
+
+        self.completed = time.time()
 
         # Set us as the circuit of our pluggable transport instance.
         self.transport.circuit = self
 
+        # Don't read from one side faster than the other side can write.
+        self.register_producers()
+
         # Call the transport-specific circuitConnected method since
         # this is a good time to perform a handshake.
         self.transport.circuitConnected()
@@ -141,6 +197,18 @@ class Circuit(Protocol):
         # to the network immediately.)
         reactor.callLater(0.01, conn_to_flush.dataReceived, '')
 
+    def register_producers(self):
+        """
+        Register a CircuitProducer on the transport of each of our
+        connections, which pauses reading from the other connection while
+        the transport's outgoing buffer is full.
+        """
+        for writer, reader in ((self.downstream, self.upstream),
+                               (self.upstream, self.downstream)):
+            writer.producer = CircuitProducer(self, writer, reader)
+            writer.transport.bufferSize = FLOW_CONTROL_HIGH_WATER
+            writer.transport.registerProducer(writer.producer, True)
+
     def dataReceived(self, data, conn):
         """
         We received 'data' on 'conn'. Pass the data to our transport,
@@ -157,28 +225,69 @@ class Circuit(Protocol):
 
         try:
             if conn is self.downstream:
-                log.debug("%s: downstream: Received %d bytes." % (self.name, len(data)))
+                log.debug("%s: downstream: Received %d bytes.", self.name, len(data))
                 self.transport.receivedDownstream(data)
             else:
-                log.debug("%s: upstream: Received %d bytes." % (self.name, len(data)))
+                log.debug("%s: upstream: Received %d bytes.", self.name, len(data))
                 self.transport.receivedUpstream(data)
         except base.PluggableTransportError, err: # Our transport didn't like that data.
-            log.info("%s: %s: Closing circuit." % (self.name, str(err)))
-            self.close()
+            log.info("%s: %s: Closing circuit.", self.name, str(err))
+            self.close(err)
+
+    def bytes_received(self, conn, nbytes):
+        """
+        Account for 'nbytes' bytes which 'conn' received from the network.
+        """
+        if conn is self.downstream:
+            self.metrics.downstream_bytes_in += nbytes
+            if not self.got_first_byte:
+                self.got_first_byte = True
+                self.metrics.first_byte_seconds.observe(time.time() - self.created)
+        else:
+            self.metrics.upstream_bytes_in += nbytes
+
+    def bytes_sent(self, conn, nbytes):
+        """
+        Account for 'nbytes' bytes which were written to 'conn'.
+        """
+        if conn is self.downstream:
+            self.metrics.downstream_bytes_out += nbytes
+        else:
+            self.metrics.upstream_bytes_out += nbytes
+
+    def handshake_finished(self):
+        """
+        Our transport finished its handshake. The time since the circuit
+        was completed is observed in the 'handshake_seconds' metric, once.
+        """
+        if self.handshake_done or (self.completed is None):
+            return
+
+        self.handshake_done = True
+        self.metrics.handshake_seconds.observe(time.time() - self.completed)
 
     def close(self, reason=None, side=None):
         """
         Tear down the circuit. The reason for the torn down circuit is given in
         'reason' and 'side' tells us where it happened: either upstream or
         downstream.
+
+        The 'close_reasons' metric counts circuits closed because of a
+        transport error, by their 'side', and otherwise as closed by the
+        transport itself.
         """
         if self.closed:
             return # NOP if already closed
 
-        log.debug("%s: Tearing down circuit." % self.name)
+        log.debug("%s: Tearing down circuit.", self.name)
 
         self.closed = True
 
+        if isinstance(reason, base.PluggableTransportError):
+            self.metrics.circuit_closed('transport_error')
+        else:
+            self.metrics.circuit_closed(side or 'transport')
+
         if self.downstream:
             self.downstream.close()
         if self.upstream:
@@ -186,6 +295,84 @@ class Circuit(Protocol):
 
         self.transport.circuitDestroyed(reason, side)
 
+@implementer(interfaces.IPushProducer)
+class CircuitProducer(object):
+    """
+    Flow control between the two connections of a circuit.
+
+    It's registered as the producer of the transport of the 'writer'
+    connection, whose data comes from the 'reader' connection. The
+    transport pauses us when its outgoing buffer exceeds
+    FLOW_CONTROL_HIGH_WATER bytes. Meanwhile, we don't read from 'reader',
+    which leaves its data in the kernel and eventually makes its peer stop
+    sending.
+
+    Twisted only resumes us once the buffer is empty, which would leave the
+    connection idle until 'reader' delivers again. So while paused, we check
+    the buffer every FLOW_CONTROL_CHECK_INTERVAL seconds and resume as soon
+    as it holds fewer than FLOW_CONTROL_LOW_WATER bytes.
+    """
+
+    def __init__(self, circuit, writer, reader):
+        self.circuit = circuit
+        self.writer = writer
+        self.reader = reader
+        self.check = None
+
+    def pauseProducing(self):
+        if self.reader.closed:
+            return
+
+        log.debug("%s: Pausing %s, the other side can't keep up.",
+                  self.circuit.name, self.reader.name)
+        self.reader.transport.pauseProducing()
+
+        if self.check is None:
+            self.check = reactor.callLater(FLOW_CONTROL_CHECK_INTERVAL,
+                                           self.check_low_water)
+
+    def check_low_water(self):
+        """
+        Resume reading if the writer's buffer drained below
+        FLOW_CONTROL_LOW_WATER bytes, and otherwise check again later.
+        """
+        self.check = None
+
+        transport = self.writer.transport
+        if buffered_bytes(transport) >= FLOW_CONTROL_LOW_WATER:
+            self.check = reactor.callLater(FLOW_CONTROL_CHECK_INTERVAL,
+                                           self.check_low_water)
+            return
+
+        # Let the transport pause us again once its buffer fills up.
+        transport.producerPaused = False
+        self.resumeProducing()
+
+    def resumeProducing(self):
+        self.stop_checking()
+
+        if self.reader.closed:
+            return
+
+        log.debug("%s: Resuming %s.", self.circuit.name, self.reader.name)
+        self.reader.transport.resumeProducing()
+
+    def stopProducing(self):
+        # The circuit closes 'reader' when our connection goes away.
+        self.stop_checking()
+
+    def stop_checking(self):
+        if self.check is not None:
+            self.check.cancel()
+            self.check = None
+
+def buffered_bytes(transport):
+    """
+    Return the number of bytes that 'transport' buffers because they didn't
+    fit into the kernel yet.
+    """
+    return len(transport.dataBuffer) - transport.offset + transport._tempDataLen
+
 class GenericProtocol(Protocol, object):
     """
     Generic obfsproxy connection. Contains useful methods and attributes.
@@ -196,31 +383,105 @@ class GenericProtocol(Protocol, object):
             away. This can happen because the circuit is not yet
             complete, or because the pluggable transport needs more
             data before deciding what to do.
+    pending_writes: Writes gathered to be sent to the network at once.
+                    See write_coalescing_delay.
+    producer: The CircuitProducer registered on our transport, if any.
     """
     def __init__(self, circuit):
         self.circuit = circuit
         self.buffer = obfs_buf.Buffer()
         self.closed = False # True if connection is closed.
 
+        self.pending_writes = []
+        self.pending_bytes = 0
+        self.flush_callbacks = []
+        self.flush_call = None # The scheduled flush_writes() call.
+        self.producer = None
+
+        metrics.registry.register_connection(self)
+
     def connectionLost(self, reason):
-        log.debug("%s: Connection was lost (%s)." % (self.name, reason.getErrorMessage()))
+        log.debug("%s: Connection was lost (%s).", self.name, reason.getErrorMessage())
         self.close()
 
     def connectionFailed(self, reason):
-        log.debug("%s: Connection failed to connect (%s)." % (self.name, reason.getErrorMessage()))
+        log.debug("%s: Connection failed to connect (%s).", self.name, reason.getErrorMessage())
         self.close()
 
     def write(self, buf):
         """
         Write 'buf' to the underlying transport.
+
+        Unless write coalescing is disabled, 'buf' is only queued. All
+        writes queued within write_coalescing_delay are handed to the
+        transport in a single writeSequence() call.
         """
         if self.closed:
             log.debug("%s: Calling write() while connection is closed. Ignoring.", self.name)
             return
 
-        log.debug("%s: Writing %d bytes." % (self.name, len(buf)))
+        log.debug("%s: Writing %d bytes.", self.name, len(buf))
+
+        self.circuit.bytes_sent(self, len(buf))
+
+        if write_coalescing_delay is None:
+            self.transport.write(buf)
+            return
+
+        self.pending_writes.append(buf)
+        self.pending_bytes += len(buf)
+
+        if self.pending_bytes >= WRITE_COALESCING_MAX_BYTES:
+            self.flush_writes()
+        else:
+            self._schedule_flush()
+
+    def call_before_flush(self, callback):
+        """
+        Call 'callback' right before the queued writes are sent. It may
+        still write to this connection, e.g., to pad the whole burst of
+        writes. Without write coalescing, 'callback' is called right away.
+        """
+        if write_coalescing_delay is None:
+            callback()
+            return
+
+        self.flush_callbacks.append(callback)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self.flush_call is None:
+            self.flush_call = reactor.callLater(write_coalescing_delay, self.flush_writes)
+
+    def flush_writes(self):
+        """
+        Send all queued writes to the network.
+        """
+        if (self.flush_call is not None) and self.flush_call.active():
+            self.flush_call.cancel()
+        self.flush_call = None
+
+        while self.flush_callbacks:
+            callbacks, self.flush_callbacks = self.flush_callbacks, []
+            for callback in callbacks:
+                callback()
+
+        if not self.pending_writes:
+            return
+
+        writes = self.pending_writes
+        self.pending_writes = []
+        self.pending_bytes = 0
+
+        if self.closed:
+            return
 
-        self.transport.write(buf)
+        log.debug("%s: Flushing %d coalesced writes.", self.name, len(writes))
+
+        if len(writes) == 1:
+            self.transport.write(writes[0])
+        else:
+            self.transport.writeSequence(writes)
 
     def close(self, also_close_circuit=True):
         """
@@ -229,13 +490,27 @@ class GenericProtocol(Protocol, object):
         if self.closed:
             return # NOP if already closed
 
-        log.debug("%s: Closing connection." % self.name)
+        # Send what we still have before the connection goes away.
+        self.flush_writes()
+
+        log.debug("%s: Closing connection.", self.name)
 
         self.closed = True
 
+        # Twisted doesn't close a connection whose producer is paused:
+        # once the buffer drains, it resumes the producer instead.
+        if self.producer is not None:
+            self.producer.stopProducing()
+            self.transport.unregisterProducer()
+            self.producer = None
+
         self.transport.loseConnection()
         if also_close_circuit:
-            self.circuit.close()
+            self.circuit.close(side=self.side())
+
+    def side(self):
+        """Return 'downstream' or 'upstream', our side of the circuit."""
+        return 'downstream' if self is self.circuit.downstream else 'upstream'
 
 
 class StaticDestinationProtocol(GenericProtocol):
@@ -271,17 +546,17 @@ class StaticDestinationProtocol(GenericProtocol):
         # Find the connection's direction and register it in the circuit.
         if self.mode == 'client' and not self.circuit.upstream:
             log.debug("%s: connectionMade (client): " \
-                      "Setting it as upstream on our circuit." % self.name)
+                      "Setting it as upstream on our circuit.", self.name)
 
             self.circuit.setUpstreamConnection(self)
         elif self.mode == 'client':
             log.debug("%s: connectionMade (client): " \
-                      "Setting it as downstream on our circuit." % self.name)
+                      "Setting it as downstream on our circuit.", self.name)
 
             self.circuit.setDownstreamConnection(self)
         elif self.mode == 'server' and not self.circuit.downstream:
             log.debug("%s: connectionMade (server): " \
-                      "Setting it as downstream on our circuit." % self.name)
+                      "Setting it as downstream on our circuit.", self.name)
 
             # Gather some statistics for our heartbeat.
             heartbeat.heartbeat.register_connection(self.peer_addr.host)
@@ -289,7 +564,7 @@ class StaticDestinationProtocol(GenericProtocol):
             self.circuit.setDownstreamConnection(self)
         elif self.mode == 'server':
             log.debug("%s: connectionMade (server): " \
-                      "Setting it as upstream on our circuit." % self.name)
+                      "Setting it as upstream on our circuit.", self.name)
 
             self.circuit.setUpstreamConnection(self)
 
@@ -309,12 +584,14 @@ class StaticDestinationProtocol(GenericProtocol):
             log.debug("%s: dataReceived called without a reason.", self.name)
             return
 
+        self.circuit.bytes_received(self, len(data))
+
         # Add the received data to the buffer.
         self.buffer.write(data)
 
         # Circuit is not fully connected yet, nothing to do here.
         if not self.circuit.circuitIsReady():
-            log.debug("%s: Incomplete circuit; cached %d bytes." % (self.name, len(data)))
+            log.debug("%s: Incomplete circuit; cached %d bytes.", self.name, len(data))
             return
 
         self.circuit.dataReceived(self.buffer, self)
@@ -335,14 +612,15 @@ class StaticDestinationClientFactory(Factory):
         return StaticDestinationProtocol(self.circuit, self.mode, addr)
 
     def startedConnecting(self, connector):
-        log.debug("%s: Client factory started connecting." % self.name)
+        log.debug("%s: Client factory started connecting.", self.name)
 
     def clientConnectionLost(self, connector, reason):
         pass # connectionLost event is handled on the Protocol.
 
     def clientConnectionFailed(self, connector, reason):
-        log.debug("%s: Connection failed (%s)." % (self.name, reason.getErrorMessage()))
-        self.circuit.close()
+        log.debug("%s: Connection failed (%s).", self.name, reason.getErrorMessage())
+        # Clients connect to the bridge, servers to the upstream destination.
+        self.circuit.close(side='downstream' if self.mode == 'client' else 'upstream')
 
 class StaticDestinationServerFactory(Factory):
     """
@@ -372,10 +650,10 @@ class StaticDestinationServerFactory(Factory):
         assert(self.mode == 'client' or self.mode == 'server')
 
     def startFactory(self):
-        log.debug("%s: Starting up static destination server factory." % self.name)
+        log.debug("%s: Starting up static destination server factory.", self.name)
 
     def buildProtocol(self, addr):
-        log.debug("%s: New connection from %s:%d." % (self.name, log.safe_addr_str(addr.host), addr.port))
+        log.debug("%s: New connection from %s:%d.", self.name, log.safe_addr_str(addr.host), addr.port)
 
         circuit = Circuit(self.transport_class())
 
@@ -58,10 +58,21 @@ class OBFSSOCKSv5Outgoing(socks5.SOCKSv5Outgoing, network.GenericProtocol):
         # reply back set self.socks.otherConn here.
         super(OBFSSOCKSv5Outgoing, self).connectionMade()
 
+    def connectionLost(self, reason):
+        # Hand what we still have for the SOCKS client to its transport
+        # before the SOCKS connection is closed.
+        self.socks.flush_writes()
+        super(OBFSSOCKSv5Outgoing, self).connectionLost(reason)
+
+    def write(self, data):
+        # Don't bypass write coalescing like socks5.SOCKSv5Outgoing would.
+        network.GenericProtocol.write(self, data)
+
     def dataReceived(self, data):
-        log.debug("%s: Recived %d bytes." % (self.name, len(data)))
+        log.debug("%s: Recived %d bytes.", self.name, len(data))
 
         assert self.circuit.circuitIsReady()
+        self.circuit.bytes_received(self, len(data))
         self.buffer.write(data)
         self.circuit.dataReceived(self.buffer, self)
 
@@ -103,6 +114,7 @@ class OBFSSOCKSv5Protocol(socks5.SOCKSv5Protocol, network.GenericProtocol):
 
     def processEstablishedData(self, data):
         assert self.circuit.circuitIsReady()
+        self.circuit.bytes_received(self, len(data))
         self.buffer.write(data)
         self.circuit.dataReceived(self.buffer, self)
 
@@ -174,10 +186,10 @@ class OBFSSOCKSv5Factory(protocol.Factory):
         self.name = "socks_fact_%s" % hex(id(self))
 
     def startFactory(self):
-        log.debug("%s: Starting up SOCKS server factory." % self.name)
+        log.debug("%s: Starting up SOCKS server factory.", self.name)
 
     def buildProtocol(self, addr):
-        log.debug("%s: New connection." % self.name)
+        log.debug("%s: New connection.", self.name)
 
         circuit = network.Circuit(self.transport_class())
 
@@ -0,0 +1,365 @@
+"""
+Multi-process listener sharding.
+
+With '--workers N', the obfsproxy process started by the user (or by
+Tor) becomes a supervisor. It binds the listening sockets itself but
+never accepts connections on them. Instead, it spawns N worker
+processes that inherit the listening sockets, adopt them into their
+own reactors and run the transports. The kernel spreads incoming
+connections over the workers.
+
+The supervisor talks to each worker over two pipes:
+
+- The worker's stdin carries the worker's configuration (a
+  length-prefixed pickle). It stays open afterwards: a worker exits
+  when it is closed, because the supervisor is shutting down or died.
+- STATS_FD carries the heartbeat stats and circuit metrics of the
+  worker, one JSON object per line. The supervisor merges them into its
+  own heartbeat and metrics registry.
+
+Workers that exit are restarted.
+"""
+
+import argparse
+import cPickle
+import json
+import os
+import signal
+import socket
+import struct
+import sys
+
+from twisted.internet import reactor, error, protocol, task
+
+import obfsproxy.common.log as logging
+import obfsproxy.common.heartbeat as heartbeat
+import obfsproxy.common.metrics as metrics
+
+log = logging.get_obfslogger()
+
+# File descriptor on which a worker reports its stats.
+STATS_FD = 3
+# File descriptor of the first listening socket in a worker.
+FIRST_LISTENER_FD = 4
+
+# How often a worker reports its stats to the supervisor (in seconds).
+STATS_INTERVAL = 60.0
+# How long to wait before restarting a worker that exited (in seconds).
+RESPAWN_DELAY = 1.0
+
+# Backlog of the listening sockets. Same as Twisted's default.
+LISTEN_BACKLOG = 50
+
+# The directory our obfsproxy package lives in. Computed at import time,
+# since __file__ may be relative to the current directory.
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKER_BOOTSTRAP = "from obfsproxy.network.workers import run_worker; run_worker()"
+
+class WorkerProcessProtocol(protocol.ProcessProtocol):
+    """
+    The supervisor's end of the pipes to a worker process.
+    """
+
+    def __init__(self, supervisor, index, spec):
+        self.supervisor = supervisor
+        self.index = index
+        self.spec = spec
+        self.stats_buf = ''
+
+    def connectionMade(self):
+        log.info("Started worker %d (pid %d).", self.index, self.transport.pid)
+
+        self.transport.writeToChild(0, struct.pack("!I", len(self.spec)) + self.spec)
+
+    def childDataReceived(self, childFD, data):
+        if childFD != STATS_FD:
+            return
+
+        self.stats_buf += data
+        while "\n" in self.stats_buf:
+            line, self.stats_buf = self.stats_buf.split("\n", 1)
+            try:
+                report = json.loads(line)
+                heartbeat.heartbeat.merge_report(report)
+                if 'metrics' in report:
+                    metrics.registry.merge_report(report['metrics'], self.index)
+            except (ValueError, KeyError, TypeError), err:
+                log.warning("Worker %d sent bogus stats (%s).", self.index, err)
+
+    def processEnded(self, reason):
+        self.supervisor.worker_ended(self, reason)
+
+class WorkerSupervisor(object):
+    """
+    Binds the listening sockets, and spawns and supervises the worker
+    processes that serve them.
+
+    Attributes:
+    n_workers: Number of worker processes. 0 means that we are not
+               using worker processes at all.
+    options: Process-wide options that the workers should apply, see
+             run_worker().
+    listeners: The listeners the workers should run.
+    sockets: The listening sockets, in the same order as 'listeners'.
+    workers: Maps worker indices to running WorkerProcessProtocols.
+    """
+
+    def __init__(self):
+        self.n_workers = 0
+        self.options = {}
+        self.listeners = []
+        self.sockets = []
+        self.workers = {}
+        self.stopping = False
+
+    @property
+    def enabled(self):
+        return self.n_workers > 0
+
+    def configure(self, n_workers, options):
+        """
+        Use 'n_workers' worker processes which apply 'options'.
+
+        Throws ValueError if 'n_workers' is invalid or if worker
+        processes are not supported on this platform.
+        """
+        if n_workers < 0:
+            raise ValueError("Invalid number of workers (%d)." % n_workers)
+        if n_workers and os.name != 'posix':
+            raise ValueError("Worker processes are not supported on this platform.")
+
+        self.n_workers = n_workers
+        self.options = options
+
+    def add_listener(self, host, port, transport, role, remote_addrport, pt_config,
+                     ext_or_cookie_file=None):
+        """
+        Bind a listening socket to 'host':'port' for the workers. See
+        launch_transport.launch_transport_listener() for the other
+        arguments.
+
+        Return a tuple (addr, port) representing where we managed to bind.
+
+        Throws twisted.internet.error.CannotListenError if the socket
+        could not be set up.
+        """
+        try:
+            family, socktype, proto, _, sockaddr = \
+                socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+            sock = socket.socket(family, socktype, proto)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(sockaddr)
+            sock.listen(LISTEN_BACKLOG)
+            sock.setblocking(False)
+        except socket.error, err:
+            raise error.CannotListenError(host, port, err)
+
+        self.listeners.append({'transport': transport,
+                               'role': role,
+                               'remote_addrport': remote_addrport,
+                               'pt_config': pt_config,
+                               'ext_or_cookie_file': ext_or_cookie_file,
+                               'family': family})
+        self.sockets.append(sock)
+
+        if len(self.sockets) == 1:
+            reactor.callWhenRunning(self.start)
+
+        return sock.getsockname()[:2]
+
+    def start(self):
+        """
+        Spawn the worker processes.
+        """
+        log.info("Spawning %d worker process(es) for %d listener(s).",
+                 self.n_workers, len(self.listeners))
+
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+        for index in xrange(self.n_workers):
+            self.spawn(index)
+
+    def spawn(self, index):
+        """
+        Spawn worker number 'index'.
+        """
+        if self.stopping:
+            return
+
+        listeners = [dict(listener, fd=FIRST_LISTENER_FD + n)
+                     for n, listener in enumerate(self.listeners)]
+        spec = cPickle.dumps({'index': index,
+                              'listeners': listeners,
+                              'options': self.options}, 2)
+
+        # In managed mode, our stdout belongs to Tor.
+        child_fds = {0: 'w', 1: 2 if self.options.get('managed') else 1, 2: 2,
+                     STATS_FD: 'r'}
+        for n, sock in enumerate(self.sockets):
+            child_fds[FIRST_LISTENER_FD + n] = sock.fileno()
+
+        # Make sure that the worker imports the same obfsproxy as we do.
+        env = os.environ.copy()
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT_DIR, env.get('PYTHONPATH')]))
+
+        worker = WorkerProcessProtocol(self, index, spec)
+        reactor.spawnProcess(worker, sys.executable,
+                             [sys.executable, '-c', WORKER_BOOTSTRAP],
+                             env=env, childFDs=child_fds)
+        self.workers[index] = worker
+
+    def worker_ended(self, worker, reason):
+        """
+        Worker 'worker' exited. Restart it, unless we are shutting down.
+        """
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+            # Its circuits are gone.
+            metrics.registry.forget(worker.index)
+
+        if self.stopping:
+            log.debug("Worker %d exited.", worker.index)
+            return
+
+        log.warning("Worker %d exited (%s). Restarting it.",
+                    worker.index, reason.getErrorMessage())
+        reactor.callLater(RESPAWN_DELAY, self.spawn, worker.index)
+
+    def stop(self):
+        """
+        Make all worker processes exit and close the listening sockets.
+        """
+        self.stopping = True
+
+        for sock in self.sockets:
+            sock.close()
+
+        # Closing their control pipe makes the workers exit.
+        for worker in self.workers.values():
+            worker.transport.closeStdin()
+
+# The supervisor singleton.
+supervisor = WorkerSupervisor()
+
+class WorkerControlProtocol(protocol.Protocol):
+    """
+    The worker's end of the pipes to the supervisor: receives the
+    worker's configuration, reports stats and stops the worker when
+    the supervisor goes away.
+    """
+
+    def __init__(self):
+        self.buf = ''
+        self.spec = None
+        self.stats_loop = None
+
+    def dataReceived(self, data):
+        if self.spec is not None:
+            return
+
+        self.buf += data
+        if len(self.buf) < 4:
+            return
+
+        (length,) = struct.unpack("!I", self.buf[:4])
+        if len(self.buf) < 4 + length:
+            return
+
+        self.spec = cPickle.loads(self.buf[4:4 + length])
+        self.buf = ''
+
+        try:
+            start_worker(self.spec)
+        except Exception, err:
+            log.error("Worker %d failed to start: %s", self.spec['index'], err)
+            reactor.stop()
+            return
+
+        self.stats_loop = task.LoopingCall(self.report_stats)
+        self.stats_loop.start(STATS_INTERVAL, now=False)
+
+    def report_stats(self):
+        report = heartbeat.heartbeat.get_report()
+        report['metrics'] = metrics.registry.get_report()
+        self.transport.write(json.dumps(report) + "\n")
+
+    def connectionLost(self, reason):
+        if self.stats_loop and self.stats_loop.running:
+            self.stats_loop.stop()
+
+        if reactor.running:
+            log.info("Lost the connection to the supervisor. Exiting.")
+            try:
+                reactor.stop()
+            except error.ReactorNotRunning: # we were shutting down already
+                pass
+
+def start_worker(spec):
+    """
+    Set up a worker process according to 'spec': apply the process-wide
+    options, set up the transports and adopt the listening sockets.
+    """
+    # Imported here to avoid an import loop with launch_transport.
+    import obfsproxy.network.launch_transport as launch_transport
+    import obfsproxy.network.network as network
+    import obfsproxy.transports.transports as transports
+    import obfsproxy.transports.obfs3_dh as obfs3_dh
+    import obfsproxy.common.crypto_worker as crypto_worker
+
+    options = spec['options']
+    if options.get('log_file'):
+        log.set_log_file(options['log_file'], *options.get('log_file_options', ()))
+    if options.get('log_min_severity'):
+        log.set_log_severity(options['log_min_severity'])
+    if options.get('no_log'):
+        log.disable_logs()
+    if options.get('no_safe_logging'):
+        log.set_no_safe_logging()
+    if 'crypto_workers' in options:
+        crypto_worker.crypto_worker.set_workers(options['crypto_workers'])
+    if 'dh_pool_size' in options:
+        obfs3_dh.keypair_pool.configure(options['dh_pool_size'])
+    if 'write_coalescing' in options:
+        network.set_write_coalescing(options['write_coalescing'])
+    if options.get('metrics_exporting'):
+        metrics.registry.exporting = True
+
+    set_up = set()
+    for listener in spec['listeners']:
+        transport_class = transports.get_transport_class(listener['transport'],
+                                                         listener['role'])
+        if transport_class not in set_up:
+            if 'external_mode_args' in options:
+                args = argparse.Namespace(**options['external_mode_args'])
+                base_class = transports.transports[listener['transport']]['base']
+                if base_class.validate_external_mode_cli(args) == False:
+                    raise ValueError("Invalid arguments for transport '%s'." %
+                                     listener['transport'])
+
+            transport_class.setup(listener['pt_config'])
+            set_up.add(transport_class)
+
+        factory = launch_transport.build_listener_factory(listener['transport'],
+                                                          listener['role'],
+                                                          listener['remote_addrport'],
+                                                          listener['pt_config'],
+                                                          listener['ext_or_cookie_file'])
+        reactor.adoptStreamPort(listener['fd'], listener['family'], factory)
+        os.close(listener['fd']) # adoptStreamPort() made its own copy.
+
+    log.debug("Worker %d (pid %d) is serving %d listener(s).",
+              spec['index'], os.getpid(), len(spec['listeners']))
+
+def run_worker():
+    """
+    Entry point of a worker process.
+    """
+    from twisted.internet import stdio
+
+    stdio.StandardIO(WorkerControlProtocol(), stdin=0, stdout=STATS_FD)
+
+    # Ctrl-C goes to the whole process group. Leave it to the
+    # supervisor, which will then close our control pipe.
+    reactor.callWhenRunning(signal.signal, signal.SIGINT, signal.SIG_IGN)
+    reactor.run()
@@ -11,10 +11,15 @@ import sys
 
 import obfsproxy.network.launch_transport as launch_transport
 import obfsproxy.network.network as network
+import obfsproxy.network.workers as workers
 import obfsproxy.transports.transports as transports
+import obfsproxy.transports.base as base
+import obfsproxy.transports.obfs3_dh as obfs3_dh
 import obfsproxy.common.log as logging
 import obfsproxy.common.argparser as argparser
 import obfsproxy.common.heartbeat as heartbeat
+import obfsproxy.common.crypto_backend as crypto_backend
+import obfsproxy.common.crypto_worker as crypto_worker
 import obfsproxy.common.transport_config as transport_config
 import obfsproxy.managed.server as managed_server
 import obfsproxy.managed.client as managed_client
@@ -27,7 +32,7 @@ except Exception:
 from pyptlib.config import checkClientMode
 from pyptlib.client_config import parseProxyURI
 
-from twisted.internet import task # for LoopingCall
+from twisted.internet import error, task # for LoopingCall
 
 log = logging.get_obfslogger()
 
@@ -45,6 +50,17 @@ def set_up_cli_parsing():
     parser.add_argument('--log-min-severity',
                         choices=['error', 'warning', 'info', 'debug'],
                         help='set minimum logging severity (default: %(default)s)')
+    parser.add_argument('--log-queue-size', type=int, default=logging.LOG_QUEUE_SIZE,
+                        help='number of log messages which may wait to be written to the log file '
+                        'by a background thread; 0 writes them right away (default: %(default)s)')
+    parser.add_argument('--log-queue-policy', choices=logging.LOG_QUEUE_POLICIES, default='drop',
+                        help='what to do with log messages while the log queue is full '
+                        '(default: %(default)s)')
+    parser.add_argument('--log-max-size', type=int, default=0, metavar='BYTES',
+                        help='rotate the log file once it reaches BYTES; 0 never rotates it '
+                        '(default: %(default)s)')
+    parser.add_argument('--log-backups', type=int, default=1,
+                        help='number of rotated log files to keep (default: %(default)s)')
     parser.add_argument('--no-log', action='store_true', default=False,
                         help='disable logging')
     parser.add_argument('--no-safe-logging', action='store_true',
@@ -55,6 +71,23 @@ def set_up_cli_parsing():
 
     parser.add_argument('--proxy', action='store', dest='proxy',
                         help='Outgoing proxy (<proxy_type>://[<user_name>][:<password>][@]<ip>:<port>)')
+    parser.add_argument('--dh-pool-size', type=int, default=None,
+                        help='number of pre-generated UniformDH keypairs to keep around; '
+                        '0 disables the pool (default: %d)' % obfs3_dh.POOL_SIZE)
+    parser.add_argument('--crypto-workers', type=int, default=None,
+                        help='number of processes computing DH shared secrets; '
+                        '0 computes them in threads (default: number of CPU cores)')
+    parser.add_argument('--write-coalescing', type=int, default=None, metavar='USEC',
+                        help='gather the writes to a connection for USEC microseconds and send '
+                        'them at once (default: gather the writes of one event loop turn)')
+    parser.add_argument('--no-write-coalescing', action='store_true', default=False,
+                        help='send every write to a connection right away')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='number of processes sharing the listening sockets of '
+                        'server-side listeners; 0 serves them in this process (default: %(default)s)')
+    parser.add_argument('--metrics-listen', type=base.addrport, metavar='ADDR:PORT',
+                        help='serve metrics in the Prometheus text format at '
+                        'http://ADDR:PORT/metrics')
 
     # Managed mode is a subparser for now because there are no
     # optional subparsers: bugs.python.org/issue9253
@@ -101,21 +134,51 @@ def do_external_mode(args):
     run_transport_setup(pt_config, args.name)
 
     launch_transport.launch_transport_listener(args.name, args.listen_addr, args.mode, args.dest, pt_config, args.ext_cookie_file)
-    log.info("Launched '%s' listener at '%s:%s' for transport '%s'." % \
-                 (args.mode, log.safe_addr_str(args.listen_addr[0]), args.listen_addr[1], args.name))
+    log.info("Launched '%s' listener at '%s:%s' for transport '%s'.",
+             args.mode, log.safe_addr_str(args.listen_addr[0]), args.listen_addr[1], args.name)
     reactor.run()
 
 def consider_cli_args(args):
     """Check out parsed CLI arguments and take the appropriate actions."""
 
+    if args.workers and args.log_max_size:
+        # Worker processes share the log file, and can't rotate it together.
+        log.warning("Log rotation is not supported with worker processes. "
+                    "Ignoring --log-max-size.")
+        args.log_max_size = 0
     if args.log_file:
-        log.set_log_file(args.log_file)
+        try:
+            log.set_log_file(args.log_file, args.log_queue_size, args.log_queue_policy,
+                             args.log_max_size, args.log_backups)
+        except ValueError as e:
+            log.error("%s", e)
+            sys.exit(1)
     if args.log_min_severity:
         log.set_log_severity(args.log_min_severity)
     if args.no_log:
         log.disable_logs()
     if args.no_safe_logging:
         log.set_no_safe_logging()
+    if args.dh_pool_size is not None:
+        try:
+            obfs3_dh.keypair_pool.configure(args.dh_pool_size)
+        except ValueError as e:
+            log.error("%s", e)
+            sys.exit(1)
+    if args.crypto_workers is not None:
+        try:
+            crypto_worker.crypto_worker.set_workers(args.crypto_workers)
+        except ValueError as e:
+            log.error("%s", e)
+            sys.exit(1)
+    if args.no_write_coalescing:
+        network.set_write_coalescing(None)
+    elif args.write_coalescing is not None:
+        try:
+            network.set_write_coalescing(args.write_coalescing)
+        except ValueError as e:
+            log.error("%s", e)
+            sys.exit(1)
 
     # validate:
     if (args.name == 'managed') and (not args.log_file) and (args.log_min_severity):
@@ -125,6 +188,9 @@ def consider_cli_args(args):
         # managed proxies without a logfile must not log at all.
         log.disable_logs()
 
+    if args.workers:
+        configure_workers(args)
+
     if args.proxy:
         # CLI proxy is only supported in external mode.
         if args.name == 'managed':
@@ -143,6 +209,57 @@ def consider_cli_args(args):
             log.error("Failed to parse proxy specifier: %s", e)
             sys.exit(1)
 
+def configure_workers(args):
+    """
+    Hand our listeners over to 'args.workers' worker processes.
+
+    The workers apply our logging and crypto options. The CPU cores are
+    shared between them, so each worker gets its share of crypto worker
+    processes. This process only supervises the workers: it does not
+    need crypto workers or a keypair pool of its own.
+    """
+    if (args.name == 'managed' and checkClientMode()) or \
+            (args.name != 'managed' and args.mode == 'socks'):
+        log.warning("Worker processes are only supported for server listeners. "
+                    "Ignoring --workers.")
+        return
+
+    if args.crypto_workers is None:
+        crypto_workers = max(1, crypto_worker.crypto_worker.workers // max(1, args.workers))
+    else:
+        crypto_workers = args.crypto_workers
+
+    options = {'managed': args.name == 'managed',
+               'log_file': args.log_file,
+               'log_file_options': (args.log_queue_size, args.log_queue_policy,
+                                    args.log_max_size, args.log_backups),
+               'log_min_severity': args.log_min_severity,
+               'no_log': args.no_log or (args.name == 'managed' and not args.log_file),
+               'no_safe_logging': args.no_safe_logging,
+               'crypto_workers': crypto_workers}
+    if args.dh_pool_size is not None:
+        options['dh_pool_size'] = args.dh_pool_size
+    if args.metrics_listen:
+        # The workers report their process gauges to our endpoint.
+        options['metrics_exporting'] = True
+    if args.no_write_coalescing:
+        options['write_coalescing'] = None
+    elif args.write_coalescing is not None:
+        options['write_coalescing'] = args.write_coalescing
+    if args.name != 'managed':
+        # The workers have to pass the transport's CLI arguments to it again.
+        options['external_mode_args'] = dict((key, value) for key, value in vars(args).items()
+                                             if key != 'validation_function')
+
+    try:
+        workers.supervisor.configure(args.workers, options)
+    except ValueError as e:
+        log.error("%s", e)
+        sys.exit(1)
+
+    crypto_worker.crypto_worker.set_workers(0)
+    obfs3_dh.keypair_pool.configure(0)
+
 def run_transport_setup(pt_config, transport_name):
     """Run the setup() method for our transports."""
     for transport, transport_class in transports.transports.items():
@@ -162,6 +279,8 @@ def pyobfsproxy():
         log.warning('Pyptlib version: %s' % pyptlibversion)
     except Exception:
         pass
+    log.warning('Crypto backends: AES via %s, HMAC-SHA256 via %s.' % \
+                crypto_backend.get_backend_names())
 
     log.debug('argv: ' + str(sys.argv))
     log.debug('args: ' + str(args))
@@ -170,6 +289,15 @@ def pyobfsproxy():
     l = task.LoopingCall(heartbeat.heartbeat.talk)
     l.start(3600.0, now=False) # do heartbeat every hour
 
+    if args.metrics_listen:
+        # Imported here since twisted.web takes a while to load.
+        import obfsproxy.common.prometheus as prometheus
+        try:
+            prometheus.listen(args.metrics_listen)
+        except error.CannotListenError as e:
+            log.error("Could not serve metrics: %s", e)
+            sys.exit(1)
+
     # Initiate obfsproxy.
     if (args.name == 'managed'):
         do_managed_mode()
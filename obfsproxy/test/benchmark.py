@@ -0,0 +1,29 @@
+"""
+Helpers for the benchmarks which live next to the unit tests.
+
+Benchmarks take a while and only log their results, so they are skipped
+unless the OBFSPROXY_BENCHMARKS environment variable is set:
+
+    OBFSPROXY_BENCHMARKS=1 trial obfsproxy
+"""
+
+import os
+import timeit
+import unittest
+
+ENABLED = bool(os.environ.get('OBFSPROXY_BENCHMARKS'))
+
+SKIP_REASON = "Benchmarks only run if OBFSPROXY_BENCHMARKS is set."
+
+# Wall clock time with the best resolution of the platform.
+timer = timeit.default_timer
+
+def skip_unless_enabled(cls):
+    """
+    Class decorator for benchmark test cases, which are skipped unless
+    benchmarks are enabled. Works for both trial and pyunit test cases.
+    """
+    if not ENABLED:
+        cls.skip = SKIP_REASON
+        cls = unittest.skip(SKIP_REASON)(cls)
+    return cls
@@ -4,7 +4,22 @@ from Crypto.Cipher import AES
 from Crypto.Util import Counter
 
 import obfsproxy.common.aes as aes
+import obfsproxy.common.crypto_backend as crypto_backend
+import obfsproxy.test.benchmark as benchmark
 import twisted.trial.unittest
+from twisted.python import log
+
+# NIST SP 800-38A, F.5.1 (CTR-AES128.Encrypt).
+NIST_KEY = "\x2b\x7e\x15\x16\x28\xae\xd2\xa6\xab\xf7\x15\x88\x09\xcf\x4f\x3c"
+NIST_IV = "\xf0\xf1\xf2\xf3\xf4\xf5\xf6\xf7\xf8\xf9\xfa\xfb\xfc\xfd\xfe\xff"
+NIST_PLAINTEXT = "6bc1bee22e409f96e93d7e117393172a" \
+                 "ae2d8a571e03ac9c9eb76fac45af8e51" \
+                 "30c81c46a35ce411e5fbc1191a0a52ef" \
+                 "f69f2445df4f9b17ad2b417be66c3710".decode('hex')
+NIST_CIPHERTEXT = "874d6191b620e3261bef6864990db6ce" \
+                  "9806f66b7970fdff8617187bb9fffdff" \
+                  "5ae4df3edbd5d35e5b4f09020db03eab" \
+                  "1e031dda2fbe03d1792170a0f3009cee".decode('hex')
 
 class testAES_CTR_128_NIST(twisted.trial.unittest.TestCase):
     def _helper_test_vector(self, input_block, output_block, plaintext, ciphertext):
@@ -69,6 +84,68 @@ class testAES_CTR_128_simple(twisted.trial.unittest.TestCase):
 
         self.assertEqual(test_string, pt)
 
+class testAES_CTR_128_Backends(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.old_backends = crypto_backend.get_backend_names()
+
+    def tearDown(self):
+        crypto_backend.set_backends(*self.old_backends)
+
+    def test_nist_all_backends(self):
+        """
+        Validate the NIST vectors against all available AES backends,
+        both in one go and split across calls.
+        """
+        for backend in crypto_backend.CIPHER_BACKENDS:
+            crypto_backend.set_backends(cipher_name=backend.name)
+
+            cipher = aes.AES_CTR_128(NIST_KEY, NIST_IV)
+            self.assertEqual(cipher.crypt(NIST_PLAINTEXT), NIST_CIPHERTEXT)
+
+            cipher = aes.AES_CTR_128(NIST_KEY, NIST_IV)
+            ct = ''.join([cipher.crypt(NIST_PLAINTEXT[i:i + 7])
+                          for i in xrange(0, len(NIST_PLAINTEXT), 7)])
+            self.assertEqual(ct, NIST_CIPHERTEXT)
+
+    def test_counter_carry(self):
+        """
+        All backends carry the counter into the upper 64 bits. This differs
+        from the PyCrypto counter ScrambleSuit used before, a 64-bit counter
+        after a fixed prefix which raised an error on overflow.
+        """
+        key = "k" * 16
+        iv = "\x00" * 8 + "\xff" * 8
+
+        results = []
+        for backend in crypto_backend.CIPHER_BACKENDS:
+            crypt = backend.aes_ctr(key, iv, False)
+            results.append(crypt("\x00" * 64))
+
+        self.assertEqual(len(set(results)), 1)
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, crypto_backend.set_backends, "rot13")
+
+@benchmark.skip_unless_enabled
+class testAES_CTR_128_Benchmark(twisted.trial.unittest.TestCase):
+    def _throughput(self, backend, size, total=8 * 1024 * 1024):
+        crypt = backend.aes_ctr("k" * 16, "\x00" * 16, False)
+        data = "A" * size
+
+        start = benchmark.timer()
+        for _ in xrange(total / size):
+            crypt(data)
+        elapsed = benchmark.timer() - start
+
+        return (total / size) * size / elapsed
+
+    def test_benchmark(self):
+        for backend in crypto_backend.CIPHER_BACKENDS:
+            for size in (50, 1448, 64 * 1024):
+                rate = self._throughput(backend, size)
+                log.msg("AES-CTR via %s, %d-byte calls: %.1f MB/s" %
+                        (backend.name, size, rate / (1024 * 1024)))
+
 
 if __name__ == '__main__':
     unittest.main()
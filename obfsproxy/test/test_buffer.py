@@ -1,7 +1,9 @@
 import unittest
 
 import obfsproxy.network.buffer as obfs_buf
+import obfsproxy.test.benchmark as benchmark
 import twisted.trial.unittest
+from twisted.python import log
 
 class testBuffer(twisted.trial.unittest.TestCase):
     def setUp(self):
@@ -37,6 +39,90 @@ class testBuffer(twisted.trial.unittest.TestCase):
         self.assertEqual(self.buf.peek(-1), '.') # peek at last character
         self.assertEqual(len(self.buf), 1) # length must be 1
 
+    def test_many_chunks(self):
+        """Read across the boundaries of many small writes."""
+        buf = obfs_buf.Buffer()
+        for c in self.test_string:
+            buf.write(c)
+        self.assertEqual(len(buf), len(self.test_string))
+
+        self.assertEqual(buf.peek(5), self.test_string[:5])
+        self.assertEqual(buf.read(3), self.test_string[:3])
+        buf.drain(4)
+        self.assertEqual(buf.read(10), self.test_string[7:17])
+        self.assertEqual(buf.peek(), self.test_string[17:])
+        self.assertEqual(buf.read(), self.test_string[17:])
+        self.assertFalse(buf)
+
+    def test_write_after_partial_read(self):
+        self.assertEqual(self.buf.read(3), self.test_string[:3])
+        self.buf.write("!!")
+        self.assertEqual(len(self.buf), len(self.test_string) - 3 + 2)
+        self.assertEqual(self.buf.read(), self.test_string[3:] + "!!")
+
+    def test_peek_view(self):
+        self.buf.write(" Ad lib.")
+        view = self.buf.peek_view(40)
+        self.assertEqual(str(view), (self.test_string + " Ad lib.")[:40])
+        self.assertEqual(len(self.buf), len(self.test_string) + 8)
+        self.assertEqual(str(obfs_buf.Buffer().peek_view()), '')
+
+    def test_empty_writes(self):
+        buf = obfs_buf.Buffer()
+        buf.write('')
+        self.assertFalse(buf)
+        self.assertEqual(buf.read(), '')
+        self.assertEqual(buf.peek(), '')
+        buf.drain(10)
+        self.assertEqual(len(buf), 0)
+
+    def test_bounded_reads(self):
+        """Chop a few large writes into MTU-sized reads."""
+        blurbs = [chr(ord('a') + i) * (100000 + i) for i in xrange(3)]
+        buf = obfs_buf.Buffer()
+        for blurb in blurbs:
+            buf.write(blurb)
+
+        total = sum(len(blurb) for blurb in blurbs)
+        pieces = []
+        while len(buf) > 1448:
+            pieces.append(buf.read(1448))
+            total -= 1448
+            self.assertEqual(len(buf), total)
+        pieces.append(buf.read())
+
+        self.assertTrue(all(len(piece) == 1448 for piece in pieces[:-1]))
+        self.assertEqual(''.join(pieces), ''.join(blurbs))
+        self.assertEqual(len(buf), 0)
+
+@benchmark.skip_unless_enabled
+class testBuffer_Benchmark(twisted.trial.unittest.TestCase):
+    def _throughput(self, backlog, total=8*1024*1024, chunk=1024, read_size=1448):
+        """
+        Push 'total' bytes through a buffer in 'chunk'-sized writes while
+        keeping 'backlog' bytes queued, and read them out in
+        'read_size'-sized pieces. Return the throughput in MB/s.
+        """
+        data = 'X' * chunk
+        buf = obfs_buf.Buffer()
+        while len(buf) < backlog:
+            buf.write(data)
+
+        start = benchmark.timer()
+        written = 0
+        while written < total:
+            buf.write(data)
+            written += chunk
+            while len(buf) > backlog:
+                buf.read(read_size)
+        taken = benchmark.timer() - start
+
+        return (total / (1024.0 * 1024.0)) / max(taken, 1e-6)
+
+    def test_benchmark(self):
+        for backlog in (1024, 64*1024, 4*1024*1024):
+            log.msg("Buffer throughput with a %d-byte backlog: %.1f MB/s" %
+                    (backlog, self._throughput(backlog)))
 
 if __name__ == '__main__':
     unittest.main()
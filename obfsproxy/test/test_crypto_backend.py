@@ -0,0 +1,77 @@
+import unittest
+
+import obfsproxy.common.crypto_backend as crypto_backend
+import obfsproxy.test.benchmark as benchmark
+import twisted.trial.unittest
+from twisted.python import log
+
+# RFC 4231 HMAC-SHA256 test cases 1, 2 and 6.
+HMAC_VECTORS = [
+    ("\x0b" * 20, "Hi There",
+     "b0344c61d8db38535ca8afceaf0bf12b881dc200c9833da726e9376c2e32cff7"),
+    ("Jefe", "what do ya want for nothing?",
+     "5bdcc146bf60754e6a042426089575c75a003f089d2739839dec58b964ec3843"),
+    ("\xaa" * 131, "Test Using Larger Than Block-Size Key - Hash Key First",
+     "60e431591ee0b67f0d8a26aacbf5b77f8e0bc6213728c5140546040f0ee37f54"),
+]
+
+class testHMAC_SHA256_Backends(twisted.trial.unittest.TestCase):
+    def test_rfc4231_all_backends(self):
+        for backend in crypto_backend.HMAC_BACKENDS:
+            for key, msg, digest in HMAC_VECTORS:
+                h = backend.hmac_sha256(key)
+                h.update(msg)
+                self.assertEqual(h.digest().encode('hex'), digest)
+
+    def test_copy(self):
+        """
+        Copies must be independent of the original and digest() must not
+        finalize the object.
+        """
+        key, msg, digest = HMAC_VECTORS[1]
+
+        for backend in crypto_backend.HMAC_BACKENDS:
+            template = backend.hmac_sha256(key)
+            h = template.copy()
+            h.update(msg[:10])
+            h.digest()
+            h.update(msg[10:])
+            self.assertEqual(h.digest().encode('hex'), digest)
+
+            h = template.copy()
+            h.update(buffer(msg))
+            self.assertEqual(h.digest().encode('hex'), digest)
+
+    def test_aes_cbc_all_backends(self):
+        # NIST SP 800-38A, F.2.1 (CBC-AES128.Encrypt), first block.
+        key = "2b7e151628aed2a6abf7158809cf4f3c".decode('hex')
+        iv = "000102030405060708090a0b0c0d0e0f".decode('hex')
+        pt = "6bc1bee22e409f96e93d7e117393172a".decode('hex')
+        ct = "7649abac8119b246cee98e9b12e9197d".decode('hex')
+
+        for backend in crypto_backend.CIPHER_BACKENDS:
+            self.assertEqual(backend.aes_cbc_encrypt(key, iv, pt), ct)
+            self.assertEqual(backend.aes_cbc_decrypt(key, iv, ct), pt)
+
+@benchmark.skip_unless_enabled
+class testHMAC_SHA256_Benchmark(twisted.trial.unittest.TestCase):
+    def test_benchmark(self):
+        for backend in crypto_backend.HMAC_BACKENDS:
+            for size in (50, 1448, 64 * 1024):
+                data = "A" * size
+                rounds = max(10, (4 * 1024 * 1024) / size)
+
+                start = benchmark.timer()
+                for _ in xrange(rounds):
+                    h = backend.hmac_sha256("k" * 32)
+                    h.update(data)
+                    h.digest()
+                elapsed = benchmark.timer() - start
+
+                log.msg("HMAC-SHA256 via %s, %d-byte messages: %.1f MB/s" %
+                        (backend.name, size,
+                         rounds * size / elapsed / (1024 * 1024)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+
+import obfsproxy.common.crypto_worker as crypto_worker
+import obfsproxy.transports.obfs3_dh as obfs3_dh
+import obfsproxy.test.benchmark as benchmark
+import twisted.trial.unittest
+from twisted.internet import defer
+from twisted.python import log
+
+class testCryptoWorker(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.worker = crypto_worker.CryptoWorker(workers=2)
+
+    def tearDown(self):
+        self.worker.stop()
+
+    def _check_exchange(self, worker):
+        dh_x = obfs3_dh.UniformDH()
+        dh_y = obfs3_dh.UniformDH()
+
+        d = worker.compute_shared_secret(dh_x.priv, dh_y.get_public())
+        d.addCallback(self.assertEqual, dh_y.get_secret(dh_x.get_public()))
+        return d
+
+    def test_shared_secret(self):
+        return self._check_exchange(self.worker)
+
+    def test_shared_secret_threads(self):
+        self.worker.set_workers(0)
+        d = self._check_exchange(self.worker)
+        self.assertEqual(self.worker.pool, None)
+        return d
+
+    def test_error(self):
+        # A public key that is not a string of bytes.
+        d = self.worker.compute_shared_secret(2, 42)
+        return self.assertFailure(d, TypeError)
+
+    def test_invalid_workers(self):
+        self.assertRaises(ValueError, self.worker.set_workers, -1)
+
+@benchmark.skip_unless_enabled
+class testCryptoWorker_Benchmark(twisted.trial.unittest.TestCase):
+    """
+    Measure how the handshake throughput scales with the number of
+    worker processes (it can only scale up to the number of cores).
+    """
+
+    N_HANDSHAKES = 200
+
+    @defer.inlineCallbacks
+    def test_benchmark(self):
+        pubs = [obfs3_dh.UniformDH().get_public() for _ in range(self.N_HANDSHAKES)]
+        dh = obfs3_dh.UniformDH()
+
+        for workers in (0, 1, 2, 4):
+            worker = crypto_worker.CryptoWorker(workers=workers)
+            worker.start()
+            try:
+                start = benchmark.timer()
+                yield defer.gatherResults([worker.compute_shared_secret(dh.priv, pub)
+                                           for pub in pubs])
+                taken = benchmark.timer() - start
+            finally:
+                worker.stop()
+
+            log.msg("Shared secrets using %d crypto worker process(es): "
+                    "%.1f handshakes/sec" % (workers, self.N_HANDSHAKES / taken))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import logging as stdlogging
+import os
+import shutil
+import tempfile
+import threading
+
+import obfsproxy.common.log as logging
+import twisted.trial.unittest
+
+class Address(object):
+    def __init__(self):
+        self.conversions = 0
+
+    def __str__(self):
+        self.conversions += 1
+        return "192.0.2.1"
+
+class testLog(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.log = logging.ObfsLogger.__new__(logging.ObfsLogger)
+        self.log.safe_logging = True
+
+    def test_safe_addr_str(self):
+        addr = Address()
+        safe = self.log.safe_addr_str(addr)
+        self.assertEqual(str(safe), "[scrubbed]")
+        self.assertEqual(addr.conversions, 0)
+
+        self.log.set_no_safe_logging()
+        self.assertEqual("%s:%d" % (safe, 443), "192.0.2.1:443")
+        self.assertEqual(addr.conversions, 1)
+
+    def test_is_enabled_for(self):
+        log = logging.get_obfslogger()
+        self.addCleanup(log.obfslogger.setLevel, log.obfslogger.level)
+        self.addCleanup(stdlogging.disable, log.obfslogger.manager.disable)
+        stdlogging.disable(stdlogging.NOTSET)
+
+        log.set_log_severity('info')
+        self.assertFalse(log.is_enabled_for(logging.DEBUG))
+        self.assertTrue(log.is_enabled_for(logging.INFO))
+
+        log.set_log_severity('debug')
+        self.assertTrue(log.is_enabled_for(logging.DEBUG))
+
+        log.disable_logs()
+        self.assertFalse(log.is_enabled_for(logging.ERROR))
+
+class testQueuedFileHandler(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, "obfsproxy.log")
+        self.logger = stdlogging.getLogger("test_queued_file_handler")
+        self.logger.propagate = False
+        self.addCleanup(stdlogging.disable, self.logger.manager.disable)
+        stdlogging.disable(stdlogging.NOTSET)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def use_handler(self, *args, **kwargs):
+        handler = logging.QueuedFileHandler(self.filename, *args, **kwargs)
+        handler.setFormatter(stdlogging.Formatter("%(message)s"))
+        self.logger.addHandler(handler)
+        self.addCleanup(self.logger.removeHandler, handler)
+        return handler
+
+    def read(self, filename):
+        with open(filename) as fd:
+            return fd.read()
+
+    def test_write(self):
+        handler = self.use_handler()
+        for i in xrange(1000):
+            self.logger.warning("Record %d", i)
+        handler.close()
+
+        self.assertEqual(self.read(self.filename),
+                         "".join("Record %d\n" % i for i in xrange(1000)))
+        self.assertEqual(handler.dropped, 0)
+
+    def test_drop(self):
+        handler = self.use_handler(queue_size=2)
+
+        # Stall the writer thread on its first batch.
+        writing, resume = threading.Event(), threading.Event()
+        write = handler._write
+        def stalled_write(lines):
+            writing.set()
+            resume.wait()
+            write(lines)
+        handler._write = stalled_write
+
+        self.logger.warning("first")
+        writing.wait()
+        for i in xrange(5):
+            self.logger.warning("Record %d", i)
+        self.assertEqual(handler.dropped, 3)
+
+        resume.set()
+        handler.close()
+        self.assertEqual(self.read(self.filename),
+                         "first\nDropped 3 log message(s).\nRecord 0\nRecord 1\n")
+
+    def test_rotation(self):
+        handler = self.use_handler(max_bytes=20, backup_count=2)
+        for i in xrange(10):
+            self.logger.warning("Record %d", i) # 9 bytes per record
+        handler.close()
+
+        self.assertEqual(self.read(self.filename), "Record 8\nRecord 9\n")
+        self.assertEqual(self.read(self.filename + ".1"), "Record 6\nRecord 7\n")
+        self.assertEqual(self.read(self.filename + ".2"), "Record 4\nRecord 5\n")
+        self.assertFalse(os.path.exists(self.filename + ".3"))
+
+    def test_invalid_policy(self):
+        self.assertRaises(ValueError, logging.QueuedFileHandler, self.filename,
+                          policy='wait')
@@ -0,0 +1,167 @@
+import json
+
+import obfsproxy.common.metrics as metrics
+import obfsproxy.network.network as network
+import obfsproxy.network.buffer as obfs_buf
+import obfsproxy.transports.base as base
+import twisted.trial.unittest
+
+class FakeCircuit(object):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+class FakeConnection(object):
+    def __init__(self):
+        self.buffer = obfs_buf.Buffer()
+        self.pending_bytes = 0
+
+    def close(self):
+        pass
+
+class EchoTransport(base.BaseTransport):
+    """
+    Finishes its handshake once it saw a newline from downstream, and then
+    passes the data upstream.
+    """
+
+    def receivedDownstream(self, data):
+        if "\n" in data.peek():
+            self.circuit.handshake_finished()
+            self.circuit.upstream.write(data.read())
+
+class FakeUpstream(object):
+    def __init__(self, circuit):
+        self.circuit = circuit
+        self.written = ""
+
+    def write(self, data):
+        self.written += data
+        self.circuit.bytes_sent(self, len(data))
+
+    def close(self):
+        pass
+
+class testHistogram(twisted.trial.unittest.TestCase):
+    def test_observe(self):
+        histogram = metrics.Histogram((1.0, 2.0))
+        for value in (0.5, 1.0, 1.5, 7.0):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [2, 1, 1])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 10.0)
+
+    def test_merge(self):
+        histogram = metrics.Histogram((1.0, 2.0))
+        histogram.observe(0.5)
+        other = metrics.Histogram((1.0, 2.0))
+        other.observe(3.0)
+
+        histogram.merge(other.snapshot())
+        self.assertEqual(histogram.counts, [1, 0, 1])
+        self.assertEqual(histogram.sum, 3.5)
+        self.assertRaises(ValueError, histogram.merge, metrics.Histogram((1.0,)).snapshot())
+
+class testMetricsRegistry(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def test_gauges(self):
+        obfs3 = self.registry.get('obfs3')
+        obfs3.circuit_opened()
+        obfs3.circuit_opened()
+        obfs3.circuit_closed('upstream')
+
+        conn = FakeConnection()
+        conn.circuit = FakeCircuit(obfs3)
+        conn.buffer.write("12345")
+        conn.pending_bytes = 3
+        self.registry.register_connection(conn)
+
+        snapshot = self.registry.snapshot()['obfs3']
+        self.assertEqual(snapshot['open_circuits'], 1)
+        self.assertEqual(snapshot['buffered_bytes'], 8)
+        self.assertEqual(snapshot['close_reasons'], {'upstream': 1})
+
+        # Closed connections drop out of the gauge.
+        del conn
+        self.assertEqual(self.registry.snapshot()['obfs3']['buffered_bytes'], 0)
+
+    def test_report(self):
+        """Worker reports survive JSON and are merged by the supervisor."""
+        worker = metrics.MetricsRegistry()
+        obfs3 = worker.get('obfs3')
+        obfs3.circuit_opened()
+        obfs3.downstream_bytes_in += 100
+        obfs3.handshake_seconds.observe(0.2)
+
+        report = json.loads(json.dumps(worker.get_report()))
+        self.assertEqual(obfs3.downstream_bytes_in, 0)
+        self.assertEqual(obfs3.open_circuits, 1)
+
+        self.registry.merge_report(report, 1)
+        self.registry.merge_report(report, 1) # Replaces worker 1's gauges.
+        snapshot = self.registry.snapshot()['obfs3']
+        self.assertEqual(snapshot['downstream_bytes_in'], 200)
+        self.assertEqual(snapshot['handshake_seconds']['count'], 2)
+        self.assertEqual(snapshot['open_circuits'], 1)
+
+        self.registry.forget(1)
+        self.assertEqual(self.registry.snapshot()['obfs3']['open_circuits'], 0)
+
+    def test_process_gauges(self):
+        """Reports only compute process gauges while metrics are exported."""
+        calls = []
+        def keys():
+            calls.append(None)
+            return 5
+
+        worker = metrics.MetricsRegistry()
+        worker.add_gauge('keys', "Keys.", keys)
+        self.registry.merge_report(worker.get_report(), 1)
+        self.assertEqual(calls, [])
+        self.assertEqual(self.registry.remote_process_gauges, {})
+
+        worker.exporting = True
+        self.registry.merge_report(json.loads(json.dumps(worker.get_report())), 1)
+        self.assertEqual(self.registry.remote_process_gauges, {1: {'keys': 5}})
+
+class testCircuitMetrics(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        self.patch(metrics, 'registry', self.registry)
+
+        self.circuit = network.Circuit(EchoTransport())
+        self.circuit.transport.circuit = self.circuit
+        self.circuit.downstream = FakeConnection()
+        self.circuit.upstream = FakeUpstream(self.circuit)
+        self.circuit.completed = self.circuit.created
+        self.metrics = self.circuit.metrics
+
+    def test_counters(self):
+        self.assertEqual(self.metrics.name, 'EchoTransport')
+        self.assertEqual(self.metrics.open_circuits, 1)
+
+        downstream = self.circuit.downstream
+        for data in ("hello", " world\n"):
+            self.circuit.bytes_received(downstream, len(data))
+            downstream.buffer.write(data)
+            self.circuit.dataReceived(downstream.buffer, downstream)
+
+        self.assertEqual(self.circuit.upstream.written, "hello world\n")
+        self.assertEqual(self.metrics.downstream_bytes_in, 12)
+        self.assertEqual(self.metrics.upstream_bytes_out, 12)
+        self.assertEqual(self.metrics.first_byte_seconds.count, 1)
+        self.assertEqual(self.metrics.handshake_seconds.count, 1)
+
+        # Later data doesn't count as another handshake.
+        downstream.buffer.write("again\n")
+        self.circuit.dataReceived(downstream.buffer, downstream)
+        self.assertEqual(self.metrics.handshake_seconds.count, 1)
+
+    def test_close_reasons(self):
+        self.circuit.close(base.PluggableTransportError("bad"))
+        self.circuit.close(side='upstream') # Closed already.
+
+        self.assertEqual(self.metrics.open_circuits, 0)
+        self.assertEqual(self.metrics.close_reasons, {'transport_error': 1})
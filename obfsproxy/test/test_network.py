@@ -0,0 +1,303 @@
+import os
+
+import obfsproxy.common.metrics as metrics
+import obfsproxy.common.transport_config as transport_config
+import obfsproxy.network.network as network
+import obfsproxy.transports.dummy as dummy
+import twisted.trial.unittest
+from twisted.internet import defer, interfaces, protocol, reactor, task
+from twisted.test import proto_helpers
+from zope.interface import implementer
+
+class CountingTransport(proto_helpers.StringTransport):
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.calls = 0
+
+    def write(self, data):
+        self.calls += 1
+        proto_helpers.StringTransport.write(self, data)
+
+    def writeSequence(self, seq):
+        self.calls += 1
+        proto_helpers.StringTransport.write(self, ''.join(seq))
+
+class FakeCircuit(object):
+    def __init__(self):
+        self.closed = False
+        self.downstream = None
+
+    def close(self, reason=None, side=None):
+        self.closed = True
+
+    def bytes_sent(self, conn, nbytes):
+        pass
+
+class testWriteCoalescing(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(network, 'reactor', self.clock)
+        self.patch(network, 'write_coalescing_delay', 0)
+
+        self.conn = network.GenericProtocol(FakeCircuit())
+        self.conn.name = "conn_test"
+        self.conn.transport = CountingTransport()
+
+    def test_one_turn(self):
+        """Writes of one reactor turn reach the transport in one call."""
+        for data in ("padding", "magic", "payload"):
+            self.conn.write(data)
+        self.assertEqual(self.conn.transport.value(), "")
+
+        self.clock.advance(0)
+        self.assertEqual(self.conn.transport.value(), "paddingmagicpayload")
+        self.assertEqual(self.conn.transport.calls, 1)
+
+    def test_delay(self):
+        network.set_write_coalescing(500)
+        self.assertEqual(network.write_coalescing_delay, 0.0005)
+
+        self.conn.write("A")
+        self.clock.advance(0.0004)
+        self.conn.write("B")
+        self.assertEqual(self.conn.transport.value(), "")
+        self.clock.advance(0.0002)
+        self.assertEqual(self.conn.transport.value(), "AB")
+        self.assertEqual(self.conn.transport.calls, 1)
+
+        self.assertRaises(ValueError, network.set_write_coalescing, -1)
+
+    def test_disabled(self):
+        network.set_write_coalescing(None)
+
+        self.conn.write("A")
+        self.conn.write("B")
+        self.assertEqual(self.conn.transport.value(), "AB")
+        self.assertEqual(self.conn.transport.calls, 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_max_bytes(self):
+        """Large bursts are flushed without waiting."""
+        self.conn.write("A" * (network.WRITE_COALESCING_MAX_BYTES - 1))
+        self.conn.write("B")
+        self.assertEqual(len(self.conn.transport.value()),
+                         network.WRITE_COALESCING_MAX_BYTES)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_call_before_flush(self):
+        """Flush callbacks see the whole burst and may still write."""
+        def pad():
+            self.conn.write("+%d" % self.conn.pending_bytes)
+
+        self.conn.call_before_flush(pad)
+        self.conn.write("AB")
+        self.conn.write("CDE")
+        self.clock.advance(0)
+        self.assertEqual(self.conn.transport.value(), "ABCDE+5")
+        self.assertEqual(self.conn.transport.calls, 1)
+
+    def test_close(self):
+        """Closing a connection sends its queued writes first."""
+        self.conn.write("bye")
+        self.conn.close()
+        self.assertEqual(self.conn.transport.value(), "bye")
+        self.assertTrue(self.conn.transport.disconnecting)
+        self.assertTrue(self.conn.circuit.closed)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+        self.conn.write("ignored")
+        self.clock.advance(0)
+        self.assertEqual(self.conn.transport.value(), "bye")
+
+class BufferingTransport(proto_helpers.StringTransport):
+    """Holds 'buffered' bytes which didn't fit into the kernel yet."""
+
+    def __init__(self):
+        proto_helpers.StringTransport.__init__(self)
+        self.dataBuffer = ""
+        self.offset = 0
+        self._tempDataLen = 0
+        self.producerPaused = False
+
+    def buffer(self, nbytes):
+        self.dataBuffer = "A" * nbytes
+
+class testLowWater(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.patch(network, 'reactor', self.clock)
+
+        circuit = FakeCircuit()
+        circuit.name = "circ_test"
+        self.writer = network.GenericProtocol(circuit)
+        self.writer.name = "conn_writer"
+        self.writer.transport = BufferingTransport()
+        self.reader = network.GenericProtocol(circuit)
+        self.reader.name = "conn_reader"
+        self.reader.transport = BufferingTransport()
+        self.producer = network.CircuitProducer(circuit, self.writer, self.reader)
+
+    def pause(self):
+        self.writer.transport.buffer(network.FLOW_CONTROL_HIGH_WATER + 1)
+        self.writer.transport.producerPaused = True
+        self.producer.pauseProducing()
+        self.assertEqual(self.reader.transport.producerState, 'paused')
+
+    def test_resume_below_low_water(self):
+        """Reading resumes before the other side's buffer is empty."""
+        self.pause()
+
+        self.writer.transport.buffer(network.FLOW_CONTROL_LOW_WATER)
+        self.clock.advance(network.FLOW_CONTROL_CHECK_INTERVAL)
+        self.assertEqual(self.reader.transport.producerState, 'paused')
+
+        self.writer.transport.buffer(network.FLOW_CONTROL_LOW_WATER - 1)
+        self.clock.advance(network.FLOW_CONTROL_CHECK_INTERVAL)
+        self.assertEqual(self.reader.transport.producerState, 'producing')
+        self.assertFalse(self.writer.transport.producerPaused)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_resume_when_empty(self):
+        """Twisted resuming us on an empty buffer stops the checks."""
+        self.pause()
+
+        self.producer.resumeProducing()
+        self.assertEqual(self.reader.transport.producerState, 'producing')
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_close(self):
+        """Closing the connection stops the checks."""
+        self.writer.transport.registerProducer(self.producer, True)
+        self.writer.producer = self.producer
+        self.pause()
+
+        self.writer.close()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class SlowReader(protocol.Protocol):
+    """Doesn't read anything until told to."""
+
+    def connectionMade(self):
+        self.received = 0
+        self.done = defer.Deferred()
+        self.lost = defer.Deferred()
+        self.transport.pauseProducing()
+        self.factory.readers.append(self)
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.received == self.factory.total:
+            self.done.callback(None)
+
+    def connectionLost(self, reason):
+        self.lost.callback(None)
+
+@implementer(interfaces.IPushProducer)
+class FastWriter(protocol.Protocol):
+    """Sends 'total' bytes as fast as its connection takes them."""
+
+    chunk = "A" * 65536
+
+    def connectionMade(self):
+        self.sent = 0
+        self.paused = False
+        self.transport.registerProducer(self, True)
+
+    def produce(self):
+        while (not self.paused) and (self.sent < self.total):
+            self.sent += len(self.chunk)
+            self.transport.write(self.chunk)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.produce()
+
+    def stopProducing(self):
+        self.paused = True
+
+def get_rss():
+    """Return our resident set size in bytes, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError):
+        return None
+
+class testFlowControl(twisted.trial.unittest.TestCase):
+    timeout = 60
+
+    # Far more than the kernel buffers of the connections can hold.
+    total = 64 * 1024 * 1024
+
+    def listen(self, factory):
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        return port.getHost().port
+
+    @defer.inlineCallbacks
+    def stall(self):
+        """
+        Connect a FastWriter through a StaticDestination proxy to a
+        SlowReader, and wait until the writer is stuck. Return the
+        writer, the reader and our RSS before the transfer.
+        """
+        sink = protocol.ServerFactory()
+        sink.protocol = SlowReader
+        sink.readers = []
+        sink.total = self.total
+
+        proxy_port = self.listen(network.StaticDestinationServerFactory(
+            ('127.0.0.1', self.listen(sink)), 'server', dummy.DummyServer,
+            transport_config.TransportConfig()))
+
+        rss = get_rss()
+        writer = yield protocol.ClientCreator(reactor, FastWriter).connectTCP(
+            '127.0.0.1', proxy_port)
+        writer.total = self.total
+        writer.produce()
+        self.addCleanup(writer.transport.loseConnection)
+
+        sent = -1
+        while sent != writer.sent:
+            sent = writer.sent
+            yield task.deferLater(reactor, 0.5, lambda: None)
+        self.assertTrue(writer.sent < self.total)
+
+        reader, = sink.readers
+        self.addCleanup(reader.transport.loseConnection)
+        defer.returnValue((writer, reader, rss))
+
+    @defer.inlineCallbacks
+    def test_slow_reader(self):
+        """A slow reader behind a fast writer doesn't make us buffer everything."""
+        writer, reader, rss = yield self.stall()
+
+        conns = [conn for conn in metrics.registry.connections
+                 if isinstance(conn, network.StaticDestinationProtocol) and not conn.closed]
+        self.assertEqual(len(conns), 2)
+        for conn in conns:
+            self.assertTrue(network.buffered_bytes(conn.transport) <=
+                            network.FLOW_CONTROL_HIGH_WATER + network.WRITE_COALESCING_MAX_BYTES)
+        if rss is not None:
+            self.assertTrue(get_rss() - rss < 8 * network.FLOW_CONTROL_HIGH_WATER)
+
+        # Once the reader catches up, everything gets through.
+        reader.transport.resumeProducing()
+        yield reader.done
+
+    @defer.inlineCallbacks
+    def test_close_while_paused(self):
+        """Circuits torn down under backpressure still close both sides."""
+        writer, reader, _ = yield self.stall()
+
+        circuit, = set(conn.circuit for conn in metrics.registry.connections
+                       if isinstance(conn, network.StaticDestinationProtocol)
+                       and not conn.closed)
+        circuit.close(side='downstream')
+
+        reader.transport.resumeProducing()
+        yield reader.lost
+        self.assertTrue(reader.received < self.total)
@@ -1,7 +1,9 @@
 import unittest
-import time
 
 import obfsproxy.transports.obfs3_dh as obfs3_dh
+import obfsproxy.common.modexp as modexp
+import obfsproxy.common.rand as rand
+import obfsproxy.test.benchmark as benchmark
 import twisted.trial.unittest
 from twisted.python import log
 
@@ -118,18 +120,112 @@ class testUniformDH_KAT(twisted.trial.unittest.TestCase):
         self.assertEqual(self._xYyX_str,  xY)
         self.assertEqual(self._xYyX_str,  yX)
 
+class testFixedBaseTable(twisted.trial.unittest.TestCase):
+    def test_matches_powmod(self):
+        mod = obfs3_dh.UniformDH.mod
+        exps = [0, 1, 2, 31, 32, mod - 1, (1 << 1536) - 1]
+        exps += [long(rand.random_bytes(192).encode('hex'), 16) for _ in range(20)]
+
+        for exp in exps:
+            self.assertEqual(modexp.powModFixedBase(2, exp, mod),
+                             modexp.powMod(2, exp, mod))
+
+    def test_small_group(self):
+        table = modexp.FixedBaseTable(3, 1019, 10, window=3)
+        for exp in range(1024):
+            self.assertEqual(table.pow(exp), pow(3, exp, 1019))
+
+        self.assertRaises(ValueError, table.pow, 1024)
+        self.assertRaises(ValueError, table.pow, -1)
+
+class testKeypairPool(twisted.trial.unittest.TestCase):
+    def test_miss_triggers_refill(self):
+        pool = obfs3_dh.KeypairPool(size=4, low_water=2)
+
+        # The pool starts out empty: the keypair is generated inline and a
+        # refill gets kicked off.
+        pool.get()
+        self.assertEqual(pool.misses, 1)
+        self.assertTrue(pool.refilling)
+
+        # A second refill must not be started while one is running.
+        self.assertEqual(pool.refill(), None)
+
+    def test_hits(self):
+        pool = obfs3_dh.KeypairPool(size=4, low_water=0)
+        d = pool.refill()
+
+        def refilled(_):
+            self.assertEqual(len(pool.keypairs), 4)
+
+            pubs = set()
+            for _ in range(4):
+                pubs.add(pool.get().get_public())
+            self.assertEqual(pool.hits, 4)
+            self.assertEqual(pool.misses, 0)
+            self.assertEqual(len(pubs), 4) # No keypair is handed out twice.
+
+        return d.addCallback(refilled)
+
+    def test_disabled(self):
+        pool = obfs3_dh.KeypairPool(size=0)
+        pool.get()
+        self.assertEqual(pool.misses, 1)
+        self.assertFalse(pool.refilling)
+        self.assertEqual(pool.refill(), None)
+
+    def test_configure(self):
+        pool = obfs3_dh.KeypairPool(size=8)
+        self.assertEqual(pool.low_water, 2)
+        self.assertRaises(ValueError, pool.configure, -1)
+        self.assertRaises(ValueError, pool.configure, 4, 5)
+
+        pool.keypairs.extend([obfs3_dh.UniformDH() for _ in range(3)])
+        pool.configure(1)
+        self.assertEqual(len(pool.keypairs), 1)
+
+    def test_stats(self):
+        pool = obfs3_dh.KeypairPool(size=2, low_water=0)
+        d = pool.refill()
+
+        def check(_):
+            stats = pool.get_stats()
+            self.assertEqual(stats['available'], 2)
+            self.assertEqual(stats['refills'], 1)
+            self.assertTrue(stats['refill_latency_per_key'] > 0)
+
+        return d.addCallback(check)
+
+@benchmark.skip_unless_enabled
 class testUniformDH_Benchmark(twisted.trial.unittest.TestCase):
     def test_benchmark(self):
-        start = time.clock()
+        start = benchmark.timer()
         for i in range(0, 1000):
             dh_x = obfs3_dh.UniformDH()
             dh_y = obfs3_dh.UniformDH()
             xY = dh_x.get_secret(dh_y.get_public())
             yX = dh_y.get_secret(dh_x.get_public())
             self.assertEqual(xY, yX)
-        end = time.clock()
+        end = benchmark.timer()
         taken = (end - start) / 1000 / 2
         log.msg("Generate + Exchange: %f sec" % taken)
 
+    def test_benchmark_keygen(self):
+        mod = obfs3_dh.UniformDH.mod
+        privs = [long(rand.random_bytes(192).encode('hex'), 16)
+                 for _ in range(200)]
+
+        # Build the table outside of the measurement.
+        modexp.powModFixedBase(2, 1, mod)
+
+        for name, powmod in (("powMod", modexp.powMod),
+                             ("powModFixedBase", modexp.powModFixedBase)):
+            start = benchmark.timer()
+            for priv in privs:
+                powmod(2, priv, mod)
+            taken = benchmark.timer() - start
+            log.msg("Public key generation using %s: %.1f keys/sec" %
+                    (name, len(privs) / taken))
+
 if __name__ == '__main__':
     unittest.main()
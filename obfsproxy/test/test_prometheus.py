@@ -0,0 +1,64 @@
+import obfsproxy.common.heartbeat as heartbeat
+import obfsproxy.common.metrics as metrics
+import obfsproxy.common.prometheus as prometheus
+import twisted.trial.unittest
+from twisted.internet import reactor
+from twisted.web import client
+
+class testPrometheus(twisted.trial.unittest.TestCase):
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        self.patch(metrics, 'registry', self.registry)
+        self.patch(heartbeat, 'heartbeat', heartbeat.Heartbeat())
+
+        obfs3 = self.registry.get('obfs3')
+        obfs3.circuit_opened()
+        obfs3.circuit_opened()
+        obfs3.circuit_closed('transport_error')
+        obfs3.downstream_bytes_in += 1500
+        obfs3.handshake_seconds.observe(0.2)
+
+        self.registry.add_gauge('dh_pool_keypairs', "Pooled keypairs.", lambda: 7)
+        self.registry.merge_report({'transports': {}, 'gauges': {},
+                                    'process_gauges': {'dh_pool_keypairs': 3}}, 1)
+
+    def test_render(self):
+        lines = prometheus.render_metrics().splitlines()
+
+        self.assertIn('# TYPE obfsproxy_circuits_open gauge', lines)
+        self.assertIn('obfsproxy_circuits_open{transport="obfs3"} 1', lines)
+        self.assertIn('obfsproxy_circuits_closed_total{transport="obfs3",reason="transport_error"} 1',
+                      lines)
+        self.assertIn('obfsproxy_bytes_total{transport="obfs3",side="downstream",direction="in"} 1500',
+                      lines)
+        self.assertIn('obfsproxy_handshake_seconds_bucket{transport="obfs3",le="0.1"} 0', lines)
+        self.assertIn('obfsproxy_handshake_seconds_bucket{transport="obfs3",le="0.25"} 1', lines)
+        self.assertIn('obfsproxy_handshake_seconds_bucket{transport="obfs3",le="+Inf"} 1', lines)
+        self.assertIn('obfsproxy_handshake_seconds_count{transport="obfs3"} 1', lines)
+        self.assertIn('obfsproxy_dh_pool_keypairs 7', lines)
+        self.assertIn('obfsproxy_dh_pool_keypairs{worker="1"} 3', lines)
+
+    def test_escape_label_value(self):
+        self.assertEqual(prometheus.format_labels([('a', 'x"y\\z\n')]),
+                         '{a="x\\"y\\\\z\\n"}')
+
+    def test_http(self):
+        port = prometheus.listen(('127.0.0.1', 0))
+        self.addCleanup(port.stopListening)
+
+        agent = client.Agent(reactor)
+        url = "http://127.0.0.1:%d/metrics" % port.getHost().port
+        d = agent.request('GET', url)
+
+        def got_response(response):
+            self.assertEqual(response.code, 200)
+            self.assertEqual(response.headers.getRawHeaders('content-type'),
+                             [prometheus.CONTENT_TYPE])
+            return client.readBody(response)
+
+        def got_body(body):
+            self.assertIn('obfsproxy_circuits_opened_total{transport="obfs3"} 2\n', body)
+
+        d.addCallback(got_response)
+        d.addCallback(got_body)
+        return d
@@ -0,0 +1,90 @@
+import obfsproxy.common.heartbeat as heartbeat
+import obfsproxy.common.transport_config as transport_config
+import obfsproxy.network.workers as workers
+import twisted.trial.unittest
+from twisted.internet import defer, error, protocol, reactor, task
+
+class Echo(protocol.Protocol):
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+class EchoClient(protocol.Protocol):
+    def connectionMade(self):
+        self.factory.connected.callback(self)
+
+    def dataReceived(self, data):
+        self.factory.received += data
+        if self.factory.received == self.factory.expected:
+            self.transport.loseConnection()
+            self.factory.done.callback(self.factory.received)
+
+class testHeartbeatReport(twisted.trial.unittest.TestCase):
+    def test_report_merge(self):
+        worker = heartbeat.Heartbeat()
+        worker.register_connection('10.0.0.1')
+        worker.register_connection('10.0.0.1')
+        worker.register_connection('::1')
+
+        supervisor = heartbeat.Heartbeat()
+        supervisor.register_connection('10.0.0.1')
+        supervisor.merge_report(worker.get_report())
+
+        self.assertEqual(supervisor.n_connections, 4)
+        self.assertEqual(len(supervisor.unique_ips), 2)
+
+        # Reports reset the worker's stats.
+        self.assertEqual(worker.n_connections, 0)
+        self.assertEqual(worker.unique_ips, set())
+
+class testWorkerSupervisor(twisted.trial.unittest.TestCase):
+    N_WORKERS = 2
+
+    def setUp(self):
+        self.echo = reactor.listenTCP(0, protocol.Factory.forProtocol(Echo),
+                                      interface='127.0.0.1')
+        self.supervisor = workers.WorkerSupervisor()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        self.supervisor.stop()
+        while self.supervisor.workers:
+            yield task.deferLater(reactor, 0.1, lambda: None)
+        yield self.echo.stopListening()
+
+    def test_invalid_workers(self):
+        self.assertRaises(ValueError, self.supervisor.configure, -1, {})
+
+    def test_bind_fails(self):
+        self.supervisor.configure(self.N_WORKERS, {'no_log': True})
+        port = self.echo.getHost().port
+        self.assertRaises(error.CannotListenError, self.supervisor.add_listener,
+                          '127.0.0.1', port, 'dummy', 'server', None, None)
+
+    @defer.inlineCallbacks
+    def test_serve(self):
+        pt_config = transport_config.TransportConfig()
+        pt_config.setListenerMode('server')
+        pt_config.setObfsproxyMode('external')
+
+        self.supervisor.configure(self.N_WORKERS, {'no_log': True, 'crypto_workers': 0})
+        host, port = self.supervisor.add_listener('127.0.0.1', 0, 'dummy', 'server',
+                                                  ('127.0.0.1', self.echo.getHost().port),
+                                                  pt_config)
+        self.assertEqual(host, '127.0.0.1')
+
+        # Both workers serve the listening socket. The dummy transport
+        # passes data through, so we talk to the echo server.
+        for n in range(2 * self.N_WORKERS):
+            factory = protocol.ClientFactory.forProtocol(EchoClient)
+            factory.connected = defer.Deferred()
+            factory.done = defer.Deferred()
+            factory.received = ''
+            factory.expected = 'hello %d' % n
+
+            reactor.connectTCP(host, port, factory)
+            client = yield factory.connected
+            client.transport.write(factory.expected)
+            received = yield factory.done
+            self.assertEqual(received, factory.expected)
+
+        self.assertEqual(len(self.supervisor.workers), self.N_WORKERS)
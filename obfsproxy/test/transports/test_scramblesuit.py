@@ -1,17 +1,28 @@
 import unittest
+import twisted.trial.unittest
 
 import os
+import time
+import pickle
+import random
 import base64
 import shutil
 import tempfile
+import logging as stdlogging
+
+import yaml
 
 import Crypto.Hash.SHA256
 import Crypto.Hash.HMAC
 
 import obfsproxy.common.log as logging
+import obfsproxy.common.serialize as pack
+import obfsproxy.common.crypto_backend as crypto_backend
 import obfsproxy.network.buffer as obfs_buf
+import obfsproxy.network.network as network
 import obfsproxy.common.transport_config as transport_config
 import obfsproxy.transports.base as base
+import obfsproxy.test.benchmark as benchmark
 
 import obfsproxy.transports.scramblesuit.state as state
 import obfsproxy.transports.scramblesuit.util as util
@@ -24,7 +35,12 @@ import obfsproxy.transports.scramblesuit.state as state
 import obfsproxy.transports.scramblesuit.ticket as ticket
 import obfsproxy.transports.scramblesuit.packetmorpher as packetmorpher
 import obfsproxy.transports.scramblesuit.probdist as probdist
+import obfsproxy.transports.scramblesuit.replay as replay
 
+from twisted.internet import reactor, defer, task
+from twisted.internet.address import IPv4Address
+from twisted.test import proto_helpers
+from twisted.python import log as twistedlog
 
 # Disable all logging as it would yield plenty of warning and error
 # messages.
@@ -132,6 +148,20 @@ class CryptoTest( unittest.TestCase ):
         self.failUnless(len(mycrypto.HMAC_SHA256_128("x" * \
                         const.SHARED_SECRET_LENGTH, "test")) == 16)
 
+    def test7_KeyedHMAC( self ):
+        key = "x" * const.SHARED_SECRET_LENGTH
+        keyedHMAC = mycrypto.KeyedHMAC(key)
+
+        # The key's state is reused for every message.
+        for msg in ("test", "test2", ""):
+            self.assertEqual(keyedHMAC(msg), mycrypto.HMAC_SHA256_128(key, msg))
+
+        existingHMAC = mycrypto.HMAC_SHA256_128(key, "test" + "2")
+        self.assertEqual(keyedHMAC.findEpoch("test", existingHMAC,
+                                             ["1", "2", "3"]), "2")
+        self.assertEqual(keyedHMAC.findEpoch("test", existingHMAC,
+                                             ["1", "3"]), None)
+
 
 class UniformDHTest( unittest.TestCase ):
 
@@ -199,11 +229,9 @@ class UtilTest( unittest.TestCase ):
 
     def test1_isValidHMAC( self ):
         self.failIf(util.isValidHMAC("A" * const.HMAC_SHA256_128_LENGTH,
-                                     "B" * const.HMAC_SHA256_128_LENGTH,
-                                     "X" * const.SHA256_LENGTH) == True)
+                                     "B" * const.HMAC_SHA256_128_LENGTH) == True)
         self.failIf(util.isValidHMAC("A" * const.HMAC_SHA256_128_LENGTH,
-                                     "A" * const.HMAC_SHA256_128_LENGTH,
-                                     "X" * const.SHA256_LENGTH) == False)
+                                     "A" * const.HMAC_SHA256_128_LENGTH) == False)
 
     def test2_locateMark( self ):
         self.failIf(util.locateMark("D", "ABC") != None)
@@ -239,6 +267,15 @@ class UtilTest( unittest.TestCase ):
         e = util.getEpoch()
         self.failUnless(isinstance(e, basestring))
 
+    def test6_isValidHMACFallback( self ):
+        # Python versions before 2.7.7 fall back to double HMAC verification.
+        doubleHMACKey = util._doubleHMACKey
+        util._doubleHMACKey = "K" * const.SHA256_LENGTH
+        try:
+            self.test1_isValidHMAC()
+        finally:
+            util._doubleHMACKey = doubleHMACKey
+
     def test7_readFromFile( self ):
 
         # Read from non-existant file.
@@ -276,7 +313,38 @@ class StateTest( unittest.TestCase ):
         self.failUnless(self.state.isReplayed(key))
         self.failIf(self.state.isReplayed("B" * const.HMAC_SHA256_128_LENGTH))
 
-    def test4_ioerrorFail( self ):
+    def test4_replaySharedState( self ):
+        # Two processes share the state file; a key registered by one of
+        # them must be a replay for the other one.
+        key = "A" * const.HMAC_SHA256_128_LENGTH
+        self.state.genState()
+        other = state.load()
+
+        self.failUnless(self.state.registerKey(key))
+        self.failUnless(other.isReplayed(key))
+        self.failIf(other.registerKey(key))
+
+    def test5_loadCached( self ):
+        srvState = state.load()
+        self.failUnless(state.load() is srvState)
+
+        # Changes made by another process are picked up.
+        other = state.State()
+        other.genState()
+        self.failUnless(state.load() is srvState)
+        self.assertEqual(srvState.prngSeed, other.prngSeed)
+
+    def test6_atomicWrite( self ):
+        self.state.genState()
+
+        self.state.closingThreshold += 1
+        self.state.writeState()
+        self.assertEqual(state.load().closingThreshold,
+                         self.state.closingThreshold)
+        self.assertEqual(os.listdir(const.STATE_LOCATION).count(
+                         const.SERVER_STATE_FILE + ".tmp"), 0)
+
+    def test7_ioerrorFail( self ):
         def fake_open(name, mode):
             raise IOError()
         self.state.genState()
@@ -292,6 +360,274 @@ class StateTest( unittest.TestCase ):
 
         __builtin__.open = real_open
 
+class TrackerTest( unittest.TestCase ):
+    def setUp( self ):
+        self.tracker = replay.Tracker()
+        self.time = time.time
+
+    def tearDown( self ):
+        time.time = self.time
+
+    def advance( self, epochs ):
+        now = time.time()
+        time.time = lambda: now + epochs * const.EPOCH_GRANULARITY
+
+    def test1_addElement( self ):
+        self.tracker.addElement("A" * 16)
+        self.failUnless(self.tracker.isPresent("A" * 16))
+        self.failIf(self.tracker.isPresent("B" * 16))
+        self.assertRaises(LookupError, self.tracker.addElement, "A" * 16)
+        self.failIf(self.tracker.register("A" * 16))
+        self.failUnless(self.tracker.register("B" * 16))
+        self.assertEqual(len(self.tracker), 2)
+
+    def test2_expiry( self ):
+        self.tracker.addElement("A" * 16)
+
+        # Keys are remembered during the two epochs after the one in which
+        # they were added.
+        self.advance(const.REPLAY_GENERATIONS - 1)
+        self.failUnless(self.tracker.isPresent("A" * 16))
+        self.tracker.addElement("B" * 16)
+
+        self.advance(1)
+        self.failIf(self.tracker.isPresent("A" * 16))
+        self.failUnless(self.tracker.isPresent("B" * 16))
+        self.assertEqual(len(self.tracker.generations), 1)
+
+@benchmark.skip_unless_enabled
+class TrackerBenchmark( unittest.TestCase ):
+
+    def lookups( self, tracker, keys ):
+        start = benchmark.timer()
+        for key in keys:
+            tracker.isPresent(key)
+        return len(keys) / max(benchmark.timer() - start, 1e-6)
+
+    def test_benchmark( self ):
+        for n in (10000, 100000, 1000000):
+            tracker = replay.Tracker()
+            start = benchmark.timer()
+            for i in xrange(n):
+                tracker.addElement(pack.htonl(i) * 4)
+            insertions = n / max(benchmark.timer() - start, 1e-6)
+
+            newSpeed = self.lookups(tracker, [pack.htonl(i) * 4
+                                              for i in xrange(0, n, 100)])
+
+            # The old tracker pruned its whole table on every lookup.
+            legacy = LegacyTracker()
+            legacy.table = dict.fromkeys(set().union(*tracker.generations.values()),
+                                         int(time.time()))
+            oldSpeed = self.lookups(legacy, [pack.htonl(i) * 4
+                                             for i in xrange(0, n, n / 10)])
+
+            twistedlog.msg("Tracker with %d keys: %.0f insertions/s, %.0f "
+                           "lookups/s (was %.1f lookups/s)" %
+                           (n, insertions, newSpeed, oldSpeed))
+
+class LegacyTracker( object ):
+
+    def isPresent( self, element ):
+        now = int(time.time())
+        for key in [key for key, added in self.table.iteritems()
+                    if (now - added) > const.EPOCH_GRANULARITY]:
+            del self.table[key]
+
+        return (element in self.table)
+
+class SharedTrackerTest( unittest.TestCase ):
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+        self.tableFile = os.path.join(self.dir, const.REPLAY_TABLE_FILE)
+        self.tracker = replay.SharedTracker(self.tableFile, slots=8)
+
+    def tearDown( self ):
+        self.tracker.close()
+        shutil.rmtree(self.dir)
+
+    def key( self, n ):
+        # All keys start with the same bytes and hence collide.
+        return "\x00" * 8 + ("%08d" % n)
+
+    def test1_register( self ):
+        self.failUnless(self.tracker.register(self.key(1)))
+        self.failIf(self.tracker.register(self.key(1)))
+        self.failUnless(self.tracker.isPresent(self.key(1)))
+        self.failIf(self.tracker.isPresent(self.key(2)))
+        self.assertRaises(LookupError, self.tracker.addElement, self.key(1))
+
+    def test2_shared( self ):
+        other = replay.SharedTracker(self.tableFile, slots=8)
+        self.tracker.register(self.key(1))
+        self.failUnless(other.isPresent(self.key(1)))
+        self.failIf(other.register(self.key(1)))
+        other.close()
+
+    def test3_full( self ):
+        now = time.time
+        for n in xrange(8):
+            time.time = lambda: now() + n
+            self.failUnless(self.tracker.register(self.key(n)))
+
+        # A full table evicts the oldest key to make room for a new one.
+        try:
+            time.time = lambda: now() + 8
+            self.failUnless(self.tracker.register(self.key(8)))
+            self.failIf(self.tracker.isPresent(self.key(0)))
+            for n in xrange(1, 9):
+                self.failUnless(self.tracker.isPresent(self.key(n)))
+        finally:
+            time.time = now
+
+    def test4_expiry( self ):
+        self.tracker.register(self.key(1))
+        self.tracker.register(self.key(2))
+
+        # Expired slots are reclaimed, and expired keys no longer present.
+        now = time.time
+        time.time = lambda: now() + \
+                            const.REPLAY_GENERATIONS * const.EPOCH_GRANULARITY
+        try:
+            self.failIf(self.tracker.isPresent(self.key(2)))
+            self.failUnless(self.tracker.register(self.key(3)))
+            self.failUnless(self.tracker.register(self.key(2)))
+            self.failIf(self.tracker.isPresent(self.key(1)))
+            self.assertEqual(len(self.tracker), 2)
+        finally:
+            time.time = now
+
+    def test5_len( self ):
+        self.assertEqual(len(self.tracker), 0)
+        for n in xrange(5):
+            self.tracker.register(self.key(n))
+        self.assertEqual(len(self.tracker), 5)
+
+        # The slots are read in chunks.
+        self.tracker.LEN_CHUNK_SLOTS = 3
+        self.assertEqual(len(self.tracker), 5)
+
+    def test6_flood( self ):
+        # Filling the table must not lock out the handshakes which follow.
+        for n in xrange(100):
+            self.tracker.register(mycrypto.strongRandom(16))
+
+        for n in xrange(100):
+            key = mycrypto.strongRandom(16)
+            self.failUnless(self.tracker.register(key))
+            self.failIf(self.tracker.register(key))
+        self.assertEqual(len(self.tracker), 8)
+
+class BloomTrackerTest( unittest.TestCase ):
+    def setUp( self ):
+        self.dir = tempfile.mkdtemp()
+        self.tableFile = os.path.join(self.dir, const.REPLAY_FILTER_FILE)
+        self.tracker = replay.BloomTracker(self.tableFile, rate=1)
+        self.time = time.time
+
+    def tearDown( self ):
+        time.time = self.time
+        self.tracker.close()
+        shutil.rmtree(self.dir)
+
+    def advance( self, epochs ):
+        now = time.time()
+        time.time = lambda: now + epochs * const.EPOCH_GRANULARITY
+
+    def test1_register( self ):
+        key = mycrypto.strongRandom(16)
+        self.failUnless(self.tracker.register(key))
+        self.failIf(self.tracker.register(key))
+        self.failUnless(self.tracker.isPresent(key))
+        self.assertRaises(LookupError, self.tracker.addElement, key)
+
+        other = replay.BloomTracker(self.tableFile, rate=1)
+        self.failUnless(other.isPresent(key))
+        other.close()
+
+    def test6_len( self ):
+        self.assertEqual(len(self.tracker), 0)
+        for _ in xrange(1000):
+            self.tracker.register(mycrypto.strongRandom(16))
+
+        # The number of keys is estimated from the bits which are set.
+        keys = len(self.tracker)
+        self.failUnless(950 <= keys <= 1050)
+
+        self.tracker.LEN_CHUNK_BYTES = 1000
+        self.assertEqual(len(self.tracker), keys)
+
+    def test2_falsePositives( self ):
+        capacity = const.EPOCH_GRANULARITY
+        for _ in xrange(capacity):
+            self.tracker.register(mycrypto.strongRandom(16))
+
+        falsePositives = sum(self.tracker.isPresent(mycrypto.strongRandom(16))
+                             for _ in xrange(10000))
+        self.failUnless(falsePositives <= 2)
+
+    def test3_rotation( self ):
+        key = mycrypto.strongRandom(16)
+        self.tracker.register(key)
+
+        self.advance(const.REPLAY_GENERATIONS - 1)
+        self.failUnless(self.tracker.isPresent(key))
+
+        self.advance(1)
+        self.failIf(self.tracker.isPresent(key))
+        self.failUnless(self.tracker.register(key))
+
+    def test4_memoryUsage( self ):
+        self.assertEqual(os.path.getsize(self.tableFile),
+                         replay.BloomTracker.memoryUsage(1))
+
+        # About 24 bits per key at a false positive rate of 10^-5.
+        perKey = replay.BloomTracker.memoryUsage(1000) * 8.0 / \
+                 (1000 * const.EPOCH_GRANULARITY * const.REPLAY_GENERATIONS)
+        self.failUnless(23 < perKey < 25)
+
+    def test5_state( self ):
+        const.STATE_LOCATION = self.dir
+        const.REPLAY_FILTER_RATE = 1
+        try:
+            srvState = state.State()
+            srvState.genState()
+            self.failUnless(isinstance(srvState.replayTracker,
+                                       replay.BloomTracker))
+            self.failUnless(srvState.registerKey("A" * 16))
+            self.failIf(srvState.registerKey("A" * 16))
+        finally:
+            const.REPLAY_FILTER_RATE = None
+
+@benchmark.skip_unless_enabled
+class BloomTrackerBenchmark( unittest.TestCase ):
+
+    def test_benchmark( self ):
+        n = 100000
+        directory = tempfile.mkdtemp()
+        try:
+            tracker = replay.BloomTracker(os.path.join(directory, "filter"),
+                                          rate=float(n) /
+                                          const.EPOCH_GRANULARITY)
+            keys = [mycrypto.strongRandom(16) for _ in xrange(n)]
+
+            start = benchmark.timer()
+            for key in keys:
+                tracker.register(key)
+            insertions = n / max(benchmark.timer() - start, 1e-6)
+
+            start = benchmark.timer()
+            for key in keys[:10000]:
+                tracker.isPresent(key)
+            lookups = 10000 / max(benchmark.timer() - start, 1e-6)
+
+            twistedlog.msg("BloomTracker with %d keys: %d bytes, %.0f "
+                           "insertions/s, %.0f lookups/s" %
+                           (n, tracker.size, insertions, lookups))
+            tracker.close()
+        finally:
+            shutil.rmtree(directory)
+
 class MockArgs( object ):
     uniformDHSecret = sharedSecret = ext_cookie_file = dest = None
     mode = 'socks'
@@ -351,6 +687,26 @@ class ScrambleSuitTransportTest( unittest.TestCase ):
         self.failUnless("password" in options)
         self.failUnless(options["password"] == "3X5BIA2MIHLZ55UV4VAEGKZIQPPZ4QT3")
 
+    def test4_replayFilterRate( self ):
+        self.assertEqual(scramblesuit.parseReplayFilterRate("2.5", ValueError),
+                         2.5)
+
+        self.args.uniformDHSecret = self.validSecret
+        for rate in (0.0, -1.0, float("nan"), float("inf")):
+            self.args.replayFilterRate = rate
+            with self.assertRaises( base.PluggableTransportError ):
+                self.suit.validate_external_mode_cli( self.args )
+
+    def test5_replayTableSlots( self ):
+        self.assertEqual(scramblesuit.parseReplayTableSlots("1024", ValueError),
+                         1024)
+
+        self.args.uniformDHSecret = self.validSecret
+        for slots in (0, -1):
+            self.args.replayTableSlots = slots
+            with self.assertRaises( base.PluggableTransportError ):
+                self.suit.validate_external_mode_cli( self.args )
+
 class MessageTest( unittest.TestCase ):
 
     def test1_createProtocolMessages( self ):
@@ -389,6 +745,191 @@ class MessageTest( unittest.TestCase ):
         self.assertRaises(base.PluggableTransportError,
                           message.ProtocolMessage, "1", paddingLen=const.MPU)
 
+    def test5_extract( self ):
+        sendCrypter = mycrypto.PayloadCrypter()
+        sendCrypter.setSessionKey("A" * 32, "A" * 8)
+        recvCrypter = mycrypto.PayloadCrypter()
+        recvCrypter.setSessionKey("A" * 32, "A" * 8)
+        hmacKey = "B" * 32
+
+        payloads = ["", "X" * const.MPU, "foo", "Y" * 1000]
+        blurb = ""
+        for payload in payloads:
+            msg = message.new(payload, paddingLen=min(len(payload) % 7,
+                                              const.MPU - len(payload)))
+            blurb += msg.encryptAndHMAC(sendCrypter, hmacKey)
+
+        # Feed the stream in odd-sized pieces to hit all partial states.
+        extractor = message.MessageExtractor()
+        msgs = []
+        for i in xrange(0, len(blurb), 333):
+            msgs += extractor.extract(blurb[i:i + 333], recvCrypter, hmacKey)
+
+        self.assertEqual([msg.payload for msg in msgs], payloads)
+        self.assertEqual(extractor.recvBuf, "")
+
+    def test6_extractInvalidHMAC( self ):
+        sendCrypter = mycrypto.PayloadCrypter()
+        sendCrypter.setSessionKey("A" * 32, "A" * 8)
+        recvCrypter = mycrypto.PayloadCrypter()
+        recvCrypter.setSessionKey("A" * 32, "A" * 8)
+
+        blurb = message.new("foo").encryptAndHMAC(sendCrypter, "B" * 32)
+        blurb = chr(ord(blurb[0]) ^ 1) + blurb[1:]
+
+        self.assertRaises(base.PluggableTransportError,
+                          message.MessageExtractor().extract, blurb,
+                          recvCrypter, "B" * 32)
+
+    def test7_createBlurb( self ):
+        hmacKey = "B" * 32
+
+        for dataLen in (0, 1, 50, const.MPU - 1, const.MPU, const.MPU + 1,
+                        3 * const.MPU, 100000):
+            data = os.urandom(dataLen)
+
+            crypter1 = mycrypto.PayloadCrypter()
+            crypter1.setSessionKey("A" * 32, "A" * 8)
+            crypter2 = mycrypto.PayloadCrypter()
+            crypter2.setSessionKey("A" * 32, "A" * 8)
+
+            expected = "".join([msg.encryptAndHMAC(crypter1, hmacKey) for msg
+                        in message.createProtocolMessages(data,
+                                                  const.FLAG_NEW_TICKET)])
+            blurb = message.createBlurb(data, crypter2, hmacKey,
+                                        const.FLAG_NEW_TICKET)
+
+            self.assertEqual(blurb, expected)
+
+            # The crypters must be in the same state afterwards.
+            self.assertEqual(crypter1.encrypt("X"), crypter2.encrypt("X"))
+
+    def test8_createPadding( self ):
+        hmacKey = "B" * 32
+
+        for lengths in ([const.HDR_LENGTH], [100], [const.MTU],
+                        [700, const.MTU - 100]):
+            crypter1 = mycrypto.PayloadCrypter()
+            crypter1.setSessionKey("A" * 32, "A" * 8)
+            crypter2 = mycrypto.PayloadCrypter()
+            crypter2.setSessionKey("A" * 32, "A" * 8)
+
+            expected = "".join([message.new("", paddingLen=length -
+                                const.HDR_LENGTH).encryptAndHMAC(crypter1,
+                                                                 hmacKey)
+                                for length in lengths])
+            padding = message.createPadding(lengths, crypter2, hmacKey)
+
+            self.assertEqual(padding, expected)
+            self.assertEqual(crypter1.encrypt("X"), crypter2.encrypt("X"))
+
+        self.assertRaises(base.PluggableTransportError, message.createPadding,
+                          [const.HDR_LENGTH - 1], crypter2, hmacKey)
+
+def legacyExtract( extractor, data, aes, hmacKey ):
+    """
+    The message extractor as it was before it became offset-based.  Only
+    used as a baseline by the benchmark below.
+    """
+
+    extractor.recvBuf += data
+    msgs = []
+
+    while len(extractor.recvBuf) >= const.HDR_LENGTH:
+
+        if extractor.totalLen == extractor.payloadLen == extractor.flags == None:
+            extractor.totalLen = pack.ntohs(aes.decrypt(extractor.recvBuf[16:18]))
+            extractor.payloadLen = pack.ntohs(aes.decrypt(extractor.recvBuf[18:20]))
+            extractor.flags = ord(aes.decrypt(extractor.recvBuf[20]))
+
+        if (len(extractor.recvBuf) - const.HDR_LENGTH) < extractor.totalLen:
+            break
+
+        rcvdHMAC = extractor.recvBuf[0:const.HMAC_SHA256_128_LENGTH]
+        vrfyHMAC = mycrypto.HMAC_SHA256_128(hmacKey,
+                          extractor.recvBuf[const.HMAC_SHA256_128_LENGTH:
+                          (extractor.totalLen + const.HDR_LENGTH)])
+        assert rcvdHMAC == vrfyHMAC
+
+        extracted = aes.decrypt(extractor.recvBuf[const.HDR_LENGTH:
+                     (extractor.totalLen + const.HDR_LENGTH)])[:extractor.payloadLen]
+        msgs.append(message.ProtocolMessage(payload=extracted,
+                                            flags=extractor.flags))
+        extractor.recvBuf = extractor.recvBuf[const.HDR_LENGTH +
+                                              extractor.totalLen:]
+
+        extractor.totalLen = extractor.payloadLen = extractor.flags = None
+
+    return msgs
+
+@benchmark.skip_unless_enabled
+class MessageExtractorBenchmark( unittest.TestCase ):
+
+    def throughput( self, extract, blurb, reads=65536 ):
+        crypter = mycrypto.PayloadCrypter()
+        crypter.setSessionKey("A" * 32, "A" * 8)
+        extractor = message.MessageExtractor()
+
+        start = benchmark.timer()
+        payload = 0
+        for i in xrange(0, len(blurb), reads):
+            for msg in extract(extractor, blurb[i:i + reads], crypter,
+                               "B" * 32):
+                payload += len(msg.payload)
+        taken = benchmark.timer() - start
+
+        return payload, (len(blurb) / (1024.0 * 1024.0)) / max(taken, 1e-6)
+
+    def test_benchmark( self ):
+        crypter = mycrypto.PayloadCrypter()
+        crypter.setSessionKey("A" * 32, "A" * 8)
+        blurb = "".join([message.new("X" * const.MPU).encryptAndHMAC(
+                         crypter, "B" * 32) for _ in xrange(2000)])
+
+        for reads in (16384, 65536, 1024 * 1024):
+            newPayload, newSpeed = self.throughput(
+                    message.MessageExtractor.extract, blurb, reads)
+            oldPayload, oldSpeed = self.throughput(legacyExtract, blurb,
+                                                   reads)
+
+            self.assertEqual(newPayload, oldPayload)
+            twistedlog.msg("MessageExtractor with %d-byte reads: %.1f MB/s "
+                           "(was %.1f MB/s)" % (reads, newSpeed, oldSpeed))
+
+@benchmark.skip_unless_enabled
+class KeyedHMACBenchmark( unittest.TestCase ):
+
+    def messagesPerSecond( self, hmacKey, size, n=20000 ):
+        sender = mycrypto.PayloadCrypter()
+        sender.setSessionKey("A" * 32, "A" * 8)
+        receiver = mycrypto.PayloadCrypter()
+        receiver.setSessionKey("A" * 32, "A" * 8)
+        extractor = message.MessageExtractor()
+        data = "X" * size
+
+        start = benchmark.timer()
+        for _ in xrange(n):
+            blurb = message.createBlurb(data, sender, hmacKey)
+            msgs = extractor.extract(blurb, receiver, hmacKey)
+        taken = max(benchmark.timer() - start, 1e-6)
+
+        self.assertEqual(msgs[0].payload, data)
+
+        return n / taken
+
+    def test_benchmark( self ):
+        key = "B" * 32
+
+        for size in (0, 100, const.MPU):
+            # A raw key is set up again for every message, which is what
+            # happened before the transport kept keyed HMACs.
+            oldSpeed = self.messagesPerSecond(key, size)
+            newSpeed = self.messagesPerSecond(mycrypto.KeyedHMAC(key), size)
+
+            twistedlog.msg("Sending and receiving %d-byte messages: %.0f "
+                           "messages/s (was %.0f messages/s)" %
+                           (size, newSpeed, oldSpeed))
+
 class TicketTest( unittest.TestCase ):
     def setUp( self ):
         const.STATE_LOCATION = tempfile.mkdtemp()
@@ -430,6 +971,714 @@ class TicketTest( unittest.TestCase ):
             else:
                 self.assertTrue(ss.receiveTicket(buf))
 
+@benchmark.skip_unless_enabled
+class TicketBenchmark( unittest.TestCase ):
+    def setUp( self ):
+        const.STATE_LOCATION = tempfile.mkdtemp()
+        self.state = state.State()
+        self.state.genState()
+        self.state.replayTracker = replay.Tracker()
+
+        # A client transport doesn't load the server's state file.
+        client = scramblesuit.ScrambleSuitClient
+        client.weAreClient, client.weAreServer = True, False
+        client.weAreExternal = False
+        self.ss = client()
+        self.ss.srvState = self.state
+
+    def tearDown( self ):
+        for attr in ("weAreClient", "weAreServer", "weAreExternal"):
+            delattr(scramblesuit.ScrambleSuitClient, attr)
+        crypto_backend.hmac_backend = crypto_backend.HMAC_BACKENDS[0]
+        shutil.rmtree(const.STATE_LOCATION)
+
+    def ticketMessages( self, n ):
+        messages = []
+        for _ in xrange(n):
+            blurb = ticket.issueTicketAndKey(self.state)
+            self.ss.deriveSecrets(blurb[:const.MASTER_KEY_LENGTH])
+            messages.append(ticket.createTicketMessage(
+                blurb[const.MASTER_KEY_LENGTH:], self.ss.recvHMAC))
+        return messages
+
+    def verify( self, ticketMsg ):
+        buf = obfs_buf.Buffer()
+        buf.write(ticketMsg)
+        self.ss.decryptedTicket = False
+        self.assertTrue(self.ss.receiveTicket(buf))
+
+    def reject( self, ticketMsg ):
+        self.assertEqual(ticket.decrypt(ticketMsg[:const.TICKET_LENGTH],
+                                        self.state), None)
+
+    def legacyIsValidHMAC( self, hmac1, hmac2, key ):
+        return mycrypto.HMAC_SHA256_128(key, hmac1) == \
+               mycrypto.HMAC_SHA256_128(key, hmac2)
+
+    def legacyDecrypt( self, rawTicket, hmacKey ):
+        hmac = crypto_backend.hmac_sha256_digest(hmacKey, rawTicket[0:80])
+        return self.legacyIsValidHMAC(hmac, rawTicket[80:], hmacKey)
+
+    def legacyReject( self, ticketMsg ):
+        rawTicket = ticketMsg[:const.TICKET_LENGTH]
+        self.assertFalse(self.legacyDecrypt(rawTicket, self.state.hmacKey))
+        self.assertFalse(self.legacyDecrypt(rawTicket, self.state.oldHmacKey))
+
+    def legacyVerify( self, ticketMsg ):
+        # What `ticket.decrypt()' and `receiveTicket()' used to do.
+        rawTicket = ticketMsg[:const.TICKET_LENGTH]
+        self.assertTrue(self.legacyDecrypt(rawTicket, self.state.hmacKey))
+        plainTicket = crypto_backend.aes_cbc_decrypt(self.state.aesKey,
+                                                     rawTicket[0:16],
+                                                     rawTicket[16:80])
+        self.ss.deriveSecrets(plainTicket[22:54])
+
+        mark = mycrypto.HMAC_SHA256_128(self.ss.recvHMAC, rawTicket)
+        index = util.locateMark(mark, ticketMsg)
+        existingHMAC = ticketMsg[index + const.MARK_LENGTH:
+                                 index + const.MARK_LENGTH +
+                                 const.HMAC_SHA256_128_LENGTH]
+        for epoch in util.expandedEpoch():
+            myHMAC = mycrypto.HMAC_SHA256_128(self.ss.recvHMAC,
+                        ticketMsg[0:index + const.MARK_LENGTH] + epoch)
+            if self.legacyIsValidHMAC(myHMAC, existingHMAC, self.ss.recvHMAC):
+                return
+        self.fail()
+
+    def measure( self, verify, messages ):
+        counter = CountingHMAC(crypto_backend.HMAC_BACKENDS[0])
+        crypto_backend.hmac_backend = counter
+        ticket._ticketHMACs.clear()
+        start = benchmark.timer()
+        for ticketMsg in messages:
+            verify(ticketMsg)
+        elapsed = max(benchmark.timer() - start, 1e-6)
+        crypto_backend.hmac_backend = crypto_backend.HMAC_BACKENDS[0]
+        return (len(messages) / elapsed,
+                float(counter.hmacs) / len(messages),
+                float(counter.keys) / len(messages))
+
+    def test_benchmark( self ):
+        messages = self.ticketMessages(2000)
+
+        # Both include the five HMACs of the session key derivation.
+        old = self.measure(self.legacyVerify, messages)
+        new = self.measure(self.verify, messages)
+        self.failUnless(new[1] < old[1])
+
+        twistedlog.msg("Ticket verification: %.0f tickets/s, %.1f HMACs and "
+                       "%.1f key setups per ticket (was %.0f tickets/s, %.1f "
+                       "HMACs and %.1f key setups)" % (new + old))
+
+        # Bogus tickets are checked against the current and the old key.
+        self.state.oldHmacKey = mycrypto.strongRandom(
+                                    const.TICKET_HMAC_KEY_LENGTH)
+        bogus = [mycrypto.strongRandom(len(ticketMsg))
+                 for ticketMsg in messages]
+
+        old = self.measure(self.legacyReject, bogus)
+        new = self.measure(self.reject, bogus)
+        self.failUnless(new[1] < old[1])
+
+        twistedlog.msg("Bogus ticket rejection: %.0f tickets/s, %.1f HMACs "
+                       "and %.1f key setups per ticket (was %.0f tickets/s, "
+                       "%.1f HMACs and %.1f key setups)" % (new + old))
+
+class CountingHMAC( object ):
+
+    name = "counting"
+
+    def __init__( self, backend ):
+        self.backend = backend
+        self.keys = 0
+        self.hmacs = 0
+
+    def hmac_sha256( self, key ):
+        self.keys += 1
+        return CountingHMACContext(self, self.backend.hmac_sha256(key))
+
+class CountingHMACContext( object ):
+
+    def __init__( self, counter, context ):
+        self.counter = counter
+        self.context = context
+
+    def update( self, msg ):
+        self.context.update(msg)
+
+    def copy( self ):
+        return CountingHMACContext(self.counter, self.context.copy())
+
+    def digest( self ):
+        self.counter.hmacs += 1
+        return self.context.digest()
+
+class TicketStoreTest( unittest.TestCase ):
+    def setUp( self ):
+        const.STATE_LOCATION = tempfile.mkdtemp() + "/"
+        self.store = ticket.TicketStore()
+        self.masterKey = "M" * const.MASTER_KEY_LENGTH
+        self.ticket = "T" * const.TICKET_LENGTH
+
+    def tearDown( self ):
+        if self.store.writeCall is not None:
+            self.store.writeCall.cancel()
+        shutil.rmtree(const.STATE_LOCATION)
+
+    def test1_putTake( self ):
+        self.store.put("bridge", self.masterKey, self.ticket)
+        self.assertEqual(self.store.take("bridge"),
+                         (self.masterKey, self.ticket))
+
+        # Tickets are redeemed only once.
+        self.assertEqual(self.store.take("bridge"), None)
+
+    def test2_expired( self ):
+        self.store.put("bridge", self.masterKey, self.ticket)
+        self.store.put("bridge", self.masterKey, "U" * const.TICKET_LENGTH)
+        self.store.tickets["bridge"][0][0] -= const.SESSION_TICKET_LIFETIME + 1
+
+        # The expired ticket is skipped.
+        self.assertEqual(self.store.take("bridge"),
+                         (self.masterKey, "U" * const.TICKET_LENGTH))
+        self.assertEqual(self.store.take("bridge"), None)
+
+    def test3_persistence( self ):
+        self.store.put("bridge", self.masterKey, self.ticket)
+        self.store.write()
+        self.failUnless(os.path.exists(const.STATE_LOCATION +
+                                       const.CLIENT_TICKET_STORE_FILE))
+
+        store = ticket.TicketStore()
+        self.assertEqual(store.take("bridge"), (self.masterKey, self.ticket))
+
+    def test4_importYAML( self ):
+        tickets = {"bridge": [int(time.time()), self.masterKey, self.ticket]}
+        util.writeToFile(yaml.dump(tickets),
+                         const.STATE_LOCATION + const.CLIENT_TICKET_FILE)
+
+        self.assertEqual(self.store.take("bridge"),
+                         (self.masterKey, self.ticket))
+
+    def test5_pool( self ):
+        tickets = ["%d" % n * const.TICKET_LENGTH
+                   for n in xrange(const.TICKET_POOL_SIZE + 1)]
+        for rawTicket in tickets:
+            self.store.put("bridge", self.masterKey, rawTicket)
+
+        # The oldest ticket was dropped and the others are taken in order.
+        for rawTicket in tickets[1:]:
+            self.assertEqual(self.store.take("bridge"),
+                             (self.masterKey, rawTicket))
+        self.assertEqual(self.store.take("bridge"), None)
+
+    def test6_waitForTicket( self ):
+        results = []
+
+        # The first connection runs UniformDH and the second one waits.
+        self.store.acquire("bridge").addCallback(results.append)
+        self.store.acquire("bridge").addCallback(results.append)
+        self.assertEqual(results, [None])
+
+        self.store.put("bridge", self.masterKey, self.ticket)
+        self.assertEqual(results, [None, (self.masterKey, self.ticket)])
+        self.assertEqual(self.store.take("bridge"), None)
+
+        # Without handshakes in progress, a waiting connection runs UniformDH.
+        self.store.acquire("bridge").addCallback(results.append)
+        self.store.release("bridge")
+        self.assertEqual(len(results), 2)
+        self.store.release("bridge")
+        self.assertEqual(results[2:], [None])
+        self.store.release("bridge")
+        self.assertEqual(self.store.pending, {})
+
+class FakeConnection( object ):
+
+    """
+    One end of an in-memory connection between a client and a server
+    transport.
+    """
+
+    def __init__( self, peer ):
+        self.peer = peer
+        self.remote = None
+        self.transport = self
+
+    def getPeer( self ):
+        return self.peer
+
+    def write( self, data ):
+        reactor.callLater(0, self.remote.deliver, data)
+
+    def call_before_flush( self, callback ):
+        callback()
+
+class FakeCircuit( object ):
+
+    """
+    Just enough of a circuit to run a ScrambleSuit transport.
+    """
+
+    def __init__( self, transport, peer ):
+        self.transport = transport
+        self.transport.circuit = self
+        self.downstream = FakeConnection(peer)
+        self.upstream = obfs_buf.Buffer()
+        self.buf = obfs_buf.Buffer()
+        self.closed = False
+
+    def deliver( self, data ):
+        if not self.closed:
+            self.buf.write(data)
+            self.transport.receivedDownstream(self.buf)
+
+    def dataReceived( self, data, conn ):
+        self.transport.receivedDownstream(data)
+
+    def bytes_sent( self, conn, nbytes ):
+        pass
+
+    def handshake_finished( self ):
+        pass
+
+    def close( self ):
+        self.closed = True
+        self.transport.circuitDestroyed(None, None)
+
+class ParallelHandshakeTest( twisted.trial.unittest.TestCase ):
+
+    def setUp( self ):
+        self.secret = "S" * const.SHARED_SECRET_LENGTH
+        self.stateDir = tempfile.mkdtemp()
+
+        self.ticketStore = ticket.ticketStore
+        ticket.ticketStore = ticket.TicketStore()
+
+        config = transport_config.TransportConfig()
+        config.setStateLocation(self.stateDir)
+        config.setListenerMode("server")
+        config.setObfsproxyMode("external")
+        scramblesuit.ScrambleSuitServer.uniformDHSecret = self.secret
+        scramblesuit.ScrambleSuitServer.setup(config)
+
+        client = scramblesuit.ScrambleSuitClient
+        client.weAreClient, client.weAreServer = True, False
+        client.weAreExternal = True
+        client.uniformDHSecret = self.secret
+
+        # Count the UniformDH handshakes initiated by clients.
+        self.handshakes = 0
+        self.createHandshake = uniformdh.UniformDH.createHandshake
+        def createHandshake( udh ):
+            if not udh.weAreServer:
+                self.handshakes += 1
+            return self.createHandshake(udh)
+        uniformdh.UniformDH.createHandshake = createHandshake
+
+    def tearDown( self ):
+        uniformdh.UniformDH.createHandshake = self.createHandshake
+
+        if ticket.ticketStore.writeCall is not None:
+            ticket.ticketStore.writeCall.cancel()
+        ticket.ticketStore = self.ticketStore
+
+        for cls in (scramblesuit.ScrambleSuitClient,
+                    scramblesuit.ScrambleSuitServer):
+            for attr in ("weAreClient", "weAreServer", "weAreExternal",
+                         "uniformDHSecret"):
+                if attr in cls.__dict__:
+                    delattr(cls, attr)
+
+        shutil.rmtree(self.stateDir)
+
+    def connect( self, bridge ):
+        client = FakeCircuit(scramblesuit.ScrambleSuitClient(), bridge)
+        server = FakeCircuit(scramblesuit.ScrambleSuitServer(), None)
+        client.downstream.remote, server.downstream.remote = server, client
+        client.transport.circuitConnected()
+        return (client, server)
+
+    def handshakesDone( self, circuits ):
+        """
+        Return a Deferred which fires once all `circuits' are connected and
+        their clients received the server's tickets.
+        """
+
+        def connected( ):
+            return all((client.transport.protoState == const.ST_CONNECTED) and
+                       not client.transport.awaitingTickets and
+                       (client.transport.bridge is not None) and
+                       (server.transport.protoState == const.ST_CONNECTED)
+                       for (client, server) in circuits)
+
+        d = defer.Deferred()
+        def poll( ):
+            if connected():
+                d.callback(None)
+            else:
+                reactor.callLater(0.01, poll)
+        poll()
+
+        return d
+
+    def test1_parallelConnections( self ):
+        """
+        N connections made at once to one bridge do at most one UniformDH
+        handshake, also if N exceeds the tickets issued per handshake.
+        """
+
+        bridge = IPv4Address("TCP", "192.0.2.1", 443)
+        circuits = [self.connect(bridge)
+                    for _ in xrange(2 * const.TICKETS_PER_HANDSHAKE)]
+
+        d = self.handshakesDone(circuits)
+
+        def check( _ ):
+            self.assertEqual(self.handshakes, 1)
+            self.assertEqual(ticket.ticketStore.pending, {})
+
+            # Payload flows over the ticket-based connections.
+            client, server = circuits[-1]
+            data = obfs_buf.Buffer()
+            data.write("Hello")
+            client.transport.receivedUpstream(data)
+            return task.deferLater(reactor, 0.1, lambda: server.upstream.read())
+        d.addCallback(check)
+        d.addCallback(self.assertEqual, "Hello")
+
+        return d
+
+    @defer.inlineCallbacks
+    def test3_refillPool( self ):
+        """
+        Redeeming tickets refills a pool which lost tickets.
+        """
+
+        bridge = IPv4Address("TCP", "192.0.2.1", 443)
+        yield self.handshakesDone([self.connect(bridge)])
+        self.assertEqual(len(ticket.ticketStore.tickets[str(bridge)]),
+                         const.TICKET_POOL_SIZE)
+
+        # Lose all tickets but one.
+        del ticket.ticketStore.tickets[str(bridge)][1:]
+
+        for _ in xrange(const.TICKET_POOL_SIZE):
+            yield self.handshakesDone([self.connect(bridge)])
+
+        self.assertEqual(self.handshakes, 1)
+        self.assertEqual(len(ticket.ticketStore.tickets[str(bridge)]),
+                         const.TICKET_POOL_SIZE)
+
+    def test2_finishFailed( self ):
+        """
+        An error while finishing the UniformDH handshake closes the circuit.
+        """
+
+        def sendTicketAndSeed( transport, numTickets=1 ):
+            raise IOError("Connection is gone.")
+        self.patch(scramblesuit.ScrambleSuitServer, "sendTicketAndSeed",
+                   sendTicketAndSeed)
+
+        client, server = self.connect(IPv4Address("TCP", "192.0.2.1", 443))
+
+        d = defer.Deferred()
+        def poll( ):
+            if server.closed:
+                # Drop the server's data which is still being delivered.
+                client.close()
+                reactor.callLater(0, d.callback, None)
+            else:
+                reactor.callLater(0.01, poll)
+        poll()
+
+        return d
+
+class BurstPaddingTest( twisted.trial.unittest.TestCase ):
+
+    def setUp( self ):
+        self.clock = task.Clock()
+        self.patch(network, "reactor", self.clock)
+        self.patch(network, "write_coalescing_delay", 0)
+        self.patch(const, "USE_IAT_OBFUSCATION", False)
+
+        client = scramblesuit.ScrambleSuitClient
+        client.weAreClient, client.weAreServer = True, False
+        client.weAreExternal = False
+
+        # The receiver derives the same keys, but as server.
+        masterKey = "M" * const.MASTER_KEY_LENGTH
+        self.sender = client()
+        self.sender.deriveSecrets(masterKey)
+        self.receiver = client()
+        self.receiver.weAreServer = True
+        self.receiver.deriveSecrets(masterKey)
+
+        circuit = FakeCircuit(self.sender, None)
+        circuit.downstream = network.GenericProtocol(circuit)
+        circuit.downstream.name = "downstream"
+        circuit.downstream.transport = proto_helpers.StringTransport()
+        self.wire = circuit.downstream.transport
+
+        # The burst lengths the packet morpher is asked to pad.
+        self.burstLengths = []
+        getPadding = self.sender.pktMorpher.getPadding
+        def countingGetPadding( sendCrypter, sendHMAC, dataLen ):
+            self.burstLengths.append(dataLen)
+            return getPadding(sendCrypter, sendHMAC, dataLen)
+        self.sender.pktMorpher.getPadding = countingGetPadding
+
+    def tearDown( self ):
+        client = scramblesuit.ScrambleSuitClient
+        for attr in ("weAreClient", "weAreServer", "weAreExternal"):
+            if attr in client.__dict__:
+                delattr(client, attr)
+
+    def burst( self, payloads ):
+        """
+        Send `payloads' in one reactor turn and return the protocol messages
+        which reached the wire.
+        """
+
+        for data in payloads:
+            self.sender.sendRemote(data)
+        self.assertEqual(self.wire.value(), "")
+
+        self.clock.advance(0)
+        wire = self.wire.value()
+        self.wire.clear()
+
+        return wire, message.MessageExtractor().extract(
+            wire, self.receiver.recvCrypter, self.receiver.recvKeyedHMAC)
+
+    def test1_onePaddingPerBurst( self ):
+        payloads = ["foo", "bar" * 100, "baz"]
+        wire, msgs = self.burst(payloads)
+
+        # The payload comes first, followed by the padding of the whole burst.
+        self.assertEqual([msg.payload for msg in msgs[:3]], payloads)
+        padding = msgs[3:]
+        self.failUnless(1 <= len(padding) <= 2)
+        self.failUnless(all(msg.payloadLen == 0 for msg in padding))
+
+        burstLen = sum(const.HDR_LENGTH + len(data) for data in payloads)
+        self.assertEqual(self.burstLengths, [burstLen])
+        self.failUnless(const.HDR_LENGTH <= len(wire) - burstLen <
+                        const.MTU + const.HDR_LENGTH)
+
+        # The next turn starts a new burst.
+        wire, msgs = self.burst(["qux"])
+        self.assertEqual(msgs[0].payload, "qux")
+        self.assertEqual(self.burstLengths[1:], [const.HDR_LENGTH + 3])
+
+def legacyRandomSample( dist ):
+    # What `RandProbDist.randomSample()' used to do.
+    rand = random.random()
+
+    for cumulProb, singleton in dist.sampleList:
+        if rand <= cumulProb:
+            return singleton
+
+    return dist.sampleList[-1][1]
+
+class ProbDistTest( unittest.TestCase ):
+
+    def setUp( self ):
+        self.state = random.getstate()
+
+    def tearDown( self ):
+        random.setstate(self.state)
+
+    def test1_sameSamples( self ):
+        # Given the same random numbers, bisecting picks the same singletons.
+        for seed in xrange(50):
+            dist = probdist.new(lambda: random.randint(0, const.MTU),
+                                seed=seed)
+
+            random.seed(seed)
+            expected = [legacyRandomSample(dist) for _ in xrange(1000)]
+
+            random.seed(seed)
+            self.assertEqual([dist.randomSample() for _ in xrange(1000)],
+                             expected)
+
+            random.seed(seed)
+            self.assertEqual(dist.sampleMany(1000), expected)
+
+    def test2_histogram( self ):
+        # Independent draws follow the same distribution.  The bound is far
+        # above the 99.9% quantile of the chi-squared distribution.
+        n = 100000
+        dist = probdist.new(lambda: random.randint(0, const.MTU), seed=1)
+
+        old, new = {}, {}
+        for _ in xrange(n):
+            sample = legacyRandomSample(dist)
+            old[sample] = old.get(sample, 0) + 1
+        for sample in dist.sampleMany(n):
+            new[sample] = new.get(sample, 0) + 1
+
+        chiSquared = sum(float(old.get(k, 0) - new.get(k, 0)) ** 2 /
+                         (old.get(k, 0) + new.get(k, 0))
+                         for k in set(old) | set(new))
+        self.assertTrue(chiSquared < 3 * len(set(old) | set(new)) + 30)
+
+    def test3_pickle( self ):
+        dist = probdist.new(lambda: random.randint(0, const.MTU), seed=2)
+        copy = pickle.loads(pickle.dumps(dist))
+
+        # The sampling tables are not pickled, like in older versions, but
+        # rebuilt when unpickling.
+        self.assertFalse("cumulProbs" in dist.__getstate__())
+        self.assertEqual(copy.cumulProbs, dist.cumulProbs)
+        self.assertEqual(copy.singletons, dist.singletons)
+
+@benchmark.skip_unless_enabled
+class ProbDistBenchmark( unittest.TestCase ):
+
+    def measure( self, dist, n=100000 ):
+        start = benchmark.timer()
+        for _ in xrange(n):
+            legacyRandomSample(dist)
+        oldSpeed = n / max(benchmark.timer() - start, 1e-6)
+
+        start = benchmark.timer()
+        for _ in xrange(n):
+            dist.randomSample()
+        newSpeed = n / max(benchmark.timer() - start, 1e-6)
+
+        start = benchmark.timer()
+        dist.sampleMany(n)
+        manySpeed = n / max(benchmark.timer() - start, 1e-6)
+
+        return (newSpeed, manySpeed, oldSpeed)
+
+    def test_benchmark( self ):
+        # Generated distributions put most of their mass into the first bins,
+        # where the linear scan stops early.
+        dist = probdist.new(lambda: random.randint(0, const.MTU), seed=2)
+        twistedlog.msg("Sampling from %d generated bins: %.0f samples/s, %.0f "
+                       "samples/s in batches (was %.0f samples/s)" %
+                       ((len(dist.sampleList),) + self.measure(dist)))
+
+        # With equally likely bins, the linear scan visits half of them.
+        dist.sampleList = [(float(i + 1) / const.MAX_BINS, i)
+                           for i in xrange(const.MAX_BINS)]
+        dist.prepareSampling()
+        twistedlog.msg("Sampling from %d uniform bins: %.0f samples/s, %.0f "
+                       "samples/s in batches (was %.0f samples/s)" %
+                       ((len(dist.sampleList),) + self.measure(dist)))
+
+def legacyGetPadding( morpher, sendCrypter, sendHMAC, dataLen ):
+    # What `PacketMorpher.getPadding()' used to do.
+    dataLen = dataLen % const.MTU
+    sampleLen = morpher.dist.randomSample()
+    if sampleLen >= dataLen:
+        padLen = sampleLen - dataLen
+    else:
+        padLen = (const.MTU - dataLen) + sampleLen
+    if padLen < const.HDR_LENGTH:
+        padLen += const.MTU
+
+    if padLen > const.MTU:
+        padMsgs = [message.new("", paddingLen=700 - const.HDR_LENGTH),
+                   message.new("", paddingLen=padLen - 700 - \
+                                   const.HDR_LENGTH)]
+    else:
+        padMsgs = [message.new("", paddingLen=padLen - const.HDR_LENGTH)]
+
+    return "".join([msg.encryptAndHMAC(sendCrypter, sendHMAC)
+                    for msg in padMsgs])
+
+@benchmark.skip_unless_enabled
+class PacketMorpherBenchmark( unittest.TestCase ):
+
+    def latency( self, getPadding, hmacKey, n=20000 ):
+        # Time per 50-byte write, as in `ScrambleSuitTransport.sendRemote()'.
+        morpher = packetmorpher.new(probdist.new(lambda: random.randint(
+                                    const.HDR_LENGTH, const.MTU), seed=1))
+        crypter = mycrypto.PayloadCrypter()
+        crypter.setSessionKey("A" * 32, "A" * 8)
+        data = "X" * 50
+
+        start = benchmark.timer()
+        for _ in xrange(n):
+            blurb = message.createBlurb(data, crypter, hmacKey)
+            blurb += getPadding(morpher, crypter, hmacKey, len(blurb))
+        return (benchmark.timer() - start) / n * 1e6
+
+    def test_benchmark( self ):
+        hmacKey = "B" * 32
+
+        # Before, the HMAC key was set up for every message, too.
+        oldLatency = self.latency(legacyGetPadding, hmacKey)
+        newLatency = self.latency(packetmorpher.PacketMorpher.getPadding,
+                                  mycrypto.KeyedHMAC(hmacKey))
+        paddingOnly = self.latency(packetmorpher.PacketMorpher.getPadding,
+                                   mycrypto.KeyedHMAC(hmacKey)) - \
+                      self.latency(lambda *args: "",
+                                   mycrypto.KeyedHMAC(hmacKey))
+
+        twistedlog.msg("50-byte writes: %.1f us per write, %.1f us of which "
+                       "for padding (was %.1f us per write)" %
+                       (newLatency, paddingOnly, oldLatency))
+
+@benchmark.skip_unless_enabled
+class LoggingBenchmark( unittest.TestCase ):
+
+    """
+    Cost of the debug messages logged for every ScrambleSuit message, when
+    running at the `info' level.
+    """
+
+    def setUp( self ):
+        self.level = log.obfslogger.level
+        stdlogging.disable(stdlogging.NOTSET)
+        log.set_log_severity("info")
+
+    def tearDown( self ):
+        log.obfslogger.setLevel(self.level)
+        log.disable_logs()
+
+    def eagerMessage( self, name, n ):
+        # How the messages were logged before.
+        log.debug("%s: upstream: Received %d bytes." % (name, n))
+        log.debug("Processing %d bytes of outgoing data." % n)
+        log.debug("Created %d protocol messages." % 1)
+        log.debug("Morphing the last %d-byte packet to %d bytes by adding %d "
+                  "bytes of padding." % (n, 600, 600 - n))
+        log.debug("%s: Writing %d bytes." % (name, n))
+        log.debug("%s: downstream: Received %d bytes." % (name, n))
+        log.debug("Message header: totalLen=%d, payloadLen=%d, flags"
+                  "=%s" % (n, n, message.getFlagNames(const.FLAG_PAYLOAD)))
+
+    def lazyMessage( self, name, n ):
+        log.debug("%s: upstream: Received %d bytes.", name, n)
+        log.debug("Processing %d bytes of outgoing data.", n)
+        log.debug("Created %d protocol messages.", 1)
+        log.debug("Morphing the last %d-byte packet to %d bytes by adding %d "
+                  "bytes of padding.", n, 600, 600 - n)
+        log.debug("%s: Writing %d bytes.", name, n)
+        log.debug("%s: downstream: Received %d bytes.", name, n)
+        if log.is_enabled_for(logging.DEBUG):
+            log.debug("Message header: totalLen=%d, payloadLen=%d, flags=%s",
+                      n, n, message.getFlagNames(const.FLAG_PAYLOAD))
+
+    def latency( self, logMessage, n=20000 ):
+        name = "conn_%s" % hex(id(self))
+
+        start = benchmark.timer()
+        for i in xrange(n):
+            logMessage(name, i % const.MPU)
+        return (benchmark.timer() - start) / n * 1e6
+
+    def test_benchmark( self ):
+        oldLatency = self.latency(self.eagerMessage)
+        newLatency = self.latency(self.lazyMessage)
+
+        twistedlog.msg("Debug logging at info level: %.1f us per message "
+                       "(was %.1f us per message)" % (newLatency, oldLatency))
+
 class PacketMorpher( unittest.TestCase ):
 
     def test1_calcPadding( self ):
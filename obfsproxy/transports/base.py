@@ -29,6 +29,9 @@ class BaseTransport(object):
     It contains callbacks that your pluggable transports should
     override and customize.
 
+    Transports which perform a handshake call circuit.handshake_finished()
+    once it's done, which measures how long it took.
+
     Attributes:
     circuit: Circuit object. This is set just before circuitConnected is called.
     """
@@ -65,7 +65,7 @@ class Obfs2Transport(base.BaseTransport):
             self.ss_hash_iterations = HASH_ITERATIONS
 
         if self.shared_secret:
-            log.debug("Starting obfs2 with shared secret: %s" % self.shared_secret)
+            log.debug("Starting obfs2 with shared secret: %s", self.shared_secret)
 
         # Our state.
         self.state = ST_WAIT_FOR_KEY
@@ -129,7 +129,7 @@ class Obfs2Transport(base.BaseTransport):
         super(Obfs2Transport, cls).validate_external_mode_cli(args)
 
     def handle_socks_args(self, args):
-        log.debug("obfs2: Got '%s' as SOCKS arguments." % args)
+        log.debug("obfs2: Got '%s' as SOCKS arguments.", args)
 
         # A shared secret might already be set if obfsproxy is in
         # external-mode and both a cli shared-secret was specified
@@ -195,9 +195,9 @@ class Obfs2Transport(base.BaseTransport):
         log_prefix = "obfs2 receivedDownstream" # used in logs
 
         if self.state == ST_WAIT_FOR_KEY:
-            log.debug("%s: Waiting for key." % log_prefix)
+            log.debug("%s: Waiting for key.", log_prefix)
             if len(data) < SEED_LENGTH + 8:
-                log.debug("%s: Not enough bytes for key (%d)." % (log_prefix, len(data)))
+                log.debug("%s: Not enough bytes for key (%d).", log_prefix, len(data))
                 return data # incomplete
 
             if self.we_are_initiator:
@@ -216,8 +216,8 @@ class Obfs2Transport(base.BaseTransport):
             magic = srlz.ntohl(self.recv_padding_crypto.crypt(data.read(4)))
             padding_length = srlz.ntohl(self.recv_padding_crypto.crypt(data.read(4)))
 
-            log.debug("%s: Got %d bytes of handshake data (padding_length: %d, magic: %s)" % \
-                          (log_prefix, len(data), padding_length, hex(magic)))
+            log.debug("%s: Got %d bytes of handshake data (padding_length: %d, magic: %s)",
+                      log_prefix, len(data), padding_length, hex(magic))
 
             if magic != MAGIC_VALUE:
                 raise base.PluggableTransportError("obfs2: Corrupted magic value '%s'" % hex(magic))
@@ -240,11 +240,12 @@ class Obfs2Transport(base.BaseTransport):
                       log_prefix, n_to_drain, self.padding_left_to_read, len(data))
 
         self.state = ST_OPEN
+        self.circuit.handshake_finished()
         log.debug("%s: Processing %d bytes of application data.",
                   log_prefix, len(data))
 
         if self.pending_data_to_send:
-            log.debug("%s: We got pending data to send and our crypto is ready. Pushing!" % log_prefix)
+            log.debug("%s: We got pending data to send and our crypto is ready. Pushing!", log_prefix)
             self.receivedUpstream(self.circuit.upstream.buffer) # XXX touching guts of network.py
             self.pending_data_to_send = False
 
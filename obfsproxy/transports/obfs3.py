@@ -13,8 +13,7 @@ import obfsproxy.transports.obfs3_dh as obfs3_dh
 import obfsproxy.common.log as logging
 import obfsproxy.common.hmac_sha256 as hmac_sha256
 import obfsproxy.common.rand as rand
-
-from twisted.internet import threads
+import obfsproxy.common.crypto_worker as crypto_worker
 
 log = logging.get_obfslogger()
 
@@ -42,7 +41,7 @@ class Obfs3Transport(base.BaseTransport):
         self.state = ST_WAIT_FOR_KEY
 
         # Uniform-DH object
-        self.dh = obfs3_dh.UniformDH()
+        self.dh = obfs3_dh.keypair_pool.get()
 
         # DH shared secret
         self.shared_secret = None
@@ -71,6 +70,15 @@ class Obfs3Transport(base.BaseTransport):
         self.recv_magic_const = None
         self.we_are_initiator = None
 
+    @classmethod
+    def setup(cls, pt_config):
+        """
+        Start the crypto workers and start filling the UniformDH keypair
+        pool before the first connection arrives.
+        """
+        crypto_worker.crypto_worker.start()
+        obfs3_dh.keypair_pool.refill()
+
     def circuitConnected(self):
         """
         Do the obfs3 handshake:
@@ -80,9 +88,9 @@ class Obfs3Transport(base.BaseTransport):
 
         handshake_message = self.dh.get_public() + rand.random_bytes(padding_length)
 
-        log.debug("obfs3 handshake: %s queued %d bytes (padding_length: %d) (public key: %s).",
+        log.debug("obfs3 handshake: %s queued %d bytes (padding_length: %d) (public key: %r).",
                   "initiator" if self.we_are_initiator else "responder",
-                  len(handshake_message), padding_length, repr(self.dh.get_public()))
+                  len(handshake_message), padding_length, self.dh.get_public())
 
         self.circuit.downstream.write(handshake_message)
 
@@ -117,29 +125,30 @@ class Obfs3Transport(base.BaseTransport):
             self._scan_for_magic(data)
 
         if self.state == ST_OPEN: # Handshake is done. Just decrypt and read application data.
-            log.debug("obfs3 receivedDownstream: Processing %d bytes of application data." %
+            log.debug("obfs3 receivedDownstream: Processing %d bytes of application data.",
                       len(data))
             self.circuit.upstream.write(self.recv_crypto.crypt(data.read()))
 
     def _read_handshake(self, data):
         """
         Read handshake message, parse the other peer's public key and
-        schedule the key exchange for execution outside of the event loop.
+        schedule the key exchange for execution in the crypto worker.
         """
 
         log_prefix = "obfs3:_read_handshake()"
         if len(data) < PUBKEY_LEN:
-            log.debug("%s: Not enough bytes for key (%d)." % (log_prefix, len(data)))
+            log.debug("%s: Not enough bytes for key (%d).", log_prefix, len(data))
             return
 
-        log.debug("%s: Got %d bytes of handshake data (waiting for key)." % (log_prefix, len(data)))
+        log.debug("%s: Got %d bytes of handshake data (waiting for key).", log_prefix, len(data))
 
         # Get the public key from the handshake message, do the DH and
         # get the shared secret.
         other_pubkey = data.read(PUBKEY_LEN)
 
         # Do the UniformDH handshake asynchronously
-        self.d = threads.deferToThread(self.dh.get_secret, other_pubkey)
+        self.d = crypto_worker.crypto_worker.compute_shared_secret(self.dh.priv,
+                                                                   other_pubkey)
         self.d.addCallback(self._read_handshake_post_dh, other_pubkey, data)
         self.d.addErrback(self._uniform_dh_errback, other_pubkey)
 
@@ -163,8 +172,8 @@ class Obfs3Transport(base.BaseTransport):
 
         self.shared_secret = shared_secret
         log_prefix = "obfs3:_read_handshake_post_dh()"
-        log.debug("Got public key: %s.\nGot shared secret: %s" %
-                  (repr(other_pubkey), repr(self.shared_secret)))
+        log.debug("Got public key: %r.\nGot shared secret: %r",
+                  other_pubkey, self.shared_secret)
 
         # Set up our crypto.
         self.send_crypto = self._derive_crypto(self.send_keytype)
@@ -180,12 +189,12 @@ class Obfs3Transport(base.BaseTransport):
         message = rand.random_bytes(padding_length) + magic + self.send_crypto.crypt(self.queued_data)
         self.queued_data = ''
 
-        log.debug("%s: Transmitting %d bytes (with magic)." % (log_prefix, len(message)))
+        log.debug("%s: Transmitting %d bytes (with magic).", log_prefix, len(message))
         self.circuit.downstream.write(message)
 
         self.state = ST_SEARCHING_MAGIC
         if len(data) > 0:
-             log.debug("%s: Processing %d bytes of handshake data remaining after key." % (log_prefix, len(data)))
+             log.debug("%s: Processing %d bytes of handshake data remaining after key.", log_prefix, len(data))
              self._scan_for_magic(data)
 
     def _scan_for_magic(self, data):
@@ -195,7 +204,7 @@ class Obfs3Transport(base.BaseTransport):
         """
 
         log_prefix = "obfs3:_scan_for_magic()"
-        log.debug("%s: Searching for magic." % log_prefix)
+        log.debug("%s: Searching for magic.", log_prefix)
 
         assert(self.other_magic_value)
         chunk = data.peek()
@@ -204,16 +213,17 @@ class Obfs3Transport(base.BaseTransport):
         if index < 0:
             if (len(data) > MAX_PADDING+HASHLEN):
                 raise base.PluggableTransportError("obfs3: Too much padding (%d)!" % len(data))
-            log.debug("%s: Did not find magic this time (%d)." % (log_prefix, len(data)))
+            log.debug("%s: Did not find magic this time (%d).", log_prefix, len(data))
             return
 
         index += len(self.other_magic_value)
-        log.debug("%s: Found magic. Draining %d bytes." % (log_prefix, index))
+        log.debug("%s: Found magic. Draining %d bytes.", log_prefix, index)
         data.drain(index)
 
         self.state = ST_OPEN
+        self.circuit.handshake_finished()
         if len(data) > 0:
-            log.debug("%s: Processing %d bytes of application data remaining after magic." % (log_prefix, len(data)))
+            log.debug("%s: Processing %d bytes of application data remaining after magic.", log_prefix, len(data))
             self.circuit.upstream.write(self.recv_crypto.crypt(data.read()))
 
     def _derive_crypto(self, pad_string):
@@ -1,7 +1,18 @@
 import binascii
+import collections
+import time
 
 import obfsproxy.common.rand as rand
 import obfsproxy.common.modexp as modexp
+import obfsproxy.common.log as logging
+import obfsproxy.common.metrics as metrics
+
+from twisted.internet import threads
+
+log = logging.get_obfslogger()
+
+# Default number of keypairs kept in the pool.
+POOL_SIZE = 32
 
 def int_to_bytes(lvalue, width):
     fmt = '%%.%dx' % (2*width)
@@ -60,7 +71,7 @@ class UniformDH:
         #
         # Note: Always generate both valid public keys, and then pick to avoid
         # leaking timing information about which key was chosen.
-        pub = modexp.powMod(self.g, self.priv, self.mod)
+        pub = modexp.powModFixedBase(self.g, self.priv, self.mod)
         pub_p_sub_X = self.mod - pub
         if flip == 1:
             self.pub = pub_p_sub_X
@@ -81,8 +92,158 @@ class UniformDH:
         This might raise a ValueError since 'their_pub_str' is
         attacker controlled.
         """
-        their_pub = int(binascii.hexlify(their_pub_str), 16)
+        secret = compute_shared_secret(self.priv, their_pub_str)
+        self.shared_secret = int(binascii.hexlify(secret), 16)
+        return secret
+
+def compute_shared_secret(priv, their_pub_str):
+    """
+    Given our private key 'priv' as an integer and the public key of the
+    other party as a string of bytes, calculate and return our shared
+    secret as a string of bytes.
+
+    This is a module-level function so that it can be shipped off to
+    the crypto worker processes (see common/crypto_worker.py).
+
+    This might raise a ValueError since 'their_pub_str' is
+    attacker controlled.
+    """
+    their_pub = int(binascii.hexlify(their_pub_str), 16)
+
+    shared_secret = modexp.powMod(their_pub, priv, UniformDH.mod)
+    return int_to_bytes(shared_secret, UniformDH.group_len)
+
+
+class KeypairPool(object):
+    """
+    A bounded pool of ready-to-use UniformDH keypairs.
+
+    Handshakes take a keypair out of the pool using get(), instead of
+    generating one on the spot. When the pool drops below its low-water
+    mark, it is refilled in a thread of the reactor's thread pool.
+    Every keypair is handed out exactly once.
+
+    Attributes:
+    size, the maximum number of pooled keypairs. 0 disables the pool.
+    low_water, the number of pooled keypairs below which we refill.
+
+    hits, the number of keypairs that were served from the pool.
+    misses, the number of keypairs generated inline because the pool
+    was empty.
+    refills, the number of completed refills.
+    refill_time, the total time spent generating keypairs in refills.
+    refill_keys, the total number of keypairs generated in refills.
+    """
+
+    def __init__(self, size=POOL_SIZE, low_water=None):
+        self.keypairs = collections.deque()
+        self.refilling = False
+
+        self.size = 0
+        self.low_water = 0
+        self.configure(size, low_water)
+
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_time = 0.0
+        self.refill_keys = 0
+
+    def configure(self, size, low_water=None):
+        """
+        Set the pool 'size' and its 'low_water' mark. If 'low_water' is
+        not given, it defaults to a quarter of 'size'.
 
-        self.shared_secret = modexp.powMod(their_pub, self.priv, self.mod)
-        return int_to_bytes(self.shared_secret, self.group_len)
+        Throws ValueError if the numbers don't make sense.
+        """
+        if low_water is None:
+            low_water = size / 4
 
+        if (size < 0) or not (0 <= low_water <= size):
+            raise ValueError("Invalid keypair pool size (%d) or low-water "
+                             "mark (%d)." % (size, low_water))
+
+        self.size = size
+        self.low_water = low_water
+
+        while len(self.keypairs) > size:
+            self.keypairs.pop()
+
+    def get(self):
+        """
+        Return a fresh UniformDH object, from the pool if possible.
+        """
+        try:
+            dh = self.keypairs.popleft()
+            self.hits += 1
+        except IndexError:
+            dh = UniformDH()
+            self.misses += 1
+
+        if len(self.keypairs) < self.low_water:
+            self.refill()
+
+        return dh
+
+    def refill(self):
+        """
+        Top up the pool in the background, unless a refill is already
+        running or the pool is full.
+
+        Return a Deferred that fires when the refill is done, or None if
+        no refill was started.
+        """
+        missing = self.size - len(self.keypairs)
+        if self.refilling or (missing <= 0):
+            return None
+
+        self.refilling = True
+        d = threads.deferToThread(self._generate, missing)
+        d.addCallbacks(self._refilled, self._refill_failed)
+        return d
+
+    def _generate(self, n):
+        """Generate 'n' keypairs. Runs in a thread."""
+        start = time.time()
+        keypairs = [UniformDH() for _ in xrange(n)]
+        return keypairs, time.time() - start
+
+    def _refilled(self, result):
+        keypairs, elapsed = result
+        self.refilling = False
+
+        self.refills += 1
+        self.refill_time += elapsed
+        self.refill_keys += len(keypairs)
+
+        # The pool might have been shrunk while we were busy.
+        self.keypairs.extend(keypairs[:self.size - len(self.keypairs)])
+
+        log.debug("Refilled UniformDH keypair pool with %d keypairs in %.3f "
+                  "seconds.", len(keypairs), elapsed)
+
+    def _refill_failed(self, failure):
+        self.refilling = False
+        log.warning("Failed to refill the UniformDH keypair pool: %s",
+                    failure.getErrorMessage())
+
+    def get_stats(self):
+        """
+        Return a dictionary with the pool's statistics.
+        """
+        return {
+            'size': self.size,
+            'available': len(self.keypairs),
+            'hits': self.hits,
+            'misses': self.misses,
+            'refills': self.refills,
+            'refill_latency_per_key': (self.refill_time / self.refill_keys)
+                                      if self.refill_keys else 0.0,
+        }
+
+# The process-wide keypair pool.
+keypair_pool = KeypairPool()
+
+metrics.registry.add_gauge("dh_pool_keypairs",
+                           "UniformDH keypairs available in the keypair pool.",
+                           lambda: len(keypair_pool.keypairs))
@@ -78,6 +78,13 @@ MIN_BINS = 1
 # The maximum amount of distinct bins for probability distributions.
 MAX_BINS = 100
 
+# Batches of at least this many samples are drawn using NumPy, if available.
+# For smaller batches, NumPy's per-call overhead outweighs its speed.
+NUMPY_MIN_SAMPLES = 64
+
+# Number of packet lengths the packet morpher draws at once.
+PADDING_SAMPLES = 128
+
 # Length of a UniformDH public key in bytes.
 PUBLIC_KEY_LENGTH = 192
 
@@ -87,6 +94,39 @@ PRNG_SEED_LENGTH = 32
 # File which holds the server's state information.
 SERVER_STATE_FILE = "server_state.cpickle"
 
+# File which is locked while the server's state file is read or modified.
+SERVER_STATE_LOCK_FILE = "server_state.lock"
+
+# Number of epochs during which authentication HMACs are remembered to detect
+# replays.  A HMAC is accepted during its epoch, the one before and the one
+# after it, so a HMAC seen during epoch `e' may still be valid during `e + 2'.
+REPLAY_GENERATIONS = 3
+
+# Memory-mapped file which holds the server's replay table.
+REPLAY_TABLE_FILE = "replay_table.mmap"
+
+# Number of slots in the replay table.  Every slot takes 20 bytes, and a slot
+# is occupied for up to `REPLAY_GENERATIONS' epochs by every authenticated
+# handshake.  The default holds about 12 handshakes per second at a load factor
+# of one half.  It can be changed with the `replay-table-slots' option.
+REPLAY_TABLE_SLOTS = 2 ** 18
+
+# Maximum number of slots which are probed to look up or add a key.
+REPLAY_TABLE_MAX_PROBES = 64
+
+# Memory-mapped file which holds the server's replay filters, if enabled.
+REPLAY_FILTER_FILE = "replay_filter.mmap"
+
+# Expected maximum rate of authenticated handshakes per second.  If set, replays
+# are detected using Bloom filters sized for this rate instead of the exact
+# replay table.
+REPLAY_FILTER_RATE = None
+
+# False positive rate of a replay filter which holds the keys of one epoch at
+# `REPLAY_FILTER_RATE'.  A false positive makes the server treat a legitimate
+# handshake as replayed.
+REPLAY_FILTER_FP_RATE = 1e-5
+
 # Life time of session tickets in seconds.
 SESSION_TICKET_LIFETIME = KEY_ROTATION_TIME
 
@@ -102,10 +142,34 @@ SHARED_SECRET_LENGTH = 20
 ST_WAIT_FOR_AUTH = 0
 ST_AUTH_FAILED = 1
 ST_CONNECTED = 2
+ST_WAIT_FOR_SECRET = 3
 
-# File which holds the client's session tickets.
+# File which held the client's session tickets in older versions.
 CLIENT_TICKET_FILE = "session_ticket.yaml"
 
+# File which holds the client's session tickets.
+CLIENT_TICKET_STORE_FILE = "session_tickets.json"
+
+# Maximum delay (in seconds) before the client's session tickets are written
+# to disk.
+TICKET_STORE_WRITE_DELAY = 5
+
+# Maximum number of session tickets a client keeps per bridge.
+TICKET_POOL_SIZE = 4
+
+# Number of session tickets the server issues after a UniformDH handshake.
+# Parallel connections to the bridge can then all redeem a ticket.
+TICKETS_PER_HANDSHAKE = TICKET_POOL_SIZE
+
+# Number of session tickets the server issues after a ticket was redeemed.
+# One replaces the redeemed ticket, the others refill a client's pool which
+# lost tickets, e.g., to connections which closed before receiving theirs.
+TICKETS_PER_REDEMPTION = 2
+
+# Maximum time (in seconds) a client connection waits for the session tickets
+# of another connection's handshake before running UniformDH itself.
+TICKET_WAIT_TIMEOUT = 10
+
 # Static validation string embedded in all tickets.  Must be a multiple of 16
 # bytes due to AES' block size.
 TICKET_IDENTIFIER = "ScrambleSuitTicket"
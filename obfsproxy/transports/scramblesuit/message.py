@@ -6,6 +6,8 @@ messages, check message headers for validity and create protocol messages out
 of application data.
 """
 
+import struct
+
 import obfsproxy.common.log as logging
 import obfsproxy.common.serialize as pack
 import obfsproxy.transports.base as base
@@ -25,17 +27,102 @@ def createProtocolMessages( data, flags=const.FLAG_PAYLOAD ):
     the MTU.
     """
 
-    messages = []
+    messages = [ProtocolMessage(data[i:i + const.MPU], flags=flags)
+                for i in xrange(0, len(data), const.MPU)]
+    if not messages:
+        messages.append(ProtocolMessage("", flags=flags))
 
-    while len(data) > const.MPU:
-        messages.append(ProtocolMessage(data[:const.MPU], flags=flags))
-        data = data[const.MPU:]
+    log.debug("Created %d protocol messages.", len(messages))
 
-    messages.append(ProtocolMessage(data, flags=flags))
+    return messages
 
-    log.debug("Created %d protocol messages." % len(messages))
 
-    return messages
+def createBlurb( data, crypter, hmacKey, flags=const.FLAG_PAYLOAD ):
+    """
+    Turn `data' into ready-to-send, encrypted and authenticated messages.
+
+    This is equivalent to calling `encryptAndHMAC()' on each of the protocol
+    messages returned by `createProtocolMessages()' and concatenating the
+    results, but it avoids creating a `ProtocolMessage' object per message.
+    All headers and payloads are laid out in one preallocated buffer which is
+    then encrypted using `crypter' in a single call.  Finally, the HMAC of
+    each message is computed over its part of the ciphertext.
+
+    `hmacKey' is either the HMAC key or a `mycrypto.KeyedHMAC' object for it.
+    Passing the latter saves setting up the key for every call.
+    """
+
+    dataLen = len(data)
+    nMsgs = max(1, (dataLen + const.MPU - 1) // const.MPU)
+    encHdrLen = const.HDR_LENGTH - const.HMAC_SHA256_128_LENGTH
+
+    # Layout: [header | payload] [header | payload] ...
+    plain = bytearray(nMsgs * encHdrLen + dataLen)
+    offset = 0
+    for i in xrange(nMsgs):
+        chunkLen = min(const.MPU, dataLen - (i * const.MPU))
+        struct.pack_into("!hhB", plain, offset, chunkLen, chunkLen, flags)
+        offset += encHdrLen
+        plain[offset:offset + chunkLen] = buffer(data, i * const.MPU,
+                                                 chunkLen)
+        offset += chunkLen
+
+    encrypted = crypter.encrypt(buffer(plain))
+
+    # Prepend every message with the HMAC over its ciphertext.
+    keyedHMAC = mycrypto.toKeyedHMAC(hmacKey)
+    blurbs = []
+    offset = 0
+    for i in xrange(nMsgs):
+        msgLen = encHdrLen + min(const.MPU, dataLen - (i * const.MPU))
+        blurbs.append(keyedHMAC(buffer(encrypted, offset, msgLen)))
+        blurbs.append(encrypted[offset:offset + msgLen])
+        offset += msgLen
+
+    log.debug("Created %d protocol messages.", nMsgs)
+
+    return "".join(blurbs)
+
+
+def createPadding( lengths, crypter, hmacKey ):
+    """
+    Return ready-to-send padding messages with the given on-the-wire `lengths'.
+
+    This is equivalent to encrypting and authenticating empty protocol
+    messages which carry `length - HDR_LENGTH' bytes of padding each, but all
+    messages are laid out in one zero-initialised buffer, so that only the
+    headers have to be filled in.  The buffer is then encrypted using
+    `crypter' in a single call and each message is authenticated using
+    `hmacKey', the key or a `mycrypto.KeyedHMAC' object for it.
+    """
+
+    encHdrLen = const.HDR_LENGTH - const.HMAC_SHA256_128_LENGTH
+
+    # Layout: [header | zeros] [header | zeros] ...
+    plain = bytearray(sum(lengths) -
+                      (len(lengths) * const.HMAC_SHA256_128_LENGTH))
+    offset = 0
+    for length in lengths:
+        totalLen = length - const.HDR_LENGTH
+        if not (0 <= totalLen <= const.MPU):
+            raise base.PluggableTransportError("Invalid padding length %d." %
+                                               length)
+        struct.pack_into("!hhB", plain, offset, totalLen, 0,
+                         const.FLAG_PAYLOAD)
+        offset += encHdrLen + totalLen
+
+    encrypted = crypter.encrypt(buffer(plain))
+
+    keyedHMAC = mycrypto.toKeyedHMAC(hmacKey)
+    blurbs = []
+    offset = 0
+    for length in lengths:
+        msgLen = length - const.HMAC_SHA256_128_LENGTH
+        blurbs.append(keyedHMAC(buffer(encrypted, offset, msgLen)))
+        blurbs.append(encrypted[offset:offset + msgLen])
+        offset += msgLen
+
+    return "".join(blurbs)
 
 
 def getFlagNames( flags ):
@@ -75,8 +162,9 @@ def isSane( totalLen, payloadLen, flags ):
 
         return True if (0 <= length <= const.MPU) else False
 
-    log.debug("Message header: totalLen=%d, payloadLen=%d, flags"
-              "=%s" % (totalLen, payloadLen, getFlagNames(flags)))
+    if log.is_enabled_for(logging.DEBUG):
+        log.debug("Message header: totalLen=%d, payloadLen=%d, flags=%s",
+                  totalLen, payloadLen, getFlagNames(flags))
 
     validFlags = [
         const.FLAG_PAYLOAD,
@@ -119,8 +207,9 @@ class ProtocolMessage( object ):
         Encrypt and authenticate this protocol message.
 
         This protocol message is encrypted using `crypter' and authenticated
-        using `hmacKey'.  Finally, the encrypted message prepended by a
-        HMAC-SHA256-128 is returned and ready to be sent over the wire.
+        using `hmacKey', the key or a `mycrypto.KeyedHMAC' object for it.
+        Finally, the encrypted message prepended by a HMAC-SHA256-128 is
+        returned and ready to be sent over the wire.
         """
 
         encrypted = crypter.encrypt(pack.htons(self.totalLen) +
@@ -128,7 +217,7 @@ class ProtocolMessage( object ):
                                     chr(self.flags) + self.payload +
                                     (self.totalLen - self.payloadLen) * '\0')
 
-        hmac = mycrypto.HMAC_SHA256_128(hmacKey, encrypted)
+        hmac = mycrypto.toKeyedHMAC(hmacKey)(encrypted)
 
         return hmac + encrypted
 
@@ -147,8 +236,8 @@ class ProtocolMessage( object ):
         if paddingLen == 0:
             return
 
-        log.debug("Adding %d bytes of padding to %d-byte message." %
-                  (paddingLen, const.HDR_LENGTH + self.totalLen))
+        log.debug("Adding %d bytes of padding to %d-byte message.",
+                  paddingLen, const.HDR_LENGTH + self.totalLen)
         self.totalLen += paddingLen
 
     def __len__( self ):
@@ -177,50 +266,89 @@ class MessageExtractor( object ):
         self.payloadLen = None
         self.flags = None
 
+    def parseHeader( self, header ):
+        """
+        Parse and verify the decrypted 5-byte message `header'.
+
+        The header fields are stored until the rest of the message is
+        processed.  In case of an invalid header, an exception is raised.
+        """
+
+        self.totalLen, self.payloadLen, self.flags = \
+                struct.unpack("!hhB", header)
+
+        if not isSane(self.totalLen, self.payloadLen, self.flags):
+            raise base.PluggableTransportError("Invalid header.")
+
     def extract( self, data, aes, hmacKey ):
         """
         Extracts (i.e., decrypts and authenticates) protocol messages.
 
         The raw `data' coming directly from the wire is decrypted using `aes'
-        and authenticated using `hmacKey'.  The payload is then returned as
+        and authenticated using `hmacKey', the key or a `mycrypto.KeyedHMAC'
+        object for it.  The payload is then returned as
         unencrypted protocol messages.  In case of invalid headers or HMACs, an
         exception is raised.
+
+        All complete messages are parsed in a single pass over the received
+        data and only the trailing partial message is kept.  Since AES-CTR is
+        a stream cipher, a message's body and the header of the message
+        following it are decrypted together in one call.
         """
 
-        self.recvBuf += data
+        if self.recvBuf:
+            data = self.recvBuf + data
+
+        keyedHMAC = mycrypto.toKeyedHMAC(hmacKey)
         msgs = []
+        pos = 0
+        end = len(data)
 
         # Keep trying to unpack as long as there is at least a header.
-        while len(self.recvBuf) >= const.HDR_LENGTH:
+        while True:
 
             # If necessary, extract the header fields.
-            if self.totalLen == self.payloadLen == self.flags == None:
-                self.totalLen = pack.ntohs(aes.decrypt(self.recvBuf[16:18]))
-                self.payloadLen = pack.ntohs(aes.decrypt(self.recvBuf[18:20]))
-                self.flags = ord(aes.decrypt(self.recvBuf[20]))
+            if self.totalLen is None:
+                if (end - pos) < const.HDR_LENGTH:
+                    break
+                self.parseHeader(aes.decrypt(
+                        data[pos + const.HMAC_SHA256_128_LENGTH:
+                             pos + const.HDR_LENGTH]))
 
-                if not isSane(self.totalLen, self.payloadLen, self.flags):
-                    raise base.PluggableTransportError("Invalid header.")
+            msgEnd = pos + const.HDR_LENGTH + self.totalLen
 
             # Parts of the message are still on the wire; waiting.
-            if (len(self.recvBuf) - const.HDR_LENGTH) < self.totalLen:
+            if msgEnd > end:
                 break
 
-            rcvdHMAC = self.recvBuf[0:const.HMAC_SHA256_128_LENGTH]
-            vrfyHMAC = mycrypto.HMAC_SHA256_128(hmacKey,
-                              self.recvBuf[const.HMAC_SHA256_128_LENGTH:
-                              (self.totalLen + const.HDR_LENGTH)])
+            rcvdHMAC = data[pos:pos + const.HMAC_SHA256_128_LENGTH]
+            vrfyHMAC = keyedHMAC(data[pos + const.HMAC_SHA256_128_LENGTH:
+                                      msgEnd])
 
             if rcvdHMAC != vrfyHMAC:
                 raise base.PluggableTransportError("Invalid message HMAC.")
 
-            # Decrypt the message and remove it from the input buffer.
-            extracted = aes.decrypt(self.recvBuf[const.HDR_LENGTH:
-                         (self.totalLen + const.HDR_LENGTH)])[:self.payloadLen]
-            msgs.append(ProtocolMessage(payload=extracted, flags=self.flags))
-            self.recvBuf = self.recvBuf[const.HDR_LENGTH + self.totalLen:]
+            # Decrypt the message body together with the next header.
+            body = data[pos + const.HDR_LENGTH:msgEnd]
+            haveNextHdr = (end - msgEnd) >= const.HDR_LENGTH
+            if haveNextHdr:
+                plain = aes.decrypt(body + data[msgEnd +
+                                                const.HMAC_SHA256_128_LENGTH:
+                                                msgEnd + const.HDR_LENGTH])
+            else:
+                plain = aes.decrypt(body)
+
+            msgs.append(ProtocolMessage(payload=plain[:self.payloadLen],
+                                        flags=self.flags))
+            pos = msgEnd
 
             # Protocol message processed; now reset length fields.
             self.totalLen = self.payloadLen = self.flags = None
 
+            if haveNextHdr:
+                self.parseHeader(plain[len(body):])
+
+        # Only keep the trailing partial message (if any).
+        self.recvBuf = data[pos:] if pos else data
+
         return msgs
@@ -1,20 +1,18 @@
 """
-This module provides cryptographic functions not implemented in PyCrypto.
+This module provides cryptographic functions on top of the crypto backend.
 
 The implemented algorithms include HKDF-SHA256, HMAC-SHA256-128, (CS)PRNGs and
 an interface for encryption and decryption using AES in counter mode.
 """
 
-import Crypto.Hash.SHA256
-import Crypto.Hash.HMAC
-import Crypto.Util.Counter
-import Crypto.Cipher.AES
-
 import obfsproxy.transports.base as base
+import obfsproxy.common.crypto_backend as crypto_backend
 import obfsproxy.common.log as logging
 
+import hmac
 import math
 import os
+import struct
 
 import const
 
@@ -67,10 +65,9 @@ class HKDF_SHA256( object ):
             raise base.PluggableTransportError("HKDF-SHA256 OKM must not "
                                                "be re-used by application.")
 
+        keyedHMAC = KeyedHMAC(self.prk)
         while self.length > len(self.T):
-            tmp = Crypto.Hash.HMAC.new(self.prk, tmp + self.info +
-                                       chr(self.ctr),
-                                       Crypto.Hash.SHA256).digest()
+            tmp = keyedHMAC.digest(tmp + self.info + chr(self.ctr))
             self.T += tmp
             self.ctr += 1
 
@@ -84,10 +81,79 @@ def HMAC_SHA256_128( key, msg ):
 
     assert(len(key) >= const.SHARED_SECRET_LENGTH)
 
-    h = Crypto.Hash.HMAC.new(key, msg, Crypto.Hash.SHA256)
-
     # Return HMAC truncated to 128 out of 256 bits.
-    return h.digest()[:16]
+    return crypto_backend.hmac_sha256_digest(key, msg)[:16]
+
+
+class KeyedHMAC( object ):
+
+    """
+    Compute HMAC-SHA256(-128)s using a fixed key.
+
+    The key's inner and outer pads are hashed only once, when the object is
+    created.  Every HMAC then starts from a copy of that state, which saves
+    two SHA256 compressions and the key setup per HMAC.
+    """
+
+    def __init__( self, key ):
+        """
+        Initialise a KeyedHMAC object for `key'.
+        """
+
+        assert(len(key) >= const.SHARED_SECRET_LENGTH)
+
+        self.key = key
+        self.context = crypto_backend.hmac_sha256(key)
+
+    def digest( self, msg ):
+        """
+        Return the HMAC-SHA256 of the given `msg'.
+        """
+
+        context = self.context.copy()
+        context.update(msg)
+
+        return context.digest()
+
+    def __call__( self, msg ):
+        """
+        Return the HMAC-SHA256-128 of the given `msg'.
+        """
+
+        return self.digest(msg)[:16]
+
+    def findEpoch( self, msg, existingHMAC, epochs ):
+        """
+        Return the epoch for which `existingHMAC' authenticates `msg'.
+
+        For every epoch in `epochs', the HMAC-SHA256-128 of `msg' followed by
+        the epoch is compared to `existingHMAC' in constant time.  `msg' is
+        hashed only once.  If none of the HMACs matches, `None' is returned.
+        """
+
+        context = self.context.copy()
+        context.update(msg)
+
+        for epoch in epochs:
+            epochContext = context.copy()
+            epochContext.update(epoch)
+            if hmac.compare_digest(epochContext.digest()[:16], existingHMAC):
+                return epoch
+
+            log.debug("HMAC invalid.  Trying next epoch value.")
+
+        return None
+
+
+def toKeyedHMAC( key ):
+    """
+    Return a `KeyedHMAC' object for `key', which may already be one.
+    """
+
+    if isinstance(key, KeyedHMAC):
+        return key
+
+    return KeyedHMAC(key)
 
 
 def strongRandom( size ):
@@ -116,7 +182,6 @@ class PayloadCrypter:
 
         self.sessionKey = None
         self.crypter = None
-        self.counter = None
 
     def setSessionKey( self, key, iv ):
         """
@@ -131,25 +196,19 @@ class PayloadCrypter:
 
         # Our 128-bit counter has the following format:
         # [ 64-bit static and random IV ] [ 64-bit incrementing counter ]
-        # Counter wrapping is not allowed which makes it possible to transfer
-        # 2^64 * 16 bytes of data while avoiding counter reuse.  That amount is
-        # effectively out of reach given today's networking performance.
-        log.debug("Setting IV for AES-CTR.")
-        self.counter = Crypto.Util.Counter.new(64,
-                                               prefix = iv,
-                                               initial_value = 1,
-                                               allow_wraparound = False)
-
-        log.debug("Setting session key for AES-CTR.")
-        self.crypter = Crypto.Cipher.AES.new(key, Crypto.Cipher.AES.MODE_CTR,
-                                             counter=self.counter)
+        # After 2^64 * 16 bytes of data, the lower half carries into the IV.
+        # That amount is effectively out of reach given today's networking
+        # performance.
+        log.debug("Setting session key and IV for AES-CTR.")
+        self.crypter = crypto_backend.aes_ctr(key, iv + struct.pack(">Q", 1),
+                                              wraparound=False)
 
     def encrypt( self, data ):
         """
         Encrypts the given `data' using AES in counter mode.
         """
 
-        return self.crypter.encrypt(data)
+        return self.crypter(data)
 
     # Encryption equals decryption in AES-CTR.
     decrypt = encrypt
@@ -40,6 +40,9 @@ class PacketMorpher( object ):
             self.dist = probdist.new(lambda: random.randint(const.HDR_LENGTH,
                                                             const.MTU))
 
+        # Packet lengths drawn ahead of time, for the next bursts.
+        self.samples = []
+
     def getPadding( self, sendCrypter, sendHMAC, dataLen ):
         """
         Based on the burst's size, return a ready-to-send padding blurb.
@@ -52,15 +55,11 @@ class PacketMorpher( object ):
 
         # We have to use two padding messages if the padding is > MTU.
         if padLen > const.MTU:
-            padMsgs = [message.new("", paddingLen=700 - const.HDR_LENGTH),
-                       message.new("", paddingLen=padLen - 700 - \
-                                       const.HDR_LENGTH)]
+            lengths = [700, padLen - 700]
         else:
-            padMsgs = [message.new("", paddingLen=padLen - const.HDR_LENGTH)]
-
-        blurbs = [msg.encryptAndHMAC(sendCrypter, sendHMAC) for msg in padMsgs]
+            lengths = [padLen]
 
-        return "".join(blurbs)
+        return message.createPadding(lengths, sendCrypter, sendHMAC)
 
     def calcPadding( self, dataLen ):
         """
@@ -70,12 +69,16 @@ class PacketMorpher( object ):
         don't fill the link's MTU.  This is done by drawing a random sample
         from our probability distribution which is used to determine and return
         the padding for such packets.  This effectively gets rid of Tor's
-        586-byte signature.
+        586-byte signature.  The samples are drawn `const.PADDING_SAMPLES' at a
+        time.
         """
 
         # The `is' and `should-be' length of the burst's last packet.
         dataLen = dataLen % const.MTU
-        sampleLen = self.dist.randomSample()
+
+        if not self.samples:
+            self.samples = self.dist.sampleMany(const.PADDING_SAMPLES)
+        sampleLen = self.samples.pop()
 
         # Now determine the padding length which is in {0..MTU-1}.
         if sampleLen >= dataLen:
@@ -87,8 +90,7 @@ class PacketMorpher( object ):
             padLen += const.MTU
 
         log.debug("Morphing the last %d-byte packet to %d bytes by adding %d "
-                  "bytes of padding." %
-                  (dataLen % const.MTU, sampleLen, padLen))
+                  "bytes of padding.", dataLen % const.MTU, sampleLen, padLen)
 
         return padLen
 
@@ -5,10 +5,16 @@ The class RandProbDist provides an interface to randomly generate probability
 distributions.  Random samples can then be drawn from these distributions.
 """
 
+import bisect
 import random
 
 import const
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 import obfsproxy.common.log as logging
 
 log = logging.get_obfslogger()
@@ -34,8 +40,40 @@ class RandProbDist:
 
         self.sampleList = []
         self.dist = self.genDistribution(genSingleton)
+        self.prepareSampling()
         self.dumpDistribution()
 
+    def __getstate__( self ):
+        """
+        Return the state to be pickled, without the sampling tables which are
+        derived from `sampleList'.
+        """
+
+        state = self.__dict__.copy()
+        state.pop("cumulProbs", None)
+        state.pop("singletons", None)
+        return state
+
+    def __setstate__( self, state ):
+        """
+        Restore the pickled `state' and rebuild the sampling tables.
+        """
+
+        self.__dict__.update(state)
+        self.prepareSampling()
+
+    def prepareSampling( self ):
+        """
+        Split `sampleList' into the arrays `randomSample()' bisects.
+        """
+
+        self.cumulProbs = [cumulProb for cumulProb, _ in self.sampleList]
+        self.singletons = [singleton for _, singleton in self.sampleList]
+
+        # Numbers above all cumulative probabilities map to the last singleton.
+        self.cumulProbs.append(float("inf"))
+        self.singletons.append(self.singletons[-1])
+
     def genDistribution( self, genSingleton ):
         """
         Generate a discrete probability distribution.
@@ -76,23 +114,47 @@ class RandProbDist:
         for singleton in self.dist.iterkeys():
             # We are not interested in tiny probabilities.
             if self.dist[singleton] > 0.01:
-                log.debug("P(%s) = %.3f" %
-                          (str(singleton), self.dist[singleton]))
+                log.debug("P(%s) = %.3f",
+                          str(singleton), self.dist[singleton])
 
     def randomSample( self ):
         """
         Draw and return a random sample from the probability distribution.
+
+        The first singleton whose cumulative probability is not smaller than a
+        uniformly drawn number is returned.  It is found by bisecting the
+        cumulative probabilities.
         """
 
         assert len(self.sampleList) > 0
 
-        rand = random.random()
+        return self.singletons[bisect.bisect_left(self.cumulProbs,
+                                                  random.random())]
+
+    def sampleMany( self, n ):
+        """
+        Draw and return a list of `n' random samples from the probability
+        distribution.
+
+        If NumPy is available, large batches are drawn using NumPy.
+        Otherwise, this is equivalent to calling `randomSample()' `n' times.
+        """
+
+        assert len(self.sampleList) > 0
+
+        singletons = self.singletons
+
+        if (numpy is not None) and (n >= const.NUMPY_MIN_SAMPLES):
+            indices = numpy.searchsorted(self.cumulProbs,
+                                         numpy.random.random_sample(n),
+                                         side='left')
+            return [singletons[index] for index in indices.tolist()]
 
-        for cumulProb, singleton in self.sampleList:
-            if rand <= cumulProb:
-                return singleton
+        cumulProbs = self.cumulProbs
+        rand = random.random
+        bisectLeft = bisect.bisect_left
 
-        return self.sampleList[-1][1]
+        return [singletons[bisectLeft(cumulProbs, rand())] for _ in xrange(n)]
 
 # Alias class name in order to provide a more intuitive API.
 new = RandProbDist
@@ -5,11 +5,32 @@ The replay protection mechanism is based on a dictionary which caches
 previously observed keys.  New keys can be added to the dictionary and existing
 ones can be queried.  A pruning mechanism deletes expired keys from the
 dictionary.
+
+Authentication HMACs include the epoch and are accepted during the epoch
+before and after it.  A key must therefore be remembered during the epoch in
+which it was added and the two following ones.
+
+Servers use a `SharedTracker' instead, which keeps the keys in a memory-mapped
+hash table that is shared by all server processes.  Alternatively, a
+`BloomTracker' keeps them in Bloom filters, which take a fixed amount of memory
+no matter how many keys are added.
 """
 
+import os
+import math
+import binascii
+import mmap
 import time
+import struct
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 import const
+import mycrypto
 
 import obfsproxy.common.log as logging
 
@@ -23,6 +44,10 @@ class Tracker( object ):
 
     This class provides methods to add new keys (elements), check whether keys
     are already present in the dictionary and to prune the lookup table.
+
+    Keys are stored in generations, one set per epoch (see `util.getEpoch()').
+    Pruning drops whole generations, so that its cost does not depend on the
+    number of keys.
     """
 
     def __init__( self ):
@@ -30,18 +55,41 @@ class Tracker( object ):
         Initialise a `Tracker' object.
         """
 
-        self.table = dict()
+        # Maps epochs to the set of keys which were added during the epoch.
+        self.generations = dict()
+
+    def __len__( self ):
+        """
+        Return the number of keys in the lookup table.
+        """
+
+        return sum(len(keys) for keys in self.generations.itervalues())
 
     def addElement( self, element ):
         """
         Add the given `element' to the lookup table.
         """
 
-        if self.isPresent(element):
+        if not self.register(element):
             raise LookupError("Element already present in table.")
 
-        # The key is a HMAC and the value is the current Unix timestamp.
-        self.table[element] = int(time.time())
+    def register( self, element ):
+        """
+        Add `element' to the lookup table unless it's already present.
+
+        Return `True' if `element' was added and `False' if it was already
+        present.
+        """
+
+        if self.isPresent(element):
+            return False
+
+        epoch = currentEpoch()
+        if epoch not in self.generations:
+            self.generations[epoch] = set()
+        self.generations[epoch].add(element)
+
+        return True
 
     def isPresent( self, element ):
         """
@@ -51,35 +99,489 @@ class Tracker( object ):
         otherwise.
         """
 
-        log.debug("Looking for existing element in size-%d lookup table." %
-                  len(self.table))
-
-        # Prune the replay table before looking up the given `element'.  This
-        # could be done more efficiently, e.g. by pruning every n minutes and
-        # only checking the timestamp of this particular element.
         self.prune()
 
-        return (element in self.table)
+        for keys in self.generations.itervalues():
+            if element in keys:
+                return True
+
+        return False
 
     def prune( self ):
         """
         Delete expired elements from the lookup table.
 
-        Keys whose Unix timestamps are older than `const.EPOCH_GRANULARITY' are
-        being removed from the lookup table.
+        Generations older than `const.REPLAY_GENERATIONS' epochs are removed
+        from the lookup table.
+        """
+
+        oldest = currentEpoch() - const.REPLAY_GENERATIONS + 1
+
+        for epoch in [epoch for epoch in self.generations if epoch < oldest]:
+            log.debug("Deleting %d expired element(s).",
+                      len(self.generations[epoch]))
+            del self.generations[epoch]
+
+
+class MappedTable( object ):
+
+    """
+    A fixed-size file which is memory-mapped and shared by all server
+    processes.  Subclasses hold `_locked()' while they access `table'.
+    """
+
+    def __init__( self, fileName, size ):
+        """
+        Open (and if necessary create) the `size'-byte file `fileName'.  If
+        the file has a different size, it's cleared.
+
+        Raise `IOError' or `OSError' if the file can't be set up.
+        """
+
+        self.size = size
+        self.fd = os.open(fileName, os.O_RDWR | os.O_CREAT, 0600)
+
+        try:
+            with self._locked():
+                if os.fstat(self.fd).st_size != self.size:
+                    log.info("Creating replay table `%s' (%d bytes).",
+                             fileName, size)
+                    os.ftruncate(self.fd, 0)
+                    os.ftruncate(self.fd, self.size)
+            self.table = mmap.mmap(self.fd, self.size)
+        except:
+            os.close(self.fd)
+            raise
+
+    def close( self ):
+        """
+        Unmap and close the file.
+        """
+
+        self.table.close()
+        os.close(self.fd)
+
+    @contextlib.contextmanager
+    def _locked( self ):
+        """
+        Hold an exclusive lock on the file.
         """
 
-        log.debug("Pruning the replay table.")
+        if fcntl is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
 
-        deleteList = []
+
+class SharedTracker( MappedTable ):
+
+    """
+    Keep track of replayed keys in a memory-mapped file.
+
+    The file is a fixed-size open-addressing hash table, so that several
+    server processes can share it.  Every slot holds a key and the Unix
+    timestamp of when it was added.  A timestamp of zero marks an empty slot.
+    Slots whose keys expired are reclaimed by later insertions.  If there is
+    no such slot, the oldest key in the way is evicted, so that a flood of
+    handshakes can't lock out legitimate clients.
+
+    Lookups and insertions touch at most `const.REPLAY_TABLE_MAX_PROBES' slots
+    and hold an `flock()' on the file, which makes them atomic across
+    processes.
+    """
+
+    # A slot is a key followed by a 32-bit timestamp.
+    KEY_LENGTH = const.HMAC_SHA256_128_LENGTH
+    SLOT_LENGTH = KEY_LENGTH + 4
+
+    # Number of slots which `__len__()' reads at a time.
+    LEN_CHUNK_SLOTS = 4096
+
+    def __init__( self, fileName, slots ):
+        """
+        Open (and if necessary create) the replay table with `slots' slots in
+        `fileName'.
+
+        Raise `IOError' or `OSError' if the file can't be set up.
+        """
+
+        self.slots = slots
+
+        # Whether we already warned about evicting unexpired keys.
+        self.warnedFull = False
+
+        MappedTable.__init__(self, fileName, slots * self.SLOT_LENGTH)
+
+    def __len__( self ):
+        """
+        Return the number of unexpired keys in the table.
+
+        This reads the entire table, so it is meant for monitoring only.  The
+        slots are read `LEN_CHUNK_SLOTS' at a time, and the lock is only held
+        while a chunk is copied.
+        """
+
+        # Keys added before `oldest' are expired, see `isExpired()'.
         now = int(time.time())
+        oldest = ((now / const.EPOCH_GRANULARITY) -
+                  const.REPLAY_GENERATIONS + 1) * const.EPOCH_GRANULARITY
+
+        keys = 0
+        for first in xrange(0, self.slots, self.LEN_CHUNK_SLOTS):
+            slots = min(self.LEN_CHUNK_SLOTS, self.slots - first)
+            start = first * self.SLOT_LENGTH
+
+            with self._locked():
+                chunk = self.table[start:start + slots * self.SLOT_LENGTH]
+
+            timestamps = struct.unpack(
+                "!" + ("%dxI" % self.KEY_LENGTH) * slots, chunk)
+            keys += sum(1 for timestamp in timestamps if timestamp >= oldest)
+
+        return keys
+
+    def _probe( self, element, now ):
+        """
+        Look for `element' in the table.
+
+        Return a tuple: the offset of `element's slot (or `None' if it's not
+        present), the offset of the first free slot on its probe sequence (or
+        `None' if there is none) and the offset of the slot holding the oldest
+        key on its probe sequence.
+        """
+
+        assert len(element) == self.KEY_LENGTH
+
+        # Keys are HMACs, so their first bytes are uniformly distributed.
+        index = struct.unpack("!Q", element[:8])[0] % self.slots
+        free = oldest = None
+        oldestTimestamp = None
+
+        for _ in xrange(min(const.REPLAY_TABLE_MAX_PROBES, self.slots)):
+            offset = index * self.SLOT_LENGTH
+            slot = self.table[offset:offset + self.SLOT_LENGTH]
+            timestamp = struct.unpack("!I", slot[self.KEY_LENGTH:])[0]
+
+            if timestamp == 0:
+                # Nothing was ever stored behind an empty slot.
+                return (None, offset if free is None else free, oldest)
+
+            if isExpired(timestamp, now):
+                if free is None:
+                    free = offset
+            elif slot[:self.KEY_LENGTH] == element:
+                return (offset, free, oldest)
+
+            if (oldestTimestamp is None) or (timestamp < oldestTimestamp):
+                oldest, oldestTimestamp = offset, timestamp
+
+            index = (index + 1) % self.slots
+
+        return (None, free, oldest)
+
+    def register( self, element ):
+        """
+        Add `element' to the table unless it's already present.
+
+        Return `True' if `element' was added and `False' if it was already
+        present.  If all the slots on `element's probe sequence are taken, the
+        oldest key is evicted.  A replay of the evicted key would then go
+        unnoticed, which is better than rejecting every new handshake.
+        """
+
+        now = int(time.time())
+
+        with self._locked():
+            found, free, oldest = self._probe(element, now)
+            if found is not None:
+                return False
+
+            if free is None:
+                if not self.warnedFull:
+                    log.warning("The replay table is full.  Evicting keys "
+                                "before they expired.  Consider increasing "
+                                "the replay table's size.")
+                    self.warnedFull = True
+                free = oldest
+
+            self.table[free:free + self.SLOT_LENGTH] = \
+                element + struct.pack("!I", now)
+
+        return True
+
+    def addElement( self, element ):
+        """
+        Add the given `element' to the lookup table.
+        """
+
+        if not self.register(element):
+            raise LookupError("Element already present in table.")
+
+    def isPresent( self, element ):
+        """
+        Check if the given `element' is already present in the lookup table.
+
+        Return `True' if `element' is already in the lookup table and `False'
+        otherwise.
+        """
+
+        with self._locked():
+            found, _, _ = self._probe(element, int(time.time()))
+
+        return found is not None
+
+
+class BloomTracker( MappedTable ):
+
+    """
+    Keep track of replayed keys in Bloom filters.
+
+    There is one filter per epoch, and `const.REPLAY_GENERATIONS' of them are
+    kept in a ring.  When a new epoch begins, the oldest filter is cleared and
+    reused.  The filters are sized for `rate' keys per second, which bounds the
+    memory they take: `BloomTracker.memoryUsage()' bytes.
+
+    Up to the configured rate, the probability that a new key is reported as
+    present is below `const.REPLAY_GENERATIONS' times `fpRate'.  Beyond that,
+    it grows with the number of keys, but memory does not.
+
+    The filters are stored as bit arrays in a memory-mapped file which is
+    shared by all server processes.  The file starts with a random salt which
+    keys the derivation of bit positions, so that clients, who can compute
+    valid HMACs, can't choose keys which set the same bits and raise the
+    false positive rate for everyone else.
+    """
+
+    # Length of the secret salt at the beginning of the file.
+    SALT_LENGTH = 32
+
+    # Every filter is preceded by the epoch it belongs to.
+    HEADER_LENGTH = 8
+
+    # Number of bytes which `__len__()' reads at a time.
+    LEN_CHUNK_BYTES = 65536
+
+    def __init__( self, fileName, rate, fpRate=const.REPLAY_FILTER_FP_RATE ):
+        """
+        Open (and if necessary create) the replay filters in `fileName'.
+
+        Raise `IOError' or `OSError' if the file can't be set up.
+        """
+
+        self.bits, self.hashes = filterParameters(
+            int(rate * const.EPOCH_GRANULARITY), fpRate)
+        self.filterLength = self.HEADER_LENGTH + (self.bits + 7) / 8
+
+        MappedTable.__init__(self, fileName, self.SALT_LENGTH +
+                             const.REPLAY_GENERATIONS * self.filterLength)
+
+        with self._locked():
+            salt = self.table[:self.SALT_LENGTH]
+            if salt == "\0" * self.SALT_LENGTH:
+                salt = mycrypto.strongRandom(self.SALT_LENGTH)
+                self.table[:self.SALT_LENGTH] = salt
+
+        self.positionHMAC = mycrypto.KeyedHMAC(salt)
+
+    def __len__( self ):
+        """
+        Return an estimate of the number of keys in the filters, derived from
+        the number of bits which are set in them.
+
+        This reads the entire filters, so it is meant for monitoring only.
+        They are read `LEN_CHUNK_BYTES' at a time, like the slots of a
+        `SharedTracker'.
+        """
+
+        length = self.filterLength - self.HEADER_LENGTH
+
+        with self._locked():
+            offsets = self._filters(currentEpoch())
+
+        keys = 0.0
+        for offset in offsets:
+            setBits = 0
+            for start in xrange(offset, offset + length, self.LEN_CHUNK_BYTES):
+                end = min(start + self.LEN_CHUNK_BYTES, offset + length)
+                with self._locked():
+                    chunk = self.table[start:end]
+                setBits += bin(int("0" + binascii.hexlify(chunk), 16)).count("1")
+
+            # A saturated filter would make the estimate infinite.
+            setBits = min(setBits, self.bits - 1)
+            keys -= float(self.bits) / self.hashes * \
+                    math.log(1 - float(setBits) / self.bits)
+
+        return int(round(keys))
+
+    @staticmethod
+    def memoryUsage( rate, fpRate=const.REPLAY_FILTER_FP_RATE ):
+        """
+        Return the number of bytes taken by the filters for `rate' keys per
+        second.
+        """
+
+        bits, _ = filterParameters(int(rate * const.EPOCH_GRANULARITY), fpRate)
+        return BloomTracker.SALT_LENGTH + const.REPLAY_GENERATIONS * \
+               (BloomTracker.HEADER_LENGTH + (bits + 7) / 8)
+
+    def _positions( self, element ):
+        """
+        Return the bit positions of `element' in a filter.
+
+        The positions are derived from the HMAC of `element' keyed with our
+        salt, using double hashing.
+        """
+
+        assert len(element) == const.HMAC_SHA256_128_LENGTH
+
+        h1, h2 = struct.unpack("!QQ", self.positionHMAC(element))
+        h2 |= 1
+
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def _filters( self, epoch ):
+        """
+        Return the offsets of the bit arrays of the filters which are valid
+        during `epoch'.  The one of `epoch' itself comes first; it is cleared if
+        it still belongs to an earlier epoch.
+        """
+
+        offsets = []
+        for i in xrange(const.REPLAY_GENERATIONS):
+            offset = self.SALT_LENGTH + \
+                     ((epoch - i) % const.REPLAY_GENERATIONS) * self.filterLength
+            header = self.table[offset:offset + self.HEADER_LENGTH]
+            filterEpoch = struct.unpack("!Q", header)[0]
+
+            if (i == 0) and (filterEpoch != epoch):
+                log.debug("Clearing the replay filter for epoch %d.", epoch)
+                self.table[offset:offset + self.filterLength] = \
+                    struct.pack("!Q", epoch) + \
+                    "\0" * (self.filterLength - self.HEADER_LENGTH)
+            elif (i > 0) and (filterEpoch != epoch - i):
+                continue
+
+            offsets.append(offset + self.HEADER_LENGTH)
+
+        return offsets
+
+    def _contains( self, offset, positions ):
+        """
+        Return `True' if all bits at `positions' are set in the bit array at
+        `offset'.
+        """
+
+        table = self.table
+        for pos in positions:
+            if not (ord(table[offset + (pos >> 3)]) & (1 << (pos & 7))):
+                return False
+
+        return True
+
+    def register( self, element ):
+        """
+        Add `element' to the current filter unless it's already present.
+
+        Return `True' if `element' was added and `False' if it was (probably)
+        already present.
+        """
+
+        positions = self._positions(element)
+
+        with self._locked():
+            offsets = self._filters(currentEpoch())
+            for offset in offsets:
+                if self._contains(offset, positions):
+                    return False
+
+            table = self.table
+            current = offsets[0]
+            for pos in positions:
+                index = current + (pos >> 3)
+                table[index] = chr(ord(table[index]) | (1 << (pos & 7)))
+
+        return True
+
+    def addElement( self, element ):
+        """
+        Add the given `element' to the current filter.
+        """
+
+        if not self.register(element):
+            raise LookupError("Element already present in table.")
+
+    def isPresent( self, element ):
+        """
+        Check if the given `element' is (probably) present in the filters.
+
+        Return `True' if `element' is probably present and `False' if it's
+        definitely not.
+        """
+
+        positions = self._positions(element)
+
+        with self._locked():
+            for offset in self._filters(currentEpoch()):
+                if self._contains(offset, positions):
+                    return True
+
+        return False
+
+def filterParameters( capacity, fpRate ):
+    """
+    Return the number of bits and hash functions of a Bloom filter which holds
+    `capacity' elements with a false positive rate of `fpRate'.
+    """
+
+    capacity = max(capacity, 1)
+    bits = int(math.ceil(-capacity * math.log(fpRate) / (math.log(2) ** 2)))
+    hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+
+    return bits, hashes
+
+def currentEpoch( ):
+    """
+    Return the current epoch as integer.  See `util.getEpoch()'.
+    """
+
+    return int(time.time()) / const.EPOCH_GRANULARITY
+
+def isExpired( timestamp, now ):
+    """
+    Return `True' if a key added at the Unix time `timestamp' has expired at
+    the Unix time `now'.
+    """
+
+    return ((now / const.EPOCH_GRANULARITY) -
+            (timestamp / const.EPOCH_GRANULARITY)) >= const.REPLAY_GENERATIONS
+
+# The shared replay tables opened by this process, keyed by file name.
+_sharedTrackers = dict()
+
+def openSharedTracker( fileName, slots ):
+    """
+    Return the `SharedTracker' with `slots' slots for `fileName'.
+
+    The server state is loaded for every connection, but the replay table is
+    only mapped once per process.
+    """
+
+    if fileName not in _sharedTrackers:
+        _sharedTrackers[fileName] = SharedTracker(fileName, slots)
+
+    return _sharedTrackers[fileName]
+
+def openBloomTracker( fileName, rate ):
+    """
+    Return the `BloomTracker' for `fileName', sized for `rate' keys per second.
+    It's only mapped once per process, like a `SharedTracker'.
+    """
 
-        for element in self.table.iterkeys():
-            if (now - self.table[element]) > const.EPOCH_GRANULARITY:
-                deleteList.append(element)
+    if fileName not in _sharedTrackers:
+        _sharedTrackers[fileName] = BloomTracker(fileName, rate)
 
-        # We can't delete from a dictionary while iterating over it; therefore
-        # this construct.
-        for elem in deleteList:
-            log.debug("Deleting expired element.")
-            del self.table[elem]
+    return _sharedTrackers[fileName]
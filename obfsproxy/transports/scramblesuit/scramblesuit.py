@@ -9,8 +9,12 @@ http://www.cs.kau.se/philwint/scramblesuit/
 from twisted.internet import reactor
 
 import obfsproxy.transports.base as base
+import obfsproxy.network.buffer as obfs_buf
+import obfsproxy.transports.obfs3_dh as obfs3_dh
+import obfsproxy.common.crypto_worker as crypto_worker
 import obfsproxy.common.log as logging
 
+import math
 import random
 import base64
 import yaml
@@ -25,11 +29,47 @@ import packetmorpher
 import ticket
 import uniformdh
 import state
-import fifobuf
+import replay
 
 
 log = logging.get_obfslogger()
 
+def parseReplayFilterRate( rate, exception ):
+    """
+    Return the handshake rate `rate' (a string or a number) as float.
+
+    Raise `exception' if `rate' is not a positive, finite number.
+    """
+
+    try:
+        rate = float(rate)
+    except ValueError:
+        rate = None
+
+    if (rate is None) or math.isnan(rate) or math.isinf(rate) or (rate <= 0):
+        raise exception("The replay filter rate must be a positive number of "
+                        "handshakes per second.")
+
+    return rate
+
+def parseReplayTableSlots( slots, exception ):
+    """
+    Return the replay table size `slots' (a string or a number) as integer.
+
+    Raise `exception' if `slots' is not a positive integer.
+    """
+
+    try:
+        slots = int(slots)
+    except ValueError:
+        slots = None
+
+    if (slots is None) or (slots <= 0):
+        raise exception("The replay table size must be a positive number of "
+                        "slots.")
+
+    return slots
+
 class ReadPassFile(argparse.Action):
     def __call__(self, parser, namespace, values, option_string=None):
         with open(values) as f:
@@ -51,7 +91,7 @@ class ScrambleSuitTransport( base.BaseTransport ):
         Initialise a ScrambleSuitTransport object.
         """
 
-        log.debug("Initialising %s." % const.TRANSPORT_NAME)
+        log.debug("Initialising %s.", const.TRANSPORT_NAME)
 
         super(ScrambleSuitTransport, self).__init__()
 
@@ -67,7 +107,11 @@ class ScrambleSuitTransport( base.BaseTransport ):
         self.sendBuf = ""
 
         # Buffer for inter-arrival time obfuscation.
-        self.choppingBuf = fifobuf.Buffer()
+        self.choppingBuf = obfs_buf.Buffer()
+
+        # Length of the protocol messages written since the last burst was
+        # padded.
+        self.burstLen = 0
 
         # AES instances to decrypt incoming and encrypt outgoing data.
         self.sendCrypter = mycrypto.PayloadCrypter()
@@ -89,6 +133,11 @@ class ScrambleSuitTransport( base.BaseTransport ):
         # decrypted but not yet authenticated.
         self.decryptedTicket = False
 
+        # Used by the client-side: the bridge we are connected to and whether
+        # our handshake still has to deliver new session tickets.
+        self.bridge = None
+        self.awaitingTickets = False
+
         # If we are in external mode we should already have a shared
         # secret set up because of validate_external_mode_cli().
         if self.weAreExternal:
@@ -114,6 +163,8 @@ class ScrambleSuitTransport( base.BaseTransport ):
 
         util.setStateLocation(transportConfig.getStateLocation())
 
+        crypto_worker.crypto_worker.start()
+
         cls.weAreClient = transportConfig.weAreClient
         cls.weAreServer = not cls.weAreClient
         cls.weAreExternal = transportConfig.weAreExternal
@@ -132,7 +183,27 @@ class ScrambleSuitTransport( base.BaseTransport ):
 
                 cls.uniformDHSecret = cls.uniformDHSecret.strip()
 
+            if cfg and "replay-filter-rate" in cfg:
+                cls.replayFilterRate = parseReplayFilterRate(
+                    cfg["replay-filter-rate"], base.TransportSetupFailed)
+
+            if cfg and "replay-table-slots" in cfg:
+                cls.replayTableSlots = parseReplayTableSlots(
+                    cfg["replay-table-slots"], base.TransportSetupFailed)
+
+        if cls.weAreClient:
+            ticket.ticketStore.load()
+
         if cls.weAreServer:
+            if getattr(cls, "replayFilterRate", None):
+                const.REPLAY_FILTER_RATE = cls.replayFilterRate
+                log.info("Using replay filters for %.1f handshakes per second "
+                         "(%d bytes).", cls.replayFilterRate,
+                         replay.BloomTracker.memoryUsage(cls.replayFilterRate))
+
+            if getattr(cls, "replayTableSlots", None):
+                const.REPLAY_TABLE_SLOTS = cls.replayTableSlots
+
             if not hasattr(cls, "uniformDHSecret"):
                 log.debug("Using fallback password for descriptor file.")
                 srv = state.load()
@@ -150,6 +221,9 @@ class ScrambleSuitTransport( base.BaseTransport ):
 
             state.writeServerPassword(cls.uniformDHSecret)
 
+            # Have UniformDH keypairs ready for the first handshakes.
+            obfs3_dh.keypair_pool.refill()
+
     @classmethod
     def get_public_server_options( cls, transportOptions ):
         """
@@ -159,7 +233,7 @@ class ScrambleSuitTransport( base.BaseTransport ):
         if the bridge operator did not use `ServerTransportOptions'.
         """
 
-        log.debug("Tor's transport options: %s" % str(transportOptions))
+        log.debug("Tor's transport options: %s", str(transportOptions))
 
         if not "password" in transportOptions:
             log.warning("No password found in transport options (use Tor's " \
@@ -183,7 +257,7 @@ class ScrambleSuitTransport( base.BaseTransport ):
 
         assert len(masterKey) == const.MASTER_KEY_LENGTH
 
-        log.debug("Deriving session keys from %d-byte master key." %
+        log.debug("Deriving session keys from %d-byte master key.",
                   len(masterKey))
 
         # We need key material for two symmetric AES-CTR keys, nonces and
@@ -205,23 +279,49 @@ class ScrambleSuitTransport( base.BaseTransport ):
             self.sendCrypter, self.recvCrypter = self.recvCrypter, \
                                                  self.sendCrypter
 
+        # Set up the HMAC keys once; every message then only copies them.
+        self.sendKeyedHMAC = mycrypto.KeyedHMAC(self.sendHMAC)
+        self.recvKeyedHMAC = mycrypto.KeyedHMAC(self.recvHMAC)
+
     def circuitConnected( self ):
         """
         Initiate a ScrambleSuit handshake.
 
         This method is only relevant for clients since servers never initiate
-        handshakes.  If a session ticket is available, it is redeemed.
-        Otherwise, a UniformDH handshake is conducted.
+        handshakes.  If a session ticket is available, it is redeemed.  If
+        other connections to the bridge are busy with their handshakes, we
+        wait for the tickets they receive.  Otherwise, a UniformDH handshake
+        is conducted.
         """
 
         # The server handles the handshake passively.
         if self.weAreServer:
             return
 
-        # The preferred authentication mechanism is a session ticket.
-        bridge = self.circuit.downstream.transport.getPeer()
-        storedTicket = ticket.findStoredTicket(bridge)
+        self.bridge = self.circuit.downstream.transport.getPeer()
+
+        d = ticket.ticketStore.acquire(self.bridge)
+        d.addCallback(self.startHandshake)
 
+    def startHandshake( self, storedTicket ):
+        """
+        Redeem the session ticket `storedTicket' or, if it's `None', start a
+        UniformDH handshake.
+
+        Until the server sent us new tickets and its PRNG seed, other
+        connections to the bridge wait for these tickets.
+        """
+
+        if self.circuit.closed:
+            log.debug("Circuit closed while waiting for a session ticket.")
+            if storedTicket is not None:
+                ticket.ticketStore.put(self.bridge, *storedTicket)
+            ticket.ticketStore.release(self.bridge)
+            return
+
+        self.awaitingTickets = True
+
+        # The preferred authentication mechanism is a session ticket.
         if storedTicket is not None:
             log.debug("Redeeming stored session ticket.")
             (masterKey, rawTicket) = storedTicket
@@ -241,6 +341,16 @@ class ScrambleSuitTransport( base.BaseTransport ):
             log.debug("No session ticket to redeem.  Running UniformDH.")
             self.circuit.downstream.write(self.uniformdh.createHandshake())
 
+    def circuitDestroyed( self, reason, side ):
+        """
+        Stop other connections from waiting for our session tickets if the
+        circuit was closed before the handshake finished.
+        """
+
+        if self.awaitingTickets:
+            self.awaitingTickets = False
+            ticket.ticketStore.release(self.bridge)
+
     def sendRemote( self, data, flags=const.FLAG_PAYLOAD ):
         """
         Send data to the remote end after a connection was established.
@@ -251,12 +361,11 @@ class ScrambleSuitTransport( base.BaseTransport ):
         payload.
         """
 
-        log.debug("Processing %d bytes of outgoing data." % len(data))
+        log.debug("Processing %d bytes of outgoing data.", len(data))
 
         # Wrap the application's data in ScrambleSuit protocol messages.
-        messages = message.createProtocolMessages(data, flags=flags)
-        blurb = "".join([msg.encryptAndHMAC(self.sendCrypter,
-                        self.sendHMAC) for msg in messages])
+        blurb = message.createBlurb(data, self.sendCrypter,
+                                    self.sendKeyedHMAC, flags=flags)
 
         # Flush data chunk for chunk to obfuscate inter-arrival times.
         if const.USE_IAT_OBFUSCATION:
@@ -269,11 +378,28 @@ class ScrambleSuitTransport( base.BaseTransport ):
                 # flushPieces() is still busy processing the chopping buffer.
                 self.choppingBuf.write(blurb)
 
+        # Messages written within one burst are padded together, once the
+        # connection flushes its coalesced writes.
         else:
-            padBlurb = self.pktMorpher.getPadding(self.sendCrypter,
-                                                  self.sendHMAC,
-                                                  len(blurb))
-            self.circuit.downstream.write(blurb + padBlurb)
+            firstInBurst = (self.burstLen == 0)
+            self.burstLen += len(blurb)
+            self.circuit.downstream.write(blurb)
+            if firstInBurst:
+                self.circuit.downstream.call_before_flush(self.padBurst)
+
+    def padBurst( self ):
+        """
+        Append padding to the burst of protocol messages written so far.
+
+        The packet morpher sees the length of the whole burst rather than the
+        length of every single message in it.
+        """
+
+        padBlurb = self.pktMorpher.getPadding(self.sendCrypter,
+                                              self.sendKeyedHMAC,
+                                              self.burstLen)
+        self.burstLen = 0
+        self.circuit.downstream.write(padBlurb)
 
     def flushPieces( self ):
         """
@@ -295,7 +421,7 @@ class ScrambleSuitTransport( base.BaseTransport ):
         else:
             blurb = self.choppingBuf.read()
             padBlurb = self.pktMorpher.getPadding(self.sendCrypter,
-                                                  self.sendHMAC,
+                                                  self.sendKeyedHMAC,
                                                   len(blurb))
             self.circuit.downstream.write(blurb + padBlurb)
             return
@@ -316,7 +442,8 @@ class ScrambleSuitTransport( base.BaseTransport ):
             return
 
         # Try to extract protocol messages from the encrypted blurb.
-        msgs  = self.protoMsg.extract(data, self.recvCrypter, self.recvHMAC)
+        msgs  = self.protoMsg.extract(data, self.recvCrypter,
+                                      self.recvKeyedHMAC)
         if (msgs is None) or (len(msgs) == 0):
             return
 
@@ -329,11 +456,11 @@ class ScrambleSuitTransport( base.BaseTransport ):
             elif self.weAreClient and (msg.flags == const.FLAG_NEW_TICKET):
                 assert len(msg.payload) == (const.TICKET_LENGTH +
                                             const.MASTER_KEY_LENGTH)
-                peer = self.circuit.downstream.transport.getPeer()
                 ticket.storeNewTicket(msg.payload[0:const.MASTER_KEY_LENGTH],
                                       msg.payload[const.MASTER_KEY_LENGTH:
                                                   const.MASTER_KEY_LENGTH +
-                                                  const.TICKET_LENGTH], peer)
+                                                  const.TICKET_LENGTH],
+                                      self.bridge)
 
             # Use the PRNG seed to generate the same probability distributions
             # as the server.  That's where the polymorphism comes from.
@@ -349,6 +476,13 @@ class ScrambleSuitTransport( base.BaseTransport ):
                                                const.MAX_PACKET_DELAY,
                                                seed=msg.payload)
 
+                # The server sends its seed after the session tickets, which
+                # concludes the handshake.
+                self.circuit.handshake_finished()
+                if self.awaitingTickets:
+                    self.awaitingTickets = False
+                    ticket.ticketStore.release(self.bridge)
+
             else:
                 log.warning("Invalid message flags: %d." % msg.flags)
 
@@ -366,7 +500,7 @@ class ScrambleSuitTransport( base.BaseTransport ):
             return
 
         # Flush the buffered data, the application is so eager to send.
-        log.debug("Flushing %d bytes of buffered application data." %
+        log.debug("Flushing %d bytes of buffered application data.",
                   len(self.sendBuf))
 
         self.sendRemote(self.sendBuf)
@@ -399,45 +533,37 @@ class ScrambleSuitTransport( base.BaseTransport ):
                 return False
 
         # First, find the mark to efficiently locate the HMAC.
-        mark = mycrypto.HMAC_SHA256_128(self.recvHMAC,
-                                        potentialTicket[:const.TICKET_LENGTH])
+        mark = self.recvKeyedHMAC(potentialTicket[:const.TICKET_LENGTH])
 
         index = util.locateMark(mark, potentialTicket)
         if not index:
             return False
 
-        # Now, verify if the HMAC is valid.
+        # Now, verify if the HMAC is valid for one of the epochs.
         existingHMAC = potentialTicket[index + const.MARK_LENGTH:
                                        index + const.MARK_LENGTH +
                                        const.HMAC_SHA256_128_LENGTH]
-        authenticated = False
-        for epoch in util.expandedEpoch():
-            myHMAC = mycrypto.HMAC_SHA256_128(self.recvHMAC,
-                                              potentialTicket[0:index + \
-                                              const.MARK_LENGTH] + epoch)
-
-            if util.isValidHMAC(myHMAC, existingHMAC, self.recvHMAC):
-                authenticated = True
-                break
-
-            log.debug("HMAC invalid.  Trying next epoch value.")
+        epoch = self.recvKeyedHMAC.findEpoch(potentialTicket[0:index +
+                                             const.MARK_LENGTH],
+                                             existingHMAC,
+                                             util.expandedEpoch())
 
-        if not authenticated:
+        if epoch is None:
             log.warning("Could not verify the authentication message's HMAC.")
             return False
 
         # Do nothing if the ticket is replayed.  Immediately closing the
-        # connection would be suspicious.
-        if self.srvState.isReplayed(existingHMAC):
+        # connection would be suspicious.  The lookup and the registration of
+        # the HMAC are one atomic step, so that two server processes can't
+        # both accept the same ticket.
+        log.debug("Adding the HMAC authenticating the ticket message to the " \
+                  "replay table: %s.", existingHMAC.encode('hex'))
+        if not self.srvState.registerKey(existingHMAC):
             log.warning("The HMAC was already present in the replay table.")
             return False
 
         data.drain(index + const.MARK_LENGTH + const.HMAC_SHA256_128_LENGTH)
 
-        log.debug("Adding the HMAC authenticating the ticket message to the " \
-                  "replay table: %s." % existingHMAC.encode('hex'))
-        self.srvState.registerKey(existingHMAC)
-
         log.debug("Switching to state ST_CONNECTED.")
         self.protoState = const.ST_CONNECTED
 
@@ -458,26 +584,99 @@ class ScrambleSuitTransport( base.BaseTransport ):
         # Buffer data we are not ready to transmit yet.
         else:
             self.sendBuf += data.read()
-            log.debug("Buffered %d bytes of outgoing data." %
+            log.debug("Buffered %d bytes of outgoing data.",
                       len(self.sendBuf))
 
-    def sendTicketAndSeed( self ):
+    def waitForUniformDH( self, data, srvState=None ):
         """
-        Send a session ticket and the PRNG seed to the client.
+        Extract a UniformDH public key and start computing the shared secret.
+
+        If a valid public key is found in `data', the shared secret is computed
+        by the crypto worker while we wait in the state ST_WAIT_FOR_SECRET, and
+        `True' is returned.  Otherwise, `False' is returned.
+        """
+
+        d = self.uniformdh.receivePublicKeyAsync(data, srvState)
+        if d is None:
+            return False
+
+        log.debug("Switching to state ST_WAIT_FOR_SECRET.")
+        self.protoState = const.ST_WAIT_FOR_SECRET
+
+        d.addCallback(self.finishUniformDH, data)
+        d.addErrback(self.uniformDHFailed)
+
+        return True
+
+    def finishUniformDH( self, masterKey, data ):
+        """
+        Finish the UniformDH handshake using the freshly computed `masterKey'.
+
+        The server replies with its own UniformDH public key, a new session
+        ticket and its PRNG seed; the client flushes its send buffer.  Data
+        which arrived in the meantime and is still waiting in `data' is
+        processed afterwards.
+        """
+
+        if self.circuit.closed:
+            log.debug("Circuit closed while computing the UniformDH secret.")
+            return
+
+        self.deriveSecrets(masterKey)
+
+        if self.weAreServer:
+            # Now send the server's UniformDH public key to the client.
+            handshakeMsg = self.uniformdh.createHandshake()
+
+            log.debug("Sending %d bytes of UniformDH handshake and "
+                      "session ticket.", len(handshakeMsg))
+
+            self.circuit.downstream.write(handshakeMsg)
+
+        log.debug("UniformDH authentication succeeded.")
+
+        log.debug("Switching to state ST_CONNECTED.")
+        self.protoState = const.ST_CONNECTED
+
+        if self.weAreServer:
+            self.sendTicketAndSeed(const.TICKETS_PER_HANDSHAKE)
+        else:
+            self.flushSendBuffer()
+
+        # Let the circuit pass us the remaining data, so that errors close it.
+        if len(data) > 0:
+            self.circuit.dataReceived(data, self.circuit.downstream)
+
+    def uniformDHFailed( self, failure ):
+        """
+        Close the circuit because the UniformDH shared secret could not be
+        computed or the handshake could not be finished.
+        """
+
+        log.info("UniformDH handshake failed: %s  Closing circuit.",
+                 failure.getErrorMessage())
+        self.circuit.close()
+
+    def sendTicketAndSeed( self, numTickets=1 ):
+        """
+        Send `numTickets' session tickets and the PRNG seed to the client.
 
         This method is only called by the server after successful
         authentication.  Finally, the server's send buffer is flushed.
         """
 
-        log.debug("Sending a new session ticket and the PRNG seed to the " \
-                  "client.")
+        log.debug("Sending %d new session ticket(s) and the PRNG seed to the "
+                  "client.", numTickets)
 
-        self.sendRemote(ticket.issueTicketAndKey(self.srvState),
-                        flags=const.FLAG_NEW_TICKET)
+        for _ in xrange(numTickets):
+            self.sendRemote(ticket.issueTicketAndKey(self.srvState),
+                            flags=const.FLAG_NEW_TICKET)
         self.sendRemote(self.srvState.prngSeed,
                         flags=const.FLAG_PRNG_SEED)
         self.flushSendBuffer()
 
+        self.circuit.handshake_finished()
+
     def receivedDownstream( self, data ):
         """
         Receives and processes data coming from the remote machine.
@@ -495,7 +694,7 @@ class ScrambleSuitTransport( base.BaseTransport ):
             if self.drainedHandshake > self.srvState.closingThreshold:
                 log.info("Terminating connection after having received >= %d"
                          " bytes because client could not "
-                         "authenticate." % self.srvState.closingThreshold)
+                         "authenticate.", self.srvState.closingThreshold)
                 self.circuit.close()
                 return
 
@@ -505,31 +704,19 @@ class ScrambleSuitTransport( base.BaseTransport ):
             if self.receiveTicket(data):
                 log.debug("Ticket authentication succeeded.")
 
-                self.sendTicketAndSeed()
-
-            # Second, interpret the data as a UniformDH handshake.
-            elif self.uniformdh.receivePublicKey(data, self.deriveSecrets,
-                    self.srvState):
-                # Now send the server's UniformDH public key to the client.
-                handshakeMsg = self.uniformdh.createHandshake()
-
-                log.debug("Sending %d bytes of UniformDH handshake and "
-                          "session ticket." % len(handshakeMsg))
-
-                self.circuit.downstream.write(handshakeMsg)
-                log.debug("UniformDH authentication succeeded.")
-
-                log.debug("Switching to state ST_CONNECTED.")
-                self.protoState = const.ST_CONNECTED
+                self.sendTicketAndSeed(const.TICKETS_PER_REDEMPTION)
 
-                self.sendTicketAndSeed()
+            # Second, interpret the data as a UniformDH handshake.  The
+            # handshake is finished in `finishUniformDH()'.
+            elif self.waitForUniformDH(data, self.srvState):
+                return
 
             elif len(data) > const.MAX_HANDSHAKE_LENGTH:
                 self.protoState = const.ST_AUTH_FAILED
                 self.drainedHandshake = len(data)
                 data.drain(self.drainedHandshake)
                 log.info("No successful authentication after having " \
-                         "received >= %d bytes.  Now ignoring client." % \
+                         "received >= %d bytes.  Now ignoring client.",
                          const.MAX_HANDSHAKE_LENGTH)
                 return
 
@@ -540,15 +727,14 @@ class ScrambleSuitTransport( base.BaseTransport ):
 
         elif self.weAreClient and (self.protoState == const.ST_WAIT_FOR_AUTH):
 
-            if not self.uniformdh.receivePublicKey(data, self.deriveSecrets):
+            if not self.waitForUniformDH(data):
                 log.debug("Unable to finish UniformDH handshake just yet.")
-                return
-
-            log.debug("UniformDH authentication succeeded.")
+            return
 
-            log.debug("Switching to state ST_CONNECTED.")
-            self.protoState = const.ST_CONNECTED
-            self.flushSendBuffer()
+        # Incoming data is kept buffered until the shared secret is ready.
+        elif self.protoState == const.ST_WAIT_FOR_SECRET:
+            log.debug("Still waiting for the UniformDH shared secret.")
+            return
 
         if self.protoState == const.ST_CONNECTED:
 
@@ -576,6 +762,20 @@ class ScrambleSuitTransport( base.BaseTransport ):
                                action=ReadPassFile,
                                dest="uniformDHSecret")
 
+        subparser.add_argument("--replay-filter-rate",
+                               type=float,
+                               help="Detect replayed handshakes using Bloom "
+                                    "filters sized for this many handshakes "
+                                    "per second",
+                               dest="replayFilterRate")
+
+        subparser.add_argument("--replay-table-slots",
+                               type=int,
+                               help="Number of slots in the replay table, "
+                                    "which remembers every handshake for "
+                                    "up to three hours",
+                               dest="replayTableSlots")
+
         super(ScrambleSuitTransport, cls).register_external_mode_cli(subparser)
 
     @classmethod
@@ -603,6 +803,14 @@ class ScrambleSuitTransport( base.BaseTransport ):
             raise base.PluggableTransportError(
                 "Pluggable Transport args invalid: %s" % args )
 
+        if getattr(args, "replayFilterRate", None) is not None:
+            cls.replayFilterRate = parseReplayFilterRate(
+                args.replayFilterRate, base.PluggableTransportError)
+
+        if getattr(args, "replayTableSlots", None) is not None:
+            cls.replayTableSlots = parseReplayTableSlots(
+                args.replayTableSlots, base.PluggableTransportError)
+
         if uniformDHSecret:
             rawLength = len(uniformDHSecret)
             if rawLength != const.SHARED_SECRET_LENGTH:
@@ -622,7 +830,7 @@ class ScrambleSuitTransport( base.BaseTransport ):
         them.  As argument, we only expect a UniformDH shared secret.
         """
 
-        log.debug("Received the following arguments over SOCKS: %s." % args)
+        log.debug("Received the following arguments over SOCKS: %s.", args)
 
         if len(args) != 1:
             raise base.SOCKSArgsError("Too many SOCKS arguments "
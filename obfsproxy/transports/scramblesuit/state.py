@@ -12,6 +12,13 @@ import sys
 import time
 import cPickle
 import random
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # No cross-process locking (and no multi-process servers) on Windows.
+    fcntl = None
 
 import const
 import replay
@@ -20,38 +27,131 @@ import probdist
 import base64
 
 import obfsproxy.common.log as logging
+import obfsproxy.common.metrics as metrics
 
 log = logging.get_obfslogger()
 
+# The state objects loaded by this process, keyed by state file.
+_loadedStates = dict()
+
 def load( ):
     """
     Load the server's state object from file.
 
     The server's state file is loaded and the state object returned.  If no
     state file is found, a new one is created and returned.
+
+    The state object is shared by all connections of this process.  Once it's
+    loaded, the file is only read again if another process modified it.
     """
 
     stateFile = os.path.join(const.STATE_LOCATION, const.SERVER_STATE_FILE)
 
-    log.info("Attempting to load the server's state file from `%s'." %
-             stateFile)
+    # State files are replaced atomically, so an unchanged stamp means that
+    # the cached object is current and we can skip taking the lock.
+    stateObject = _loadedStates.get(stateFile)
+    if stateObject is not None:
+        stamp = fileStamp(stateFile)
+        if (stamp is not None) and (stamp == stateObject.stamp):
+            return stateObject
+
+    with lock():
+        if (stateFile in _loadedStates) and os.path.exists(stateFile):
+            stateObject = _loadedStates[stateFile]
+            stateObject.refresh()
+            return stateObject
+
+        log.info("Attempting to load the server's state file from `%s'.",
+                 stateFile)
+
+        if not os.path.exists(stateFile):
+            log.info("The server's state file does not exist (yet).")
+            stateObject = State()
+            stateObject.genState()
+            _loadedStates[stateFile] = stateObject
+            return stateObject
 
-    if not os.path.exists(stateFile):
-        log.info("The server's state file does not exist (yet).")
-        state = State()
-        state.genState()
-        return state
+        try:
+            with open(stateFile, 'r') as fd:
+                stateObject = cPickle.load(fd)
+        except IOError as err:
+            log.error("Error reading server state file from `%s': %s" %
+                      (stateFile, err))
+            sys.exit(1)
 
-    try:
-        with open(stateFile, 'r') as fd:
-            stateObject = cPickle.load(fd)
-    except IOError as err:
-        log.error("Error reading server state file from `%s': %s" %
-                  (stateFile, err))
-        sys.exit(1)
+        stateObject.stamp = fileStamp(stateFile)
+
+    stateObject.openReplayTracker()
+    _loadedStates[stateFile] = stateObject
 
     return stateObject
 
+def replayTrackerSize( ):
+    """
+    Return the number of keys in the replay trackers of the loaded states.
+    """
+
+    trackers = dict()
+    for stateObject in _loadedStates.values():
+        tracker = getattr(stateObject, "replayTracker", None)
+        if tracker is not None:
+            trackers[id(tracker)] = tracker
+
+    return sum(len(tracker) for tracker in trackers.values())
+
+metrics.registry.add_gauge("replay_tracker_keys",
+                           "Keys in ScrambleSuit's replay tracker.",
+                           replayTrackerSize)
+
+# Nesting depth of `lock()' in this process.
+_lockDepth = 0
+
+@contextlib.contextmanager
+def lock( ):
+    """
+    Hold an exclusive lock on the server's state file.
+
+    Several obfsproxy worker processes can share the same state file.  The
+    lock serialises reading and modifying it.  Nested calls within one
+    process don't block.
+    """
+
+    global _lockDepth
+
+    fd = None
+    if (_lockDepth == 0) and (fcntl is not None) and const.STATE_LOCATION:
+        lockFile = os.path.join(const.STATE_LOCATION,
+                                const.SERVER_STATE_LOCK_FILE)
+        try:
+            fd = os.open(lockFile, os.O_RDWR | os.O_CREAT, 0600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        except (OSError, IOError) as err:
+            log.warning("Could not lock `%s': %s", lockFile, err)
+            if fd is not None:
+                os.close(fd)
+                fd = None
+
+    _lockDepth += 1
+    try:
+        yield
+    finally:
+        _lockDepth -= 1
+        if fd is not None:
+            os.close(fd) # This also releases the lock.
+
+def fileStamp( fileName ):
+    """
+    Return a tuple which changes whenever the file `fileName' is replaced or
+    written to, or `None' if the file does not exist.
+    """
+
+    try:
+        st = os.stat(fileName)
+    except OSError:
+        return None
+
+    return (st.st_ino, st.st_mtime, st.st_size)
+
 def writeServerPassword( password ):
     """
     Dump our ScrambleSuit server descriptor to file.
@@ -64,7 +164,7 @@ def writeServerPassword( password ):
     assert const.STATE_LOCATION != ""
 
     passwordFile = os.path.join(const.STATE_LOCATION, const.PASSWORD_FILE)
-    log.info("Writing server password to file `%s'." % passwordFile)
+    log.info("Writing server password to file `%s'.", passwordFile)
 
     password_str = "# You are supposed to give this password to your clients to append it to their Bridge line"
     password_str = "# For example: Bridge scramblesuit 192.0.2.1:5555 EXAMPLEFINGERPRINTNOTREAL password=EXAMPLEPASSWORDNOTREAL"
@@ -104,6 +204,82 @@ class State( object ):
         self.fallbackPassword = None
         self.closingThreshold = None
 
+        # Identifies the version of the state file we last read or wrote.
+        self.stamp = None
+
+    def __getstate__( self ):
+        """
+        Return the state to be pickled, without the file stamp and the replay
+        table which lives in its own file.
+        """
+
+        state = self.__dict__.copy()
+        state.pop("stamp", None)
+        state.pop("replayTracker", None)
+        return state
+
+    def __setstate__( self, state ):
+        """
+        Restore the pickled `state'.  Replay tables pickled by older versions
+        are dropped.
+        """
+
+        state.pop("replayTracker", None)
+        self.__dict__.update(state)
+
+    def openReplayTracker( self ):
+        """
+        Open the replay table which is shared by all server processes.
+
+        If `const.REPLAY_FILTER_RATE' is set, replay filters sized for this
+        rate are used instead of the exact replay table.  If the memory-mapped
+        file can't be set up, fall back to a replay table which only protects
+        this process.
+        """
+
+        try:
+            if const.REPLAY_FILTER_RATE:
+                tableFile = os.path.join(const.STATE_LOCATION,
+                                         const.REPLAY_FILTER_FILE)
+                self.replayTracker = replay.openBloomTracker(
+                    tableFile, const.REPLAY_FILTER_RATE)
+            else:
+                tableFile = os.path.join(const.STATE_LOCATION,
+                                         const.REPLAY_TABLE_FILE)
+                self.replayTracker = replay.openSharedTracker(
+                    tableFile, const.REPLAY_TABLE_SLOTS)
+        except EnvironmentError as err:
+            log.warning("Could not open the replay table `%s': %s.  Replay "
+                        "protection won't be shared with other processes." %
+                        (tableFile, err))
+            self.replayTracker = replay.Tracker()
+
+    def refresh( self ):
+        """
+        Reload the state file if another process modified it.
+
+        This must be called with the state `lock()' held.
+        """
+
+        stateFile = os.path.join(const.STATE_LOCATION, const.SERVER_STATE_FILE)
+
+        stamp = fileStamp(stateFile)
+        if (stamp is None) or (stamp == getattr(self, "stamp", None)):
+            return
+
+        log.debug("Reloading the server's state file which was modified by "
+                  "another process.")
+
+        try:
+            with open(stateFile, 'r') as fd:
+                self.__dict__.update(cPickle.load(fd).__dict__)
+        except IOError as err:
+            log.error("Error reading server state file from `%s': %s" %
+                      (stateFile, err))
+            sys.exit(1)
+
+        self.stamp = stamp
+
     def genState( self ):
         """
         Populate all the local variables with values.
@@ -123,8 +299,8 @@ class State( object ):
         self.oldHmacKey = None
         self.oldAesKey = None
 
-        # Replay dictionary for both authentication mechanisms.
-        self.replayTracker = replay.Tracker()
+        # Replay table for both authentication mechanisms.
+        self.openReplayTracker()
 
         # Distributions for packet lengths and inter arrival times.
         prng = random.Random(self.prngSeed)
@@ -144,6 +320,7 @@ class State( object ):
         self.closingThreshold = prng.randint(const.MAX_HANDSHAKE_LENGTH,
                                              const.MAX_HANDSHAKE_LENGTH * 5)
 
+        # Other processes must use the same parameters.
         self.writeState()
 
     def isReplayed( self, hmac ):
@@ -163,31 +340,42 @@ class State( object ):
     def registerKey( self, hmac ):
         """
         Add the given `hmac' to the replay table.
+
+        Looking up and adding the `hmac' happens atomically, also across
+        processes.  Return `False' if the `hmac' was already present, i.e., if
+        it was replayed, and `True' otherwise.
         """
 
         assert self.replayTracker is not None
 
         log.debug("Adding a new HMAC to the replay table.")
-        self.replayTracker.addElement(hmac)
 
-        # We must write the data to disk immediately so that other ScrambleSuit
-        # connections can share the same state.
-        self.writeState()
+        return self.replayTracker.register(hmac)
 
     def writeState( self ):
         """
         Write the state object to a file using the `cPickle' module.
+
+        The state is written to a temporary file which then replaces the state
+        file, so that the state file is never left half-written.
         """
 
         stateFile = os.path.join(const.STATE_LOCATION, const.SERVER_STATE_FILE)
+        tmpFile = stateFile + ".tmp"
 
-        log.debug("Writing server's state file to `%s'." %
+        log.debug("Writing server's state file to `%s'.",
                   stateFile)
 
-        try:
-            with open(stateFile, 'w') as fd:
-                cPickle.dump(self, fd)
-        except IOError as err:
-            log.error("Error writing state file to `%s': %s" %
-                      (stateFile, err))
-            sys.exit(1)
+        with lock():
+            try:
+                with open(tmpFile, 'w') as fd:
+                    cPickle.dump(self, fd)
+                    fd.flush()
+                    os.fsync(fd.fileno())
+                os.rename(tmpFile, stateFile)
+            except (IOError, OSError) as err:
+                log.error("Error writing state file to `%s': %s" %
+                          (stateFile, err))
+                sys.exit(1)
+
+            self.stamp = fileStamp(stateFile)
@@ -18,19 +18,20 @@ The 64-byte encrypted state contains:
 """
 
 import os
+import json
 import time
 import const
 import yaml
+import base64
 import struct
 import random
 import datetime
 
-from Crypto.Cipher import AES
-from Crypto.Hash import HMAC
-from Crypto.Hash import SHA256
+from twisted.internet import reactor, defer
 from twisted.internet.address import IPv4Address
 
 import obfsproxy.common.log as logging
+import obfsproxy.common.crypto_backend as crypto_backend
 
 import mycrypto
 import util
@@ -57,10 +58,11 @@ def createTicketMessage( rawTicket, HMACKey ):
                                     const.MAX_PADDING_LENGTH -
                                     const.TICKET_LENGTH))
 
-    mark = mycrypto.HMAC_SHA256_128(HMACKey, rawTicket)
+    keyedHMAC = mycrypto.KeyedHMAC(HMACKey)
 
-    hmac = mycrypto.HMAC_SHA256_128(HMACKey, rawTicket + padding +
-                                    mark + util.getEpoch())
+    mark = keyedHMAC(rawTicket)
+
+    hmac = keyedHMAC(rawTicket + padding + mark + util.getEpoch())
 
     return rawTicket + padding + mark + hmac
 
@@ -81,76 +83,334 @@ def issueTicketAndKey( srvState ):
     return masterKey + newTicket
 
 
-def storeNewTicket( masterKey, ticket, bridge ):
+class TicketStore( object ):
+
     """
-    Store a new session ticket and the according master key for future use.
+    Keep the client's session tickets in memory.
 
-    This method is only called by clients.  The given data, `masterKey',
-    `ticket' and `bridge', is YAMLed and stored in the global ticket
-    dictionary.  If there already is a ticket for the given `bridge', it is
-    overwritten.
+    The tickets are loaded from disk once and shared by all connections of the
+    process.  For each bridge (identified by `str(bridge)'), a pool of up to
+    `const.TICKET_POOL_SIZE' tickets is kept.  Every ticket is stored together
+    with its master key and the time it was received.  Changes are written
+    back to disk, as JSON, within `const.TICKET_STORE_WRITE_DELAY' seconds and
+    when the reactor shuts down.
+
+    The store also coordinates parallel connections to a bridge: a connection
+    which finds no ticket waits for the tickets of the handshakes which are
+    already in progress instead of running its own UniformDH handshake.
+
+    Ticket files written by older versions in YAML are imported once.
     """
 
-    assert len(masterKey) == const.MASTER_KEY_LENGTH
-    assert len(ticket) == const.TICKET_LENGTH
+    def __init__( self, storeFile=None ):
+        """
+        Initialise an empty `TicketStore' object which keeps its tickets in
+        `storeFile', by default in the ticket file in `const.STATE_LOCATION'.
+        """
 
-    ticketFile = const.STATE_LOCATION + const.CLIENT_TICKET_FILE
+        self.storeFile = storeFile
 
-    log.debug("Storing newly received ticket in `%s'." % ticketFile)
+        # Maps bridges to lists of [timestamp, masterKey, ticket] lists, the
+        # oldest ticket first.
+        self.tickets = dict()
 
-    # Add a new (key, ticket) tuple with the given bridge as hash key.
-    tickets = dict()
-    content = util.readFromFile(ticketFile)
-    if (content is not None) and (len(content) > 0):
-        tickets = yaml.safe_load(content)
+        # Maps bridges to the number of handshakes in progress.  Each of them
+        # is about to bring us new tickets.
+        self.pending = dict()
 
-    # We also store a timestamp so we later know if our ticket already expired.
-    tickets[str(bridge)] = [int(time.time()), masterKey, ticket]
-    util.writeToFile(yaml.dump(tickets), ticketFile)
+        # Maps bridges to the Deferreds of connections waiting for a ticket.
+        self.waiting = dict()
 
+        # The file the tickets were loaded from.
+        self.fileName = None
 
-def findStoredTicket( bridge ):
+        self.writeCall = None
+        self.writeAtShutdown = False
+
+    def load( self ):
+        """
+        Load the tickets stored in our ticket file, unless they were loaded
+        already.
+        """
+
+        fileName = self.storeFile or (const.STATE_LOCATION +
+                                      const.CLIENT_TICKET_STORE_FILE)
+        if fileName == self.fileName:
+            return
+
+        self.fileName = fileName
+        self.tickets = dict()
+
+        content = util.readFromFile(fileName)
+        if content:
+            try:
+                for bridge, entries in json.loads(content).iteritems():
+                    self.tickets[bridge] = [[timestamp,
+                                             base64.b64decode(masterKey),
+                                             base64.b64decode(ticket)]
+                                            for (timestamp, masterKey, ticket)
+                                            in entries]
+            except (ValueError, TypeError) as err:
+                log.warning("Ignoring corrupted ticket file `%s': %s." %
+                            (fileName, err))
+                self.tickets = dict()
+        elif self.storeFile is None:
+            self.importYAML(const.STATE_LOCATION + const.CLIENT_TICKET_FILE)
+
+        self.evictExpired()
+
+        log.debug("Loaded session tickets for %d bridge(s) from `%s'.",
+                  len(self.tickets), fileName)
+
+    def importYAML( self, fileName ):
+        """
+        Import the tickets in the YAML file `fileName'.
+        """
+
+        content = util.readFromFile(fileName)
+        if not content:
+            return
+
+        log.info("Importing session tickets from `%s'.", fileName)
+
+        try:
+            tickets = yaml.safe_load(content)
+            for bridge, (timestamp, masterKey, ticket) in tickets.iteritems():
+                self.tickets[bridge] = [[timestamp, masterKey, ticket]]
+        except (yaml.YAMLError, ValueError, TypeError, AttributeError) as err:
+            log.warning("Could not import tickets from `%s': %s." %
+                        (fileName, err))
+            return
+
+        self.scheduleWrite()
+
+    def evictExpired( self ):
+        """
+        Delete the tickets which are too old to be redeemed.
+        """
+
+        now = int(time.time())
+        for bridge in self.tickets.keys():
+            pool = [entry for entry in self.tickets[bridge]
+                    if (now - entry[0]) <= const.SESSION_TICKET_LIFETIME]
+
+            if len(pool) < len(self.tickets[bridge]):
+                log.debug("Evicting %d expired ticket(s) for bridge `%s'.",
+                          len(self.tickets[bridge]) - len(pool), bridge)
+
+            if pool:
+                self.tickets[bridge] = pool
+            else:
+                del self.tickets[bridge]
+
+    def put( self, bridge, masterKey, ticket ):
+        """
+        Store the `ticket' and its `masterKey' for `bridge'.
+
+        If a connection is waiting for a ticket, the ticket is handed to it
+        right away.  Otherwise, it's added to the bridge's pool.  If the pool
+        is full, its oldest ticket is dropped.
+        """
+
+        self.load()
+
+        bridge = str(bridge)
+
+        waiting = self.waiting.get(bridge)
+        if waiting:
+            log.debug("Handing new ticket to a waiting connection.")
+            self.pending[bridge] = self.pending.get(bridge, 0) + 1
+            waiting.pop(0).callback((masterKey, ticket))
+            return
+
+        # We also store a timestamp so we later know if our ticket already
+        # expired.
+        pool = self.tickets.setdefault(bridge, [])
+        pool.append([int(time.time()), masterKey, ticket])
+        del pool[:-const.TICKET_POOL_SIZE]
+        self.scheduleWrite()
+
+    def take( self, bridge ):
+        """
+        Remove the oldest ticket for `bridge' from the store and return it.
+
+        Return a (masterKey, ticket) tuple or `None' if there is no ticket
+        which can still be redeemed.
+        """
+
+        self.load()
+
+        bridge = str(bridge)
+
+        pool = self.tickets.get(bridge)
+        if not pool:
+            log.info("Found no ticket for bridge `%s'.", bridge)
+            return None
+
+        # The ticket is removed since we are about to redeem it.
+        timestamp, masterKey, ticket = pool.pop(0)
+        if not pool:
+            del self.tickets[bridge]
+        self.scheduleWrite()
+
+        # If our ticket is expired, we can't redeem it.  The tickets after it
+        # in the pool are younger, so we try them next.
+        ticketAge = int(time.time()) - timestamp
+        if ticketAge > const.SESSION_TICKET_LIFETIME:
+            log.warning("We did have a ticket but it already expired %s ago." %
+                        str(datetime.timedelta(seconds=
+                            (ticketAge - const.SESSION_TICKET_LIFETIME))))
+            return self.take(bridge)
+
+        return (masterKey, ticket)
+
+    def acquire( self, bridge ):
+        """
+        Return a Deferred which fires when a new connection to `bridge' can
+        start its handshake.
+
+        The Deferred fires with a (masterKey, ticket) tuple if a ticket can be
+        redeemed, or with `None' if the connection should run UniformDH.  If
+        there's no ticket but other handshakes to `bridge' are in progress,
+        the connection waits for their tickets, but no longer than
+        `const.TICKET_WAIT_TIMEOUT' seconds.  Afterwards, the connection's
+        handshake counts as in progress until `release()' is called.
+        """
+
+        bridge = str(bridge)
+
+        storedTicket = self.take(bridge)
+        if (storedTicket is not None) or not self.pending.get(bridge):
+            self.pending[bridge] = self.pending.get(bridge, 0) + 1
+            return defer.succeed(storedTicket)
+
+        log.debug("Waiting for a ticket from one of %d handshake(s) in "
+                  "progress.", self.pending[bridge])
+
+        d = defer.Deferred()
+        timeout = reactor.callLater(const.TICKET_WAIT_TIMEOUT,
+                                    self.stopWaiting, bridge, d)
+
+        def cancelTimeout( result ):
+            if timeout.active():
+                timeout.cancel()
+            return result
+
+        self.waiting.setdefault(bridge, []).append(d)
+        d.addBoth(cancelTimeout)
+
+        return d
+
+    def stopWaiting( self, bridge, d ):
+        """
+        Let the waiting connection `d' run UniformDH after all.
+        """
+
+        log.info("No ticket arrived in time.  Running UniformDH instead.")
+
+        self.waiting[bridge].remove(d)
+        self.pending[bridge] = self.pending.get(bridge, 0) + 1
+        d.callback(None)
+
+    def release( self, bridge ):
+        """
+        Mark a handshake with `bridge' started by `acquire()' as finished.
+
+        If it was the last handshake in progress but connections are still
+        waiting, no more tickets are to be expected.  One of the waiting
+        connections then runs UniformDH.
+        """
+
+        bridge = str(bridge)
+
+        self.pending[bridge] = self.pending.get(bridge, 1) - 1
+        if self.pending[bridge] > 0:
+            return
+        del self.pending[bridge]
+
+        waiting = self.waiting.get(bridge)
+        if waiting:
+            self.pending[bridge] = 1
+            waiting.pop(0).callback(None)
+
+    def scheduleWrite( self ):
+        """
+        Make sure that the tickets are written to disk soon and at shutdown.
+        """
+
+        if not self.writeAtShutdown:
+            reactor.addSystemEventTrigger('before', 'shutdown', self.write)
+            self.writeAtShutdown = True
+
+        if (self.writeCall is None) or not self.writeCall.active():
+            self.writeCall = reactor.callLater(const.TICKET_STORE_WRITE_DELAY,
+                                               self.write)
+
+    def write( self ):
+        """
+        Write the tickets to disk, if they were changed.
+        """
+
+        if self.writeCall is None:
+            return
+
+        if self.writeCall.active():
+            self.writeCall.cancel()
+        self.writeCall = None
+
+        self.evictExpired()
+
+        tickets = dict((bridge, [[timestamp, base64.b64encode(masterKey),
+                                  base64.b64encode(ticket)]
+                                 for (timestamp, masterKey, ticket) in pool])
+                       for bridge, pool in self.tickets.iteritems())
+
+        log.debug("Writing session tickets for %d bridge(s) to `%s'.",
+                  len(tickets), self.fileName)
+
+        # Replace the file in one step, so that it's never half-written.
+        tmpFile = self.fileName + ".tmp"
+        util.writeToFile(json.dumps(tickets), tmpFile)
+        try:
+            os.rename(tmpFile, self.fileName)
+        except OSError as err:
+            log.error("Could not write ticket file `%s': %s." %
+                      (self.fileName, err))
+
+# The session tickets of this process.
+ticketStore = TicketStore()
+
+
+def storeNewTicket( masterKey, ticket, bridge ):
     """
-    Retrieve a previously stored ticket from the ticket dictionary.
+    Store a new session ticket and the according master key for future use.
 
-    The global ticket dictionary is loaded and the given `bridge' is used to
-    look up the ticket and the master key.  If the ticket dictionary does not
-    exist (yet) or the ticket data could not be found, `None' is returned.
+    This method is only called by clients.  The given data, `masterKey',
+    `ticket' and `bridge', is stored in the global ticket store.  If the pool
+    of tickets for the given `bridge' is full, its oldest ticket is dropped.
     """
 
-    assert bridge
+    assert len(masterKey) == const.MASTER_KEY_LENGTH
+    assert len(ticket) == const.TICKET_LENGTH
 
-    ticketFile = const.STATE_LOCATION + const.CLIENT_TICKET_FILE
+    log.debug("Storing newly received ticket.")
 
-    log.debug("Attempting to read master key and ticket from file `%s'." %
-              ticketFile)
+    ticketStore.put(bridge, masterKey, ticket)
 
-    # Load the ticket hash table from file.
-    yamlBlurb = util.readFromFile(ticketFile)
-    if (yamlBlurb is None) or (len(yamlBlurb) == 0):
-        return None
-    tickets = yaml.safe_load(yamlBlurb)
 
-    try:
-        timestamp, masterKey, ticket = tickets[str(bridge)]
-    except KeyError:
-        log.info("Found no ticket for bridge `%s'." % str(bridge))
-        return None
+def findStoredTicket( bridge ):
+    """
+    Retrieve a previously stored ticket from the ticket store.
 
-    # We can remove the ticket now since we are about to redeem it.
-    log.debug("Deleting ticket since it is about to be redeemed.")
-    del tickets[str(bridge)]
-    util.writeToFile(yaml.dump(tickets), ticketFile)
-
-    # If our ticket is expired, we can't redeem it.
-    ticketAge = int(time.time()) - timestamp
-    if ticketAge > const.SESSION_TICKET_LIFETIME:
-        log.warning("We did have a ticket but it already expired %s ago." %
-                    str(datetime.timedelta(seconds=
-                        (ticketAge - const.SESSION_TICKET_LIFETIME))))
-        return None
+    The given `bridge' is used to look up the oldest ticket and its master
+    key.  The ticket is removed from the store since it's about to be
+    redeemed.  If no ticket could be found which did not expire yet, `None' is
+    returned.
+    """
 
-    return (masterKey, ticket)
+    assert bridge
+
+    return ticketStore.take(bridge)
 
 
 def checkKeys( srvState ):
@@ -166,7 +426,15 @@ def checkKeys( srvState ):
            (srvState.aesKey is not None) and \
            (srvState.keyCreation is not None)
 
-    if (int(time.time()) - srvState.keyCreation) > const.KEY_ROTATION_TIME:
+    if (int(time.time()) - srvState.keyCreation) <= const.KEY_ROTATION_TIME:
+        return
+
+    with state.lock():
+        # Another server process might have rotated the keys already.
+        srvState.refresh()
+        if (int(time.time()) - srvState.keyCreation) <= const.KEY_ROTATION_TIME:
+            return
+
         log.info("Rotating server key material for session tickets.")
 
         # Save expired keys to be able to validate old tickets.
@@ -178,10 +446,31 @@ def checkKeys( srvState ):
         srvState.hmacKey = mycrypto.strongRandom(const.TICKET_HMAC_KEY_LENGTH)
         srvState.keyCreation = int(time.time())
 
-        # ...and save it to disk.
+        # ...and save it to disk, where other server processes find it.
         srvState.writeState()
 
 
+# Keyed HMACs for the ticket keys, by key.  Only the current and the previous
+# key are in use at any time.
+_ticketHMACs = dict()
+
+def ticketHMAC( key ):
+    """
+    Return a `mycrypto.KeyedHMAC' object for the ticket HMAC key `key'.
+
+    The objects are cached, so that the key is set up only once.
+    """
+
+    keyedHMAC = _ticketHMACs.get(key)
+    if keyedHMAC is None:
+        # Drop the keys which were rotated away.
+        if len(_ticketHMACs) >= 2:
+            _ticketHMACs.clear()
+        keyedHMAC = _ticketHMACs[key] = mycrypto.KeyedHMAC(key)
+
+    return keyedHMAC
+
+
 def decrypt( ticket, srvState ):
     """
     Decrypts, verifies and returns the given `ticket'.
@@ -201,27 +490,24 @@ def decrypt( ticket, srvState ):
     checkKeys(srvState)
 
     # Verify the ticket's authenticity before decrypting.
-    hmac = HMAC.new(srvState.hmacKey, ticket[0:80], digestmod=SHA256).digest()
-    if util.isValidHMAC(hmac, ticket[80:const.TICKET_LENGTH],
-                        srvState.hmacKey):
+    hmac = ticketHMAC(srvState.hmacKey).digest(ticket[0:80])
+    if util.isValidHMAC(hmac, ticket[80:const.TICKET_LENGTH]):
         aesKey = srvState.aesKey
     else:
         if srvState.oldHmacKey is None:
             return None
 
         # Was the HMAC created using the rotated key material?
-        oldHmac = HMAC.new(srvState.oldHmacKey, ticket[0:80],
-                           digestmod=SHA256).digest()
-        if util.isValidHMAC(oldHmac, ticket[80:const.TICKET_LENGTH],
-                            srvState.oldHmacKey):
+        oldHmac = ticketHMAC(srvState.oldHmacKey).digest(ticket[0:80])
+        if util.isValidHMAC(oldHmac, ticket[80:const.TICKET_LENGTH]):
             aesKey = srvState.oldAesKey
         else:
             return None
 
     # Decrypt the ticket to extract the state information.
-    aes = AES.new(aesKey, mode=AES.MODE_CBC,
-                  IV=ticket[0:const.TICKET_AES_CBC_IV_LENGTH])
-    plainTicket = aes.decrypt(ticket[const.TICKET_AES_CBC_IV_LENGTH:80])
+    plainTicket = crypto_backend.aes_cbc_decrypt(aesKey,
+                        ticket[0:const.TICKET_AES_CBC_IV_LENGTH],
+                        ticket[const.TICKET_AES_CBC_IV_LENGTH:80])
 
     issueDate = struct.unpack('I', plainTicket[0:4])[0]
     identifier = plainTicket[4:22]
@@ -273,12 +559,12 @@ class ProtocolState( object ):
 
         lifetime = int(time.time()) - self.issueDate
         if lifetime > const.SESSION_TICKET_LIFETIME:
-            log.debug("The ticket is invalid and expired %s ago." %
+            log.debug("The ticket is invalid and expired %s ago.",
                       str(datetime.timedelta(seconds=
                       (lifetime - const.SESSION_TICKET_LIFETIME))))
             return False
 
-        log.debug("The ticket is still valid for %s." %
+        log.debug("The ticket is still valid for %s.",
                   str(datetime.timedelta(seconds=
                   (const.SESSION_TICKET_LIFETIME - lifetime))))
         return True
@@ -340,17 +626,16 @@ class SessionTicket( object ):
         self.state.issueDate = int(time.time())
 
         # Encrypt the protocol state.
-        aes = AES.new(self.symmTicketKey, mode=AES.MODE_CBC, IV=self.IV)
         state = repr(self.state)
-        assert (len(state) % AES.block_size) == 0
-        cryptedState = aes.encrypt(state)
+        assert (len(state) % 16) == 0
+        cryptedState = crypto_backend.aes_cbc_encrypt(self.symmTicketKey,
+                                                      self.IV, state)
 
         # Authenticate the encrypted state and the IV.
-        hmac = HMAC.new(self.hmacTicketKey,
-                        self.IV + cryptedState, digestmod=SHA256).digest()
+        hmac = ticketHMAC(self.hmacTicketKey).digest(self.IV + cryptedState)
 
         finalTicket = self.IV + cryptedState + hmac
-        log.debug("Returning %d-byte ticket." % len(finalTicket))
+        log.debug("Returning %d-byte ticket.", len(finalTicket))
 
         return finalTicket
 
@@ -370,8 +655,8 @@ if __name__ == "__main__":
                         "%s server." % const.TRANSPORT_NAME)
     parser.add_argument("tcp_port", type=int, help="The TCP port of the %s "
                         "server." % const.TRANSPORT_NAME)
-    parser.add_argument("ticket_file", type=str, help="The file, the newly "
-                        "issued ticket is written to.")
+    parser.add_argument("ticket_file", type=str, help="The ticket store, the "
+                        "newly issued ticket is added to.")
     args = parser.parse_args()
 
     print "[+] Loading server state file."
@@ -381,11 +666,10 @@ if __name__ == "__main__":
     masterKey = mycrypto.strongRandom(const.MASTER_KEY_LENGTH)
     ticket = SessionTicket(masterKey, serverState).issue()
 
-    print "[+] Writing new session ticket to `%s'." % args.ticket_file
-    tickets = dict()
-    server = IPv4Address('TCP', args.ip_addr, args.tcp_port)
-    tickets[str(server)] = [int(time.time()), masterKey, ticket]
-
-    util.writeToFile(yaml.dump(tickets), args.ticket_file)
+    print "[+] Adding new session ticket to `%s'." % args.ticket_file
+    store = TicketStore(args.ticket_file)
+    store.put(IPv4Address('TCP', args.ip_addr, args.tcp_port), masterKey,
+              ticket)
+    store.write()
 
     print "[+] Success."
@@ -9,7 +9,7 @@ import const
 import random
 import binascii
 
-import Crypto.Hash.SHA256
+import hashlib
 
 import util
 import mycrypto
@@ -17,6 +17,7 @@ import mycrypto
 import obfsproxy.transports.obfs3_dh as obfs3_dh
 import obfsproxy.transports.base as base
 import obfsproxy.common.log as logging
+import obfsproxy.common.crypto_worker as crypto_worker
 
 log = logging.get_obfslogger()
 
@@ -65,6 +66,56 @@ class UniformDH( object ):
         master secret as argument.  If any of this fails, `False' is returned.
         """
 
+        remotePublicKey = self.preparePublicKey(data, srvState)
+        if not remotePublicKey:
+            return False
+
+        try:
+            uniformDHSecret = self.udh.get_secret(remotePublicKey)
+        except ValueError:
+            raise base.PluggableTransportError("Corrupted public key.")
+
+        # Session keys are now derived from the master key.
+        callback(self.getMasterKey(uniformDHSecret))
+
+        return True
+
+    def receivePublicKeyAsync( self, data, srvState=None ):
+        """
+        Extract the public key and compute the master secret asynchronously.
+
+        This works like `receivePublicKey()' but the shared secret is computed
+        by the crypto worker.  If no public key could be extracted out of
+        `data', `None' is returned.  Otherwise, a Deferred is returned which
+        fires with the master secret or fails with a PluggableTransportError.
+        """
+
+        remotePublicKey = self.preparePublicKey(data, srvState)
+        if not remotePublicKey:
+            return None
+
+        d = crypto_worker.crypto_worker.compute_shared_secret(self.udh.priv,
+                                                              remotePublicKey)
+        d.addCallbacks(self.getMasterKey, self._corruptedPublicKey)
+
+        return d
+
+    def _corruptedPublicKey( self, failure ):
+        """
+        Turn a failed shared secret computation into a transport error.
+        """
+
+        failure.trap(ValueError)
+        raise base.PluggableTransportError("Corrupted public key.")
+
+    def preparePublicKey( self, data, srvState=None ):
+        """
+        Extract and return the remote public key and set up our DH object.
+
+        If no valid public key could be extracted out of `data', `False' is
+        returned.
+        """
+
         # Extract the public key sent by the remote host.
         remotePublicKey = self.extractPublicKey(data, srvState)
         if not remotePublicKey:
@@ -73,22 +124,20 @@ class UniformDH( object ):
         if self.weAreServer:
             self.remotePublicKey = remotePublicKey
             # As server, we need a DH object; as client, we already have one.
-            self.udh = obfs3_dh.UniformDH()
+            self.udh = obfs3_dh.keypair_pool.get()
 
         assert self.udh is not None
 
-        try:
-            uniformDHSecret = self.udh.get_secret(remotePublicKey)
-        except ValueError:
-            raise base.PluggableTransportError("Corrupted public key.")
+        return remotePublicKey
 
-        # First, hash the 4096-bit UniformDH secret to obtain the master key.
-        masterKey = Crypto.Hash.SHA256.new(uniformDHSecret).digest()
+    def getMasterKey( self, uniformDHSecret ):
+        """
+        Return the master key derived from the UniformDH secret.
 
-        # Second, session keys are now derived from the master key.
-        callback(masterKey)
+        The 4096-bit UniformDH secret is hashed to obtain the master key.
+        """
 
-        return True
+        return hashlib.sha256(uniformDHSecret).digest()
 
     def extractPublicKey( self, data, srvState=None ):
         """
@@ -108,13 +157,15 @@ class UniformDH( object ):
             return False
 
         log.debug("Attempting to extract the remote machine's UniformDH "
-                  "public key out of %d bytes of data." % len(data))
+                  "public key out of %d bytes of data.", len(data))
 
         handshake = data.peek()
 
+        keyedHMAC = mycrypto.KeyedHMAC(self.sharedSecret)
+
         # First, find the mark to efficiently locate the HMAC.
         publicKey = handshake[:const.PUBLIC_KEY_LENGTH]
-        mark = mycrypto.HMAC_SHA256_128(self.sharedSecret, publicKey)
+        mark = keyedHMAC(publicKey)
 
         index = util.locateMark(mark, handshake)
         if not index:
@@ -125,34 +176,27 @@ class UniformDH( object ):
         existingHMAC = handshake[hmacStart:
                                  (hmacStart + const.HMAC_SHA256_128_LENGTH)]
 
-        authenticated = False
-        for epoch in util.expandedEpoch():
-            myHMAC = mycrypto.HMAC_SHA256_128(self.sharedSecret,
-                                              handshake[0 : hmacStart] + epoch)
-
-            if util.isValidHMAC(myHMAC, existingHMAC, self.sharedSecret):
-                self.echoEpoch = epoch
-                authenticated = True
-                break
+        epoch = keyedHMAC.findEpoch(handshake[0 : hmacStart], existingHMAC,
+                                    util.expandedEpoch())
 
-            log.debug("HMAC invalid.  Trying next epoch value.")
-
-        if not authenticated:
+        if epoch is None:
             log.warning("Could not verify the authentication message's HMAC.")
             return False
 
-        # Do nothing if the ticket is replayed.  Immediately closing the
-        # connection would be suspicious.
-        if srvState is not None and srvState.isReplayed(existingHMAC):
-            log.warning("The HMAC was already present in the replay table.")
-            return False
-
-        data.drain(index + const.MARK_LENGTH + const.HMAC_SHA256_128_LENGTH)
+        self.echoEpoch = epoch
 
+        # Do nothing if the ticket is replayed.  Immediately closing the
+        # connection would be suspicious.  The lookup and the registration of
+        # the HMAC are one atomic step, so that two server processes can't
+        # both accept the same handshake.
         if srvState is not None:
             log.debug("Adding the HMAC authenticating the UniformDH message " \
-                      "to the replay table: %s." % existingHMAC.encode('hex'))
-            srvState.registerKey(existingHMAC)
+                      "to the replay table: %s.", existingHMAC.encode('hex'))
+            if not srvState.registerKey(existingHMAC):
+                log.warning("The HMAC was already present in the replay table.")
+                return False
+
+        data.drain(index + const.MARK_LENGTH + const.HMAC_SHA256_128_LENGTH)
 
         return handshake[:const.PUBLIC_KEY_LENGTH]
 
@@ -170,7 +214,7 @@ class UniformDH( object ):
         log.debug("Creating UniformDH handshake message.")
 
         if self.udh is None:
-            self.udh = obfs3_dh.UniformDH()
+            self.udh = obfs3_dh.keypair_pool.get()
         publicKey = self.udh.get_public()
 
         assert (const.MAX_PADDING_LENGTH - const.PUBLIC_KEY_LENGTH) >= 0
@@ -8,6 +8,7 @@ from files and to convert a number to raw text.
 import obfsproxy.common.log as logging
 
 import os
+import hmac
 import time
 import const
 
@@ -15,6 +16,11 @@ import mycrypto
 
 log = logging.get_obfslogger()
 
+# Key for the double HMAC verification in `isValidHMAC()' on Python versions
+# older than 2.7.7, which lack `hmac.compare_digest()'.
+_doubleHMACKey = None if hasattr(hmac, "compare_digest") else \
+                 mycrypto.strongRandom(const.SHA256_LENGTH)
+
 def setStateLocation( stateLocation ):
     """
     Set the constant `STATE_LOCATION' to the given `stateLocation'.
@@ -38,31 +44,35 @@ def setStateLocation( stateLocation ):
     # ...and if it does not exist yet, we attempt to create the full
     # directory path.
     if not os.path.exists(stateLocation):
-        log.info("Creating directory path `%s'." % stateLocation)
+        log.info("Creating directory path `%s'.", stateLocation)
         os.makedirs(stateLocation)
 
-    log.debug("Setting the state location to `%s'." % stateLocation)
+    log.debug("Setting the state location to `%s'.", stateLocation)
     const.STATE_LOCATION = stateLocation
 
 
-def isValidHMAC( hmac1, hmac2, key ):
+def isValidHMAC( hmac1, hmac2 ):
     """
-    Compares `hmac1' and `hmac2' after HMACing them again using `key'.
+    Compares `hmac1' and `hmac2' in constant time.
 
     The arguments `hmac1' and `hmac2' are compared.  If they are equal, `True'
-    is returned and otherwise `False'.  To prevent timing attacks, double HMAC
-    verification is used meaning that the two arguments are HMACed again before
-    (variable-time) string comparison.  The idea is taken from:
+    is returned and otherwise `False'.  To prevent timing attacks, the time
+    the comparison takes does not depend on where the two arguments differ.
+
+    Python versions older than 2.7.7 lack `hmac.compare_digest()'.  There,
+    double HMAC verification is used instead, meaning that the two arguments
+    are HMACed again with a secret key before (variable-time) string
+    comparison.  The idea is taken from:
     https://www.isecpartners.com/blog/2011/february/double-hmac-verification.aspx
     """
 
     assert len(hmac1) == len(hmac2)
 
-    # HMAC the arguments again to prevent timing attacks.
-    doubleHmac1 = mycrypto.HMAC_SHA256_128(key, hmac1)
-    doubleHmac2 = mycrypto.HMAC_SHA256_128(key, hmac2)
-
-    if doubleHmac1 != doubleHmac2:
+    if _doubleHMACKey is not None:
+        if mycrypto.HMAC_SHA256_128(_doubleHMACKey, hmac1) != \
+           mycrypto.HMAC_SHA256_128(_doubleHMACKey, hmac2):
+            return False
+    elif not hmac.compare_digest(hmac1, hmac2):
         return False
 
     log.debug("The computed HMAC is valid.")
@@ -124,7 +134,7 @@ def writeToFile( data, fileName ):
     an exception or return an error code.
     """
 
-    log.debug("Opening `%s' for writing." % fileName)
+    log.debug("Opening `%s' for writing.", fileName)
 
     try:
         with open(fileName, "wb") as desc:
@@ -146,10 +156,10 @@ def readFromFile( fileName, length=-1 ):
     data = None
 
     if not os.path.exists(fileName):
-        log.debug("File `%s' does not exist (yet?)." % fileName)
+        log.debug("File `%s' does not exist (yet?).", fileName)
         return None
 
-    log.debug("Opening `%s' for reading." % fileName)
+    log.debug("Opening `%s' for reading.", fileName)
 
     try:
         with open(fileName, "rb") as desc:
@@ -174,12 +184,12 @@ def sanitiseBase32( data ):
 
     if "1" in data:
         log.info("Found a \"1\" in Base32-encoded \"%s\".  Assuming " \
-                 "it's actually \"I\"." % data)
+                 "it's actually \"I\".", data)
         data = data.replace("1", "I")
 
     if "0" in data:
         log.info("Found a \"0\" in Base32-encoded \"%s\".  Assuming " \
-                 "it's actually \"O\"." % data)
+                 "it's actually \"O\".", data)
         data = data.replace("0", "O")
 
     return data
@@ -38,6 +38,7 @@ setup(
         ],
 
     extras_require = {
-        'SOCKS': ["txsocksx"]
+        'SOCKS': ["txsocksx"],
+        'OpenSSL': ["cryptography"]
         }
 )